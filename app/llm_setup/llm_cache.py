@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+DEFAULT_CACHE_PATH = "app/llm_setup/llm_cache.sqlite3"
+DEFAULT_DISABLED_KEYS = "final_recommendation,final_recommendation_with_reference"
+
+
+class LLMCache:
+    """Two-tier cache of LLM completions keyed on (model, rendered prompt, request parameters).
+
+    Lookups go to an in-memory LRU first and then to an optional SQLite file, which
+    survives restarts and is shared by every process pointing at the same path. Entries
+    older than ``ttl_seconds`` are treated as misses. Prompt keys listed in
+    ``disabled_keys`` bypass the cache entirely.
+    """
+
+    def __init__(self, path=None, max_memory_entries=1024, max_disk_entries=100_000, ttl_seconds=None,
+                 disabled_keys=()):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self.disabled_keys = frozenset(disabled_keys)
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_trim = 0
+        self.counters = defaultdict(lambda: {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0})
+
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at)")
+
+    @staticmethod
+    def make_key(model, prompt, params):
+        payload = json.dumps({"model": model, "prompt": prompt, "params": params}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def enabled_for(self, prompt_key):
+        return prompt_key not in self.disabled_keys
+
+    def _expired(self, created_at):
+        return self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds
+
+    def get(self, key, prompt_key=None):
+        with self._lock:
+            counters = self.counters[prompt_key]
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[1]):
+                    self._memory.move_to_end(key)
+                    counters["memory_hits"] += 1
+                    return entry[0]
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    if not self._expired(row[1]):
+                        self._db.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+                        self._remember(key, row[0], row[1])
+                        counters["disk_hits"] += 1
+                        return row[0]
+                    self._db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+
+            counters["misses"] += 1
+            return None
+
+    def set(self, key, response):
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, response, now, now)
+                )
+                self._writes_since_trim += 1
+                if self._writes_since_trim >= 100:
+                    self._trim_disk()
+
+    def record_bypass(self, prompt_key):
+        with self._lock:
+            self.counters[prompt_key]["bypassed"] += 1
+
+    def _remember(self, key, response, created_at):
+        self._memory[key] = (response, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _trim_disk(self):
+        self._writes_since_trim = 0
+        if self.ttl_seconds is not None:
+            self._db.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        excess = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] - self.max_disk_entries
+        if excess > 0:
+            self._db.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed_at LIMIT ?)",
+                (excess,)
+            )
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM llm_cache")
+
+    def stats(self):
+        with self._lock:
+            by_prompt = {str(key): dict(value) for key, value in self.counters.items()}
+            disk_entries = None
+            if self._db is not None:
+                disk_entries = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        totals = {name: sum(c[name] for c in by_prompt.values())
+                  for name in ("memory_hits", "disk_hits", "misses", "bypassed")}
+        return {
+            "memory_entries": len(self._memory),
+            "disk_entries": disk_entries,
+            "totals": totals,
+            "by_prompt": by_prompt,
+        }
+
+    @classmethod
+    def from_env(cls):
+        if os.getenv("LLM_CACHE_ENABLED", "true").lower() != "true":
+            return None
+        ttl = os.getenv("LLM_CACHE_TTL_SECONDS")
+        disabled_keys = os.getenv("LLM_CACHE_DISABLED_KEYS", DEFAULT_DISABLED_KEYS)
+        return cls(
+            path=os.getenv("LLM_CACHE_PATH", DEFAULT_CACHE_PATH) or None,
+            max_memory_entries=int(os.getenv("LLM_CACHE_MAX_MEMORY_ENTRIES", 1024)),
+            max_disk_entries=int(os.getenv("LLM_CACHE_MAX_DISK_ENTRIES", 100_000)),
+            ttl_seconds=float(ttl) if ttl else None,
+            disabled_keys=[key.strip() for key in disabled_keys.split(",") if key.strip()],
+        )
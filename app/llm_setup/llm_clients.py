@@ -0,0 +1,210 @@
+import json
+import re
+import string
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache
+from types import SimpleNamespace
+
+import tiktoken
+
+from llm_setup.llm_prompts import PROMPTS
+
+COLORS = {"red": "Red", "white": "White", "rosé": "Rosé", "rose": "Rosé"}
+TOKEN_ENCODING = "o200k_base"  # gpt-4o family
+COUNTRIES = ["US", "France", "Italy", "Spain", "Portugal", "Chile", "Argentina", "Australia", "Germany", "Austria",
+             "New Zealand", "South Africa"]
+
+
+def _template_pattern(template):
+    """Regex matching ``template`` once formatted; group ``gN`` captures the N-th distinct field."""
+    parts, fields = [], []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        parts.append(re.escape(literal))
+        if field is not None and field in fields:
+            parts.append(".*?")
+        elif field is not None:
+            parts.append(f"(?P<g{len(fields)}>.*?)")
+            fields.append(field)
+    return re.compile("".join(parts) + r"\Z", re.DOTALL), fields
+
+
+_PATTERNS = {key: _template_pattern(template) for key, template in PROMPTS.items()}
+
+
+def parse_prompt(prompt):
+    """``(prompt_key, fields)`` of a prompt rendered from ``PROMPTS``, or ``(None, {})``."""
+    for key, (pattern, fields) in _PATTERNS.items():
+        match = pattern.match(prompt)
+        if match:
+            return key, {field: match.group(f"g{i}") for i, field in enumerate(fields)}
+    return None, {}
+
+
+@lru_cache(maxsize=None)
+def _encoding():
+    try:
+        return tiktoken.get_encoding(TOKEN_ENCODING)
+    except Exception:  # the encoding is downloaded on first use; offline we estimate instead
+        return None
+
+
+def count_tokens(text):
+    """Token count of ``text`` for responses that don't report usage (~4 characters per token without tiktoken)."""
+    encoding = _encoding()
+    if encoding is None:
+        return max(1, len(text) // 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text, max_tokens):
+    """``text`` cut to at most ``max_tokens`` tokens, at a word boundary, with an ellipsis when shortened."""
+    encoding = _encoding()
+    if encoding is None:
+        if len(text) <= max_tokens * 4:
+            return text
+        cut = text[:(max_tokens - 1) * 4]
+    else:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        cut = encoding.decode(tokens[:max_tokens - 1])  # one token left for the ellipsis
+    return cut.rsplit(" ", 1)[0].rstrip(" ,;:") + "…"
+
+
+def _response(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class StubLLMClient:
+    """Deterministic, offline stand-in for the OpenAI client.
+
+    Recognizes which prompt of ``PROMPTS`` it was sent and answers in the format the
+    caller parses, derived only from the query text (simple keyword rules for metadata
+    and intent), so pipelines and evaluations run without network access, cost or
+    variance. ``latency`` seconds are slept per call to emulate API round trips.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, stream=False, **params):
+        prompt = messages[-1]["content"]
+        content = self.respond(*parse_prompt(prompt))
+        if self.latency:
+            time.sleep(self.latency)
+        usage = SimpleNamespace(prompt_tokens=count_tokens(prompt), completion_tokens=count_tokens(content))
+        if stream:
+            return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word))], usage=None)
+                         for word in re.findall(r"\S+\s*", content)])
+        response = _response(content)
+        response.usage = usage
+        return response
+
+    def respond(self, prompt_key, fields):
+        query = fields.get("query") or fields.get("original_query") or fields.get("initial_query") or ""
+        if prompt_key == "metadata_extraction":
+            return repr(self.metadata(query))
+        if prompt_key == "classify_query_intent":
+            return repr(self.intent(query))
+        if prompt_key == "query_understanding":
+            return json.dumps({**self.intent(query), **self.metadata(query), "rewritten_query": query})
+        if prompt_key == "generate_fusion_queries":
+            variations = [f"{query} {aspect}" for aspect in ("flavor profile", "aroma", "body and finish")]
+            return repr(variations[:int(fields.get("num_queries") or 3)])
+        if prompt_key == "generate_hypo":
+            return f"Title: A wine for this request\nDescription: {query}"
+        if prompt_key == "generate_clarifying_questions":
+            return "\n".join(f"{i}. Could you tell me more about your preferences?"
+                             for i in range(1, int(fields.get("number_of_questions") or 3) + 1))
+        if prompt_key in ("final_recommendation", "final_recommendation_with_reference"):
+            titles = re.findall(r"^Title: (.*)$", fields.get("retrieval_context", ""), re.MULTILINE)
+            return f"I recommend {titles[0]}." if titles else "I have no recommendation for this request."
+        return query
+
+    @staticmethod
+    def metadata(query):
+        lowered = query.lower()
+        positive = {key: "-" for key in ["min_price", "max_price", "points", "variety_designation", "country",
+                                         "province", "wine_color", "min_vintage", "max_vintage"]}
+        match = re.search(r"(?:under|below|less than|up to|max(?:imum)?)\s*\$?\s*(\d+)(?!\s*points)", lowered)
+        if match:
+            positive["max_price"] = int(match.group(1))
+        match = re.search(r"(?:over|above|from|starting at|at least)\s*\$\s*(\d+)", lowered)
+        if match:
+            positive["min_price"] = int(match.group(1))
+        match = re.search(r"(\d{2,3})\s*(?:\+\s*)?points", lowered)
+        if match:
+            positive["points"] = int(match.group(1))
+        for word, color in COLORS.items():
+            if re.search(rf"\b{word}\b", lowered):
+                positive["wine_color"] = color
+                break
+        for country in COUNTRIES:
+            if re.search(rf"\b{re.escape(country.lower())}\b", lowered):
+                positive["country"] = country
+                break
+        negative = {key: "-" for key in ["variety_designation", "country", "province", "wine_color"]}
+        return {"positive": positive, "negative": negative}
+
+    @staticmethod
+    def intent(query):
+        match = re.search(r"(?:similar to|like|reminds me of|in the spirit of)\s+(.+?)[.?!]?$", query, re.IGNORECASE)
+        if match and match.group(1)[:1].isupper():
+            return {"intent": "similar", "reference": match.group(1)}
+        return {"intent": "normal", "reference": ""}
+
+
+class UsageTrackingClient:
+    """Wraps an OpenAI-compatible client and records calls, latency and token usage per prompt key.
+
+    Streamed completions are counted when the stream is exhausted; token counts fall
+    back to ``count_tokens`` when the response carries no usage.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self._lock = threading.Lock()
+        self.usage = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0})
+
+    def _record(self, prompt_key, prompt_tokens, completion_tokens, seconds):
+        with self._lock:
+            entry = self.usage[prompt_key or "other"]
+            entry["calls"] += 1
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["seconds"] += seconds
+
+    def create(self, model, messages, stream=False, **params):
+        prompt = messages[-1]["content"]
+        prompt_key, _ = parse_prompt(prompt)
+        start = time.perf_counter()
+        response = self.client.chat.completions.create(model=model, messages=messages, stream=stream, **params)
+        if stream:
+            return self._tracked_stream(response, prompt_key, prompt, start)
+
+        usage = getattr(response, "usage", None)
+        content = response.choices[0].message.content or ""
+        self._record(prompt_key, getattr(usage, "prompt_tokens", None) or count_tokens(prompt),
+                     getattr(usage, "completion_tokens", None) or count_tokens(content), time.perf_counter() - start)
+        return response
+
+    def _tracked_stream(self, stream, prompt_key, prompt, start):
+        parts = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+            yield chunk
+        self._record(prompt_key, count_tokens(prompt), count_tokens("".join(parts)), time.perf_counter() - start)
+
+    def totals(self):
+        with self._lock:
+            return {
+                "calls": sum(entry["calls"] for entry in self.usage.values()),
+                "prompt_tokens": sum(entry["prompt_tokens"] for entry in self.usage.values()),
+                "completion_tokens": sum(entry["completion_tokens"] for entry in self.usage.values()),
+                "by_prompt": {key: dict(entry) for key, entry in self.usage.items()},
+            }
@@ -193,6 +193,28 @@ For example:
 4. Query: I'm seeking a wine in the spirit of 2013 Chehalem Vineyard Pinot Noir from the Chehalem Mountains, with a vibrant, layered fruit profile.",
    Answer: {{"intent": "similar", "reference": "2013 Chehalem Vineyard Pinot Noir (Chehalem Mountains)"}}
 Now, analyze the following query and return your answer as a dict with keys "intent" and "reference":
+{query}
+    """,
+
+    "query_understanding": """You are the query analysis step of a wine recommendation system. Analyze the user's query once and return a single JSON object with exactly these keys:
+
+- "intent" (string): "similar" if the user wants a wine that resembles a specific reference wine, otherwise "normal".
+- "reference" (string): the exact wine name mentioned as the reference, as it would appear in our records, without extra adjectives or qualifiers. Our titles follow the structure "Winery Name Vintage Wine Type (Region)", e.g. "Chateau Lafayette Reneau 2016 Pinot Noir Rosé (Finger Lakes)". Use an empty string when no wine is named.
+- "positive" (object): the preferences stated in the query, with the keys "min_price", "max_price", "points", "min_vintage", "max_vintage" (numbers) and "variety_designation", "country", "province", "wine_color" (strings; wine_color is one of “Red”, “White”, “Rosé”). Use '-' for every key the query does not mention. "under $25" is a max_price of 25, "from $15" is a min_price of 15, "rated around 90" is points 90, "vintage from 2005" is a min_vintage of 2005.
+- "negative" (object): what the user explicitly wants to avoid (e.g. “not Chardonnay”, “anything but France”, “no Rosé”), with only the keys "variety_designation", "country", "province", "wine_color". Use '-' for every key without an exclusion. Numeric fields never appear here.
+- "rewritten_query" (string): if any negative value is not '-', the query rewritten as natural, fluent text that no longer mentions the excluded elements and does not mention what is excluded. Otherwise the original query unchanged.
+
+Example:
+Query: "A Rosé from New York under $20 rated around 90, but not a Pinot Noir"
+Answer: {{
+  "intent": "normal",
+  "reference": "",
+  "positive": {{"min_price": "-", "max_price": 20, "points": 90, "variety_designation": "-", "country": "-", "province": "New York", "wine_color": "Rosé", "min_vintage": "-", "max_vintage": "-"}},
+  "negative": {{"variety_designation": "Pinot Noir", "country": "-", "province": "-", "wine_color": "-"}},
+  "rewritten_query": "A Rosé from New York under $20 rated around 90"
+}}
+
+Return only the JSON object. Query:
 {query}
     """
 }
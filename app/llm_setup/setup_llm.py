@@ -1,16 +1,152 @@
+import os
+import threading
+import time
+
 from openai import OpenAI
 
+from llm_setup.llm_cache import LLMCache
+from llm_setup.llm_clients import StubLLMClient, count_tokens
+from monitoring.metrics import observe_stage, record_llm_cache_hit, record_llm_usage, timed
+
+LLM_MODEL = "gpt-4o-mini-2024-07-18"
+
+_llm_cache = None
+_llm_cache_configured = False
+_llm_cache_lock = threading.Lock()
+
+
+def using_stub_llm():
+    return os.getenv("LLM_BACKEND", "openai").lower() == "stub"
+
 
 def set_up_llm():
+    # LLM_BACKEND=stub answers every prompt locally and deterministically (evaluation, load tests).
+    if using_stub_llm():
+        return StubLLMClient(latency=float(os.getenv("STUB_LLM_LATENCY", 0)))
     client = OpenAI()
     return client
 
 
-def prompt_llm(client, prompt: str) -> str:
-    response = client.chat.completions.create(
-        model="gpt-4o-mini-2024-07-18",
-        messages=[
-            {"role": "user", "content": prompt}
-        ]
-    )
-    return response.choices[0].message.content
+def get_llm_cache():
+    global _llm_cache, _llm_cache_configured
+    with _llm_cache_lock:
+        if not _llm_cache_configured:
+            # Stub completions must never be served to (or from) the real model's cache.
+            _llm_cache = LLMCache.from_env() if not using_stub_llm() else None
+            _llm_cache_configured = True
+        return _llm_cache
+
+
+def set_llm_cache(cache):
+    global _llm_cache, _llm_cache_configured
+    with _llm_cache_lock:
+        _llm_cache = cache
+        _llm_cache_configured = True
+
+
+def complete(choice):
+    """Whether the model finished on its own (not cut off by max tokens or a content filter)."""
+    return getattr(choice, "finish_reason", None) in (None, "stop")
+
+
+def prompt_llm(client, prompt: str, response_format=None, prompt_key=None, parse=None):
+    """Complete ``prompt``, going through the LLM cache.
+
+    With ``parse`` the parsed completion is returned instead of the raw text. Only
+    completions that finished normally and parse (``parse`` raises ``ValueError`` or
+    ``SyntaxError`` otherwise) are cached, so a malformed answer is not served again.
+    """
+    params = {}
+    if response_format is not None:
+        params["response_format"] = response_format
+
+    cache = get_llm_cache()
+    cache_key = None
+    if cache is not None:
+        if cache.enabled_for(prompt_key):
+            cache_key = cache.make_key(LLM_MODEL, prompt, params)
+            cached = cache.get(cache_key, prompt_key=prompt_key)
+            if cached is not None:
+                try:
+                    result = cached if parse is None else parse(cached)
+                except (ValueError, SyntaxError):
+                    pass  # cached before it was validated; ask again and overwrite it
+                else:
+                    record_llm_cache_hit(prompt_key)
+                    return result
+        else:
+            cache.record_bypass(prompt_key)
+
+    with timed(f"llm.{prompt_key or 'other'}"):
+        response = client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            **params
+        )
+    content = response.choices[0].message.content
+    usage = getattr(response, "usage", None)
+    record_llm_usage(prompt_key, getattr(usage, "prompt_tokens", None) or count_tokens(prompt),
+                     getattr(usage, "completion_tokens", None) or count_tokens(content or ""))
+
+    result = content if parse is None else parse(content)
+    if cache_key is not None and content is not None and complete(response.choices[0]):
+        cache.set(cache_key, content)
+    return result
+
+
+def prompt_llm_stream(client, prompt: str, prompt_key=None):
+    """Like ``prompt_llm`` but yields the completion in chunks as the model produces them.
+
+    A cache hit is yielded as a single chunk. A completion is cached, under the same key
+    ``prompt_llm`` would use, only once it was streamed to the end and finished normally.
+    The call is timed from the request to the last chunk, and its time to first token as
+    the ``.first_token`` stage.
+    """
+    cache = get_llm_cache()
+    cache_key = None
+    if cache is not None:
+        if cache.enabled_for(prompt_key):
+            cache_key = cache.make_key(LLM_MODEL, prompt, {})
+            cached = cache.get(cache_key, prompt_key=prompt_key)
+            if cached is not None:
+                record_llm_cache_hit(prompt_key)
+                yield cached
+                return
+        else:
+            cache.record_bypass(prompt_key)
+
+    stage = f"llm.{prompt_key or 'other'}"
+    parts = []
+    usage = None
+    finished = True
+    with timed(stage):
+        start = time.perf_counter()
+        stream = client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        for chunk in stream:
+            # With include_usage the last chunk carries the token counts and no choices.
+            usage = getattr(chunk, "usage", None) or usage
+            if not chunk.choices:
+                continue
+            if getattr(chunk.choices[0], "finish_reason", None):
+                finished = complete(chunk.choices[0])
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if not parts:
+                    observe_stage(f"{stage}.first_token", start)
+                parts.append(delta)
+                yield delta
+
+    record_llm_usage(prompt_key, getattr(usage, "prompt_tokens", None) or count_tokens(prompt),
+                     getattr(usage, "completion_tokens", None) or count_tokens("".join(parts)))
+
+    if cache_key is not None and parts and finished:
+        cache.set(cache_key, "".join(parts))
@@ -1,10 +1,21 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from dotenv import load_dotenv
-from rag_methods.rag import RAG, RetrievalStrategy, EmbeddingModel
+from rag_methods.rag import RAG, RetrievalStrategy, EmbeddingModel, RequestConfig
+from rag_methods.catalog import Catalog
+from rag_methods.context_builder import DEFAULT_CONTEXT_TOKENS
 from rag_methods.clarification import generate_clarifying_questions
 from rag_methods.llm_calls import rewrite_query_smart
+from vectorstore.load_vectorstore import VECTORSTORE_CONFIG
+from vectorstore.ingest import ingest
+from llm_setup.setup_llm import get_llm_cache
+from monitoring.metrics import metrics_registry, trace_request
 import pandas as pd
+import numpy as np
+import hmac
+import json
 import os
+import threading
+from contextlib import nullcontext
 
 load_dotenv()
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
@@ -12,37 +23,239 @@ os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
 app = Flask(__name__)
 
 csv_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data_processing', 'wine_data_final.csv')
-df = pd.read_csv(csv_path)
+catalog_state = {'mtime': os.path.getmtime(csv_path), 'lock': threading.Lock()}
+BATCH_MAX_QUERIES = int(os.getenv('BATCH_MAX_QUERIES', 10000))
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', 16))
+CATALOG_API_TOKEN = os.getenv('CATALOG_API_TOKEN')
+INGEST_MAX_WINES = int(os.getenv('INGEST_MAX_WINES', 200))
+rag_system = RAG(df=pd.read_csv(csv_path), emb_model_name=EmbeddingModel.OPENAI, retrieval_strategy=RetrievalStrategy.FUSION, k=5)
 
-rag_system = RAG(df=df, emb_model_name=EmbeddingModel.OPENAI, retrieval_strategy=RetrievalStrategy.FUSION, k=5)
+@app.before_request
+def refresh_catalog():
+    """Reloads the catalog once it has been changed by ingestion (in any worker process or the CLI)."""
+    mtime = os.path.getmtime(csv_path)
+    if mtime == catalog_state['mtime']:
+        return
+    with catalog_state['lock']:
+        if mtime != catalog_state['mtime']:
+            rag_system.set_catalog(Catalog.from_frame(pd.read_csv(csv_path)))
+            catalog_state['mtime'] = mtime
+
+def service_metrics():
+    """Index, cache and catalog gauges, read when ``/metrics`` is scraped."""
+    loaded = rag_system.registry.loaded()
+    yield ('wine_rag_index_documents', 'gauge', 'Documents in each loaded index.',
+           [({'emb_model': e['emb_model']}, e['documents']) for e in loaded])
+    yield ('wine_rag_index_bytes', 'gauge', 'Estimated resident bytes of each loaded index.',
+           [({'emb_model': e['emb_model']}, e['bytes']) for e in loaded])
+    yield ('wine_rag_index_mapped_bytes', 'gauge', 'Part of the estimated bytes that is memory-mapped.',
+           [({'emb_model': e['emb_model']}, e['mapped_bytes']) for e in loaded])
+    yield ('wine_rag_index_load_seconds', 'gauge', 'Time it took to load each index.',
+           [({'emb_model': e['emb_model']}, e['load_seconds']) for e in loaded])
+    query_caches = [(e['emb_model'], e['query_cache']) for e in loaded if e['query_cache']]
+    for name in ('hits', 'misses'):
+        yield (f'wine_rag_query_embedding_cache_{name}_total', 'counter', f'Query embedding cache {name}.',
+               [({'emb_model': emb_model}, stats[name]) for emb_model, stats in query_caches])
+    yield ('wine_rag_query_embedding_cache_entries', 'gauge', 'Cached query embeddings.',
+           [({'emb_model': emb_model}, stats['entries']) for emb_model, stats in query_caches])
+    yield ('wine_rag_catalog_wines', 'gauge', 'Wines in the served catalog.', [({}, len(rag_system.catalog.store))])
+
+    cache = get_llm_cache()
+    if cache is not None:
+        stats = cache.stats()
+        for name in ('memory_hits', 'disk_hits', 'misses', 'bypassed'):
+            yield (f'wine_rag_llm_cache_{name}_total', 'counter', f'LLM cache {name.replace("_", " ")} by prompt.',
+                   [({'prompt_key': key}, counters[name]) for key, counters in stats['by_prompt'].items()])
+        yield ('wine_rag_llm_cache_entries', 'gauge', 'LLM cache entries by tier.',
+               [({'tier': 'memory'}, stats['memory_entries']), ({'tier': 'disk'}, stats['disk_entries'])])
+
+metrics_registry.register_collector(service_metrics)
+
+def request_config(args):
+    """Builds the immutable per-request config from query args; raises ValueError on bad input."""
+    return RequestConfig(
+        strategy=args.get('strategy', 'hyde').lower(),
+        emb_model=args.get('emb_model', 'openai').lower(),
+        k=int(args.get('k', rag_system.default_config.k)),
+        num_results=int(args.get('num_results', 1)),
+        prefilter=args.get('prefilter', 'false').lower() == 'true',
+        single_call=args.get('single_call', 'false').lower() == 'true',
+        context_tokens=int(args.get('context_tokens', DEFAULT_CONTEXT_TOKENS))
+    )
 
 @app.route('/recommend', methods=['GET'])
 def recommend():
     query = request.args.get('query')
-    strategy = request.args.get('strategy', 'hyde').lower()
-    num_results = int(request.args.get('num_results', 1))
-    emb_model = request.args.get('emb_model', 'openai').lower()
     if not query:
         return jsonify({'error': 'Query parameter is required'}), 400
 
     try:
-        rag_system.set_retrieval_strategy(strategy)
+        config = request_config(request.args)
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
 
+    debug = request.args.get('debug', 'false').lower() == 'true'
+    with trace_request() if debug else nullcontext() as trace:
+        recommendation = rag_system.recommend(query, config)
+
+    response = {
+        'query': query,
+        'strategy': config.strategy,
+        'recommendation': recommendation
+    }
+    if debug:
+        response['debug'] = trace.summary()
+    return jsonify(response)
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=_json_default)}\n\n"
+
+@app.route('/recommend/stream', methods=['GET'])
+def recommend_stream():
+    query = request.args.get('query')
+    if not query:
+        return jsonify({'error': 'Query parameter is required'}), 400
+
     try:
-        rag_system.set_emb_model(emb_model)
+        config = request_config(request.args)
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
 
-    recommendation = rag_system.recommend(query, num_results=num_results)
+    debug = request.args.get('debug', 'false').lower() == 'true'
+
+    def generate():
+        with trace_request() if debug else nullcontext() as trace:
+            try:
+                for event, data in rag_system.recommend_stream(query, config):
+                    yield sse_event(event, data)
+            except Exception as e:
+                yield sse_event('error', {'error': str(e)})
+            if debug:
+                yield sse_event('debug', trace.summary())
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/recommend/batch', methods=['POST'])
+def recommend_batch():
+    """Many recommendations in one request, streamed back as NDJSON lines in completion order.
+
+    Body: ``{"queries": [...], "defaults": {...}, "max_concurrency": 8}``; each query is a string
+    or an object with ``query`` and any of the ``/recommend`` parameters, which override ``defaults``.
+    """
+    data = request.get_json(silent=True) or {}
+    queries = data.get('queries')
+    defaults = data.get('defaults', {})
+    if not isinstance(queries, list) or not queries or not isinstance(defaults, dict):
+        return jsonify({'error': "A non-empty 'queries' list is required."}), 400
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify({'error': f'At most {BATCH_MAX_QUERIES} queries per batch.'}), 400
+    try:
+        max_concurrency = min(max(int(data.get('max_concurrency', 8)), 1), BATCH_MAX_CONCURRENCY)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'max_concurrency must be an integer'}), 400
 
+    items, invalid = [], []
+    for index, entry in enumerate(queries):
+        if isinstance(entry, str):
+            entry = {'query': entry}
+        params = {**defaults, **entry} if isinstance(entry, dict) else {}
+        try:
+            if not params.get('query'):
+                raise ValueError('query is required')
+            config = request_config({key: str(value).lower() if isinstance(value, bool) else str(value)
+                                     for key, value in params.items()})
+        except ValueError as e:
+            invalid.append({'index': index, 'error': str(e)})
+            continue
+        items.append((index, params['query'], config))
+
+    def generate():
+        for line in invalid:
+            yield json.dumps(line) + "\n"
+        results = rag_system.recommend_batch([(query, config) for _, query, config in items], max_concurrency)
+        for position, recommendation, error in results:
+            index, query, config = items[position]
+            line = {'index': index, 'query': query, 'strategy': config.strategy}
+            line.update({'error': str(error)} if error else {'recommendation': recommendation})
+            yield json.dumps(line, default=_json_default) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/models', methods=['GET'])
+def models():
     return jsonify({
-        'query': query,
-        'strategy': strategy,
-        'recommendation': recommendation
+        'available': list(VECTORSTORE_CONFIG),
+        'loaded': rag_system.registry.loaded(),
+        'memory_cap_bytes': rag_system.registry.memory_cap_bytes
     })
 
+@app.route('/llm_cache', methods=['GET'])
+def llm_cache_stats():
+    cache = get_llm_cache()
+    if cache is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **cache.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+def authorized():
+    supplied = request.headers.get('Authorization', '')
+    return hmac.compare_digest(supplied.encode(), f'Bearer {CATALOG_API_TOKEN}'.encode())
+
+def catalog_change(field, change):
+    """Runs ``change`` on the non-empty ``field`` list of the JSON body (or the body itself when it is a list).
+
+    Catalog changes are disabled unless ``CATALOG_API_TOKEN`` is set, and then need it as a
+    bearer token. Each request is limited to ``INGEST_MAX_WINES`` entries and never compacts
+    the indexes, so it only embeds what it changes; ``vectorstore/ingest.py`` handles bulk
+    changes and compaction offline.
+    """
+    if not CATALOG_API_TOKEN:
+        return jsonify({'error': 'Catalog changes are disabled; set CATALOG_API_TOKEN to enable them.'}), 403
+    if not authorized():
+        return jsonify({'error': 'A valid bearer token is required.'}), 401
+
+    data = request.get_json(silent=True)
+    values = data.get(field) if isinstance(data, dict) else data
+    if not isinstance(values, list) or not values:
+        return jsonify({'error': f"A non-empty '{field}' list is required."}), 400
+    if len(values) > INGEST_MAX_WINES:
+        return jsonify({'error': f'At most {INGEST_MAX_WINES} {field} per request.'}), 400
+
+    try:
+        summary = change(values)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    refresh_catalog()
+    return jsonify(summary)
+
+def upsert_wines(wines):
+    if not all(isinstance(wine, dict) for wine in wines):
+        raise ValueError('Every wine must be an object.')
+    return ingest(upserts=pd.DataFrame(wines), csv_path=csv_path, compact=False, registry=rag_system.registry)
+
+def delete_wines(ids):
+    if not all(isinstance(wine_id, (str, int)) and not isinstance(wine_id, bool) for wine_id in ids):
+        raise ValueError('Every id must be a string or an integer.')
+    return ingest(delete_ids=ids, csv_path=csv_path, compact=False, registry=rag_system.registry)
+
+@app.route('/catalog/upsert', methods=['POST'])
+def catalog_upsert():
+    return catalog_change('wines', upsert_wines)
+
+@app.route('/catalog/delete', methods=['POST'])
+def catalog_delete():
+    return catalog_change('ids', delete_wines)
+
 @app.route('/generate_questions', methods=['POST'])
 def generate_questions():
     data = request.get_json()
@@ -96,4 +309,4 @@ def rewrite_query():
     })
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000, debug=True)
+    app.run(host='0.0.0.0', port=8000, threaded=True, debug=os.getenv('FLASK_DEBUG', 'false').lower() == 'true')
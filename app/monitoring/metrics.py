@@ -0,0 +1,212 @@
+import contextvars
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            lines += [f"{self.name}{_format_labels(labels)} {_format_value(value)}"
+                      for labels, value in sorted(self._values.items())]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} "
+                                 f"{cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {series['sum']!r}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {series['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """Counters and histograms updated in-process, plus collectors that read gauges at scrape time.
+
+    A collector returns ``(name, type, help, samples)`` tuples, ``samples`` being
+    ``(labels_dict, value)`` pairs. ``render`` produces the Prometheus text format.
+    Metrics are per process; with several gunicorn workers each one is scraped separately.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text):
+        metric = Counter(name, help_text)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets=STAGE_BUCKETS):
+        metric = Histogram(name, help_text, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        for collector in self._collectors:
+            for name, metric_type, help_text, samples in collector():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+                lines += [f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}"
+                          for labels, value in samples if value is not None]
+        return "\n".join(lines) + "\n"
+
+
+metrics_registry = MetricsRegistry()
+
+stage_seconds = metrics_registry.histogram("wine_rag_stage_seconds", "Time spent per pipeline stage.")
+llm_calls = metrics_registry.counter("wine_rag_llm_calls_total", "LLM API calls (cache hits excluded) by prompt.")
+llm_prompt_tokens = metrics_registry.counter("wine_rag_llm_prompt_tokens_total", "Prompt tokens sent by prompt.")
+llm_completion_tokens = metrics_registry.counter("wine_rag_llm_completion_tokens_total",
+                                                 "Completion tokens received by prompt.")
+batch_search_failures = metrics_registry.counter(
+    "wine_rag_batch_search_failures_total",
+    "Batched searches that failed, by embedding model and error; their queries were searched one by one.")
+relaxation_levels = metrics_registry.counter(
+    "wine_rag_metadata_relaxation_level_total",
+    "Metadata filtering runs by the loosest relaxation level their results needed.")
+
+
+class RequestTrace:
+    """Stage timings and LLM usage of one request, for the debug breakdown."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+        self.llm = defaultdict(lambda: {"calls": 0, "cached": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, started, seconds):
+        with self._lock:
+            self.stages.append({"stage": stage, "start_ms": round((started - self.start) * 1000, 2),
+                                "ms": round(seconds * 1000, 2)})
+
+    def add_llm(self, prompt_key, prompt_tokens=0, completion_tokens=0, cached=False):
+        with self._lock:
+            entry = self.llm[prompt_key or "other"]
+            entry["cached" if cached else "calls"] += 1
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+
+    def summary(self):
+        with self._lock:
+            stages = sorted(self.stages, key=lambda stage: stage["start_ms"])
+            totals = defaultdict(float)
+            for stage in stages:
+                totals[stage["stage"]] += stage["ms"]
+            return {
+                "total_ms": round((time.perf_counter() - self.start) * 1000, 2),
+                "stages": stages,
+                "stage_totals_ms": {stage: round(ms, 2) for stage, ms in totals.items()},
+                "llm": {key: dict(entry) for key, entry in self.llm.items()},
+            }
+
+
+@contextmanager
+def trace_request():
+    """Collect a ``RequestTrace`` for everything run in this context (and tasks submitted through ``run_async``)."""
+    trace = RequestTrace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def observe_stage(stage, start):
+    """Record ``stage`` as having run from ``start`` (a ``time.perf_counter()`` value) until now."""
+    seconds = time.perf_counter() - start
+    stage_seconds.observe(seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_stage(stage, start, seconds)
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, start)
+
+
+def record_llm_usage(prompt_key, prompt_tokens, completion_tokens):
+    prompt_key = prompt_key or "other"
+    llm_calls.inc(prompt_key=prompt_key)
+    llm_prompt_tokens.inc(prompt_tokens, prompt_key=prompt_key)
+    llm_completion_tokens.inc(completion_tokens, prompt_key=prompt_key)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_llm(prompt_key, prompt_tokens, completion_tokens)
+
+
+def record_llm_cache_hit(prompt_key):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_llm(prompt_key, cached=True)
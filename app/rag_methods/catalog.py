@@ -0,0 +1,44 @@
+import threading
+import weakref
+
+from rag_methods.fuzzy_index import TitleIndex
+from rag_methods.metadata_filter import MetadataColumns
+from rag_methods.metadata_matching import MetadataVocabularies, get_allowed_values
+from vectorstore.bm25_index import BM25_INDEX_PATH, load_or_build_bm25_index
+from vectorstore.create_vectorstore import DOCUMENTS_CACHE_DIR, frame_fingerprint
+from vectorstore.document_store import bind_document_store, load_or_create_document_store
+
+
+class Catalog:
+    """The wine catalog and everything derived from it: document store, BM25 index, matching
+    vocabularies, metadata columns and title index.
+
+    Built as a whole so that ingestion can replace it with a single assignment; a request
+    reads one ``Catalog`` from start to finish. Loaded vectorstores are shared by every
+    catalog and never modified; ``vectorstore`` gives this catalog's view of one.
+    """
+
+    def __init__(self, store, bm25_index):
+        self.store = store
+        self.bm25_index = bm25_index
+        self.vocabularies = MetadataVocabularies(get_allowed_values(store.frame))
+        self.metadata_columns = MetadataColumns(store.frame)
+        self.title_index = TitleIndex(store.frame.get("title", []))
+        self._views = weakref.WeakKeyDictionary()
+        self._views_lock = threading.Lock()
+
+    @classmethod
+    def from_frame(cls, df, cache_dir=DOCUMENTS_CACHE_DIR, bm25_path=BM25_INDEX_PATH):
+        # The catalog is kept once, in the document store; ``df`` is not retained. Both caches are
+        # keyed on its content hash, computed once here.
+        fingerprint = frame_fingerprint(df)
+        store = load_or_create_document_store(df, cache_dir, fingerprint=fingerprint)
+        return cls(store, load_or_build_bm25_index(store, fingerprint, bm25_path))
+
+    def vectorstore(self, vectorstore):
+        """``vectorstore`` hydrating its results from this catalog's document store, bound once per store."""
+        with self._views_lock:
+            view = self._views.get(vectorstore)
+            if view is None:
+                view = self._views[vectorstore] = bind_document_store(vectorstore, self.store)
+            return view
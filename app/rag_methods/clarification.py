@@ -5,6 +5,6 @@ import re
 
 def generate_clarifying_questions(client, query, num_questions=3):
     prompt = get_prompt("generate_clarifying_questions", initial_query=query, number_of_questions=num_questions)
-    clarifying_questions = prompt_llm(client, prompt)
+    clarifying_questions = prompt_llm(client, prompt, prompt_key="generate_clarifying_questions")
     clarifying_questions = re.findall(r'^\d+\.\s*(.*)', clarifying_questions, re.MULTILINE)
     return clarifying_questions
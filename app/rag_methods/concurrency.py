@@ -0,0 +1,21 @@
+import contextvars
+from concurrent.futures import Future
+
+
+def run_async(executor, fn, *args, **kwargs):
+    """Submit ``fn`` to ``executor``, or run it inline when no executor is given.
+
+    Either way the caller gets a ``Future``, so pipeline code reads the same with and
+    without a thread pool. Tasks submitted here must never block on other tasks of
+    the same pool; chain dependent work in the submitting thread instead. The task runs
+    in a copy of the caller's context, so per-request state (e.g. the debug trace) follows it.
+    """
+    if executor is not None:
+        return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
@@ -0,0 +1,134 @@
+import os
+import re
+
+from langchain_core.documents import Document
+
+from llm_setup.llm_clients import count_tokens, truncate_tokens
+
+DEFAULT_CONTEXT_TOKENS = int(os.getenv("RECOMMENDATION_CONTEXT_TOKENS", 1200))
+MIN_DESCRIPTION_TOKENS = 40
+MIN_REVIEW_TOKENS = 20
+MIN_REVIEW_WORDS = 3
+REVIEW_OVERLAP = 0.6
+
+_CONTENT_WORD = re.compile(r"[a-z][a-z']{3,}")  # short words are mostly stop words
+
+
+def parse_document(text):
+    """Split a document's ``page_content`` into title, description, metadata line and reviews."""
+    sections = {"title": None, "description": None, "metadata": None, "reviews": []}
+    in_reviews = False
+    for line in text.split("\n"):
+        if in_reviews:
+            if line.strip():
+                sections["reviews"].append(line.strip())
+        elif line.startswith("Title: "):
+            sections["title"] = line
+        elif line.startswith("Description: "):
+            sections["description"] = line
+        elif line == "Reviews:":
+            in_reviews = True
+        elif line.strip():
+            sections["metadata"] = line
+    return sections
+
+
+def documents_for(num_results):
+    """How many of the retrieved documents the prompt gets at least: a few candidates per requested wine."""
+    return 2 * num_results + 1
+
+
+def profile_tokens(profile):
+    """Tokens of a profile's title, metadata and description lines."""
+    return sum(count_tokens(section) + 1 for section in (profile["title"], profile["metadata"], profile["description"])
+               if section)
+
+
+def select_profiles(documents, num_results, max_tokens):
+    """Profiles of the documents that go into the prompt, in retrieval order.
+
+    The first ``documents_for(num_results)`` always do; each further one only while its
+    title, metadata and description still fit in ``max_tokens`` with those of the ones
+    before it, so a larger budget gives the model more candidates instead of only more reviews.
+    """
+    profiles = [parse_document(doc.page_content) for doc in documents]
+    minimum = documents_for(num_results)
+    used = sum(profile_tokens(profile) for profile in profiles[:minimum])
+    count = min(minimum, len(profiles))
+    for profile in profiles[minimum:]:
+        used += profile_tokens(profile)
+        if used > max_tokens:
+            break
+        count += 1
+    return profiles[:count]
+
+
+def _words(text):
+    return set(_CONTENT_WORD.findall(text.lower()))
+
+
+def distinct_reviews(reviews, description=None):
+    """Reviews that add something: too-short ones and near-duplicates (of each other or the description) dropped."""
+    seen = [_words(description)] if description else []
+    kept = []
+    for review in reviews:
+        words = _words(review)
+        if len(words) < MIN_REVIEW_WORDS:
+            continue
+        if any(len(words & other) >= REVIEW_OVERLAP * len(words) for other in seen):
+            continue
+        seen.append(words)
+        kept.append(review)
+    return kept
+
+
+def build_recommendation_context(documents, num_results=1, max_tokens=DEFAULT_CONTEXT_TOKENS):
+    """Wine profiles for the recommendation prompt, within ``max_tokens`` tokens.
+
+    The budget decides how many documents are included (see ``select_profiles``).
+    Sections are then filled by priority across them: titles and metadata (price,
+    points, country, vintage...) always, then descriptions, then distinct reviews
+    round-robin, so every wine keeps its facts and the budget goes to tasting notes
+    of as many wines as possible. A section that doesn't fit whole is truncated.
+    """
+    profiles = select_profiles(documents, num_results, max_tokens)
+    parts = [[section for section in (profile["title"], profile["metadata"]) if section] for profile in profiles]
+    remaining = max_tokens - sum(count_tokens(part) + 1 for doc_parts in parts for part in doc_parts)
+
+    for doc_parts, profile in zip(parts, profiles):
+        description = profile["description"]
+        if description is None or remaining < MIN_DESCRIPTION_TOKENS:
+            continue
+        tokens = count_tokens(description) + 1
+        if tokens > remaining:
+            description, tokens = truncate_tokens(description, remaining - 1), remaining
+        doc_parts.insert(1, description)
+        remaining -= tokens
+
+    reviews = [distinct_reviews(profile["reviews"], profile["description"]) for profile in profiles]
+    added = [[] for _ in profiles]
+    for review_index in range(max((len(doc_reviews) for doc_reviews in reviews), default=0)):
+        for doc_reviews, doc_added in zip(reviews, added):
+            if review_index >= len(doc_reviews) or remaining < MIN_REVIEW_TOKENS:
+                continue
+            review = doc_reviews[review_index]
+            tokens = count_tokens(review) + 1 + (0 if doc_added else 3)  # "Reviews:" header
+            if tokens > remaining:
+                review, tokens = truncate_tokens(review, remaining - 1), remaining
+            doc_added.append(review)
+            remaining -= tokens
+
+    for doc_parts, doc_added in zip(parts, added):
+        if doc_added:
+            doc_parts.append("Reviews:\n" + "\n".join(doc_added))
+    return "\n\n".join("\n".join(doc_parts) for doc_parts in parts)
+
+
+def condensed_reference(reference_doc, max_tokens):
+    """The reference wine without its reviews, its description cut to fit ``max_tokens``."""
+    profile = parse_document(reference_doc.page_content)
+    parts = [section for section in (profile["title"], profile["metadata"]) if section]
+    remaining = max_tokens - sum(count_tokens(part) + 1 for part in parts)
+    if profile["description"] is not None and remaining >= MIN_DESCRIPTION_TOKENS:
+        parts.insert(1, truncate_tokens(profile["description"], remaining - 1))
+    return Document(page_content="\n".join(parts), metadata=reference_doc.metadata)
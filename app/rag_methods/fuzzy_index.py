@@ -0,0 +1,92 @@
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from fuzzywuzzy import fuzz
+from fuzzywuzzy.utils import full_process
+
+
+def ngrams(processed, n=3):
+    grams = set()
+    for token in processed.split():
+        padded = f" {token} "
+        grams.update(padded[i:i + n] for i in range(max(len(padded) - n + 1, 1)))
+    return grams
+
+
+class NgramIndex:
+    """Fuzzy matching over a fixed list of strings, blocked by a character n-gram inverted index.
+
+    Strings are processed once (``full_process``, as fuzzywuzzy does per call) and only
+    the ``max_candidates`` entries sharing the most n-grams with the query are scored,
+    so a lookup costs the same however large the vocabulary grows. Results are ordered
+    like fuzzywuzzy's: by score, then by position in ``strings``.
+    """
+
+    def __init__(self, strings, n=3, max_candidates=200):
+        self.strings = tuple(strings)
+        self.processed = tuple(full_process(s) for s in self.strings)
+        self.n = n
+        self.max_candidates = max_candidates
+
+        postings = defaultdict(list)
+        self.gram_counts = np.zeros(len(self.strings), dtype=np.int32)
+        for position, processed in enumerate(self.processed):
+            grams = ngrams(processed, n)
+            self.gram_counts[position] = len(grams)
+            for gram in grams:
+                postings[gram].append(position)
+        self.postings = {gram: np.asarray(positions, dtype=np.int32) for gram, positions in postings.items()}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def candidates(self, processed_query):
+        query_grams = ngrams(processed_query, self.n)
+        hits = [self.postings[gram] for gram in query_grams if gram in self.postings]
+        if not hits:
+            return np.empty(0, dtype=np.int64)
+        counts = np.bincount(np.concatenate(hits), minlength=len(self.strings))
+        positions = np.flatnonzero(counts)
+        if len(positions) > self.max_candidates:
+            # Containment rather than raw overlap, so short entries found inside the query (which
+            # partial-ratio scorers rate highly) compete with long entries that share many n-grams.
+            containment = counts[positions] / np.minimum(self.gram_counts[positions], len(query_grams))
+            top = np.lexsort((-counts[positions], -containment))[:self.max_candidates]
+            positions = np.sort(positions[top])
+        return positions
+
+    def extract(self, query, scorer=fuzz.WRatio, score_cutoff=0, limit=None):
+        """``[(position, score), ...]`` of the best matches scoring at least ``score_cutoff``."""
+        processed_query = full_process(query)
+        scored = []
+        for position in self.candidates(processed_query).tolist():
+            score = scorer(processed_query, self.processed[position])
+            if score >= score_cutoff:
+                scored.append((position, score))
+        scored.sort(key=lambda match: (-match[1], match[0]))
+        return scored[:limit] if limit is not None else scored
+
+    def extract_one(self, query, scorer=fuzz.WRatio, score_cutoff=0):
+        matches = self.extract(query, scorer=scorer, score_cutoff=score_cutoff, limit=1)
+        return (self.strings[matches[0][0]], matches[0][1]) if matches else None
+
+
+class TitleIndex:
+    """Wine titles, built once: normalized title -> first row, plus an n-gram index for fuzzy lookups."""
+
+    def __init__(self, titles):
+        titles = pd.Series(titles)
+        self.title_to_row = {}
+        for row, title in enumerate(titles.astype(str).str.strip().str.lower()):
+            self.title_to_row.setdefault(title, row)
+        self.ngram_index = NgramIndex(titles.dropna().astype(str).unique().tolist())
+
+    def match(self, wine_name, threshold=80):
+        best_match = self.ngram_index.extract_one(wine_name, scorer=fuzz.token_set_ratio)
+        if best_match and best_match[1] >= threshold:
+            return best_match[0]
+        return None
+
+    def row_for_title(self, title):
+        return self.title_to_row.get(title.strip().lower())
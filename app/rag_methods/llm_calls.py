@@ -1,60 +1,90 @@
 from llm_setup.llm_prompts import get_prompt
-from llm_setup.setup_llm import prompt_llm
+from llm_setup.setup_llm import prompt_llm, prompt_llm_stream
 import ast
+import json
 
 
 def extract_metadata(client, query):
     prompt = get_prompt('metadata_extraction', query=query)
-    result = prompt_llm(client, prompt)
-    result = ast.literal_eval(result)
+    result = prompt_llm(client, prompt, prompt_key='metadata_extraction', parse=ast.literal_eval)
     return result
 
 
 def generate_hypothetical_document(llm_client, query):
     prompt = get_prompt('generate_hypo', query=query)
-    hypo_doc = prompt_llm(llm_client, prompt)
+    hypo_doc = prompt_llm(llm_client, prompt, prompt_key='generate_hypo')
     return hypo_doc
 
 
 def generate_queries_llm(client, original_query, num_queries=3):
     prompt = get_prompt('generate_fusion_queries', original_query=original_query, num_queries=num_queries)
-    response = prompt_llm(client, prompt)
-    response = ast.literal_eval(response)
+    response = prompt_llm(client, prompt, prompt_key='generate_fusion_queries', parse=ast.literal_eval)
     return response
 
 
 def rewrite_query_smart(client, original_query, context):
     prompt = get_prompt('rewrite_query', original_query=original_query, context=chr(10).join(context))
-    response = prompt_llm(client, prompt)
+    response = prompt_llm(client, prompt, prompt_key='rewrite_query')
     return response
 
 
+def has_negative_metadata(negative_metadata):
+    return any(value != "-" for value in negative_metadata.values())
+
+
 def rewrite_query_remove_negative_metadata(client, original_query, negative_metadata):
     def format_metadata(md):
         return "\n".join(
             f"- {key}: {value}" for key, value in md.items() if value != "-"
         )
 
+    if not has_negative_metadata(negative_metadata):
+        return original_query
+
     prompt = get_prompt('remove_negative_metadata', original_query=original_query,
                         negative_metadata=format_metadata(negative_metadata))
 
-    return prompt_llm(client, prompt)
+    return prompt_llm(client, prompt, prompt_key='remove_negative_metadata')
 
 
 def classify_query_intent(client, query):
     prompt = get_prompt("classify_query_intent", query=query)
-    response = prompt_llm(client, prompt)
-    response = ast.literal_eval(response)
+    response = prompt_llm(client, prompt, prompt_key="classify_query_intent", parse=ast.literal_eval)
     return response
 
 
-def get_recommendation(client, retrieval_context, query, reference_doc=None, reference_wine_present=False,
-                       num_results=1):
+def parse_json_object(text):
+    try:
+        response = json.loads(text)
+    except json.JSONDecodeError:
+        response = ast.literal_eval(text)
+    if not isinstance(response, dict):
+        raise ValueError(f"Expected a JSON object, got {type(response).__name__}")
+    return response
+
+
+def understand_query(client, query):
+    prompt = get_prompt("query_understanding", query=query)
+    response = prompt_llm(client, prompt, response_format={"type": "json_object"},
+                          prompt_key="query_understanding", parse=parse_json_object)
+
+    negative = response.get("negative") or {}
+    rewritten_query = response.get("rewritten_query") or query
+    return {
+        "intent": {"intent": response.get("intent", "normal"), "reference": response.get("reference", "")},
+        "metadata": {"positive": response.get("positive") or {}, "negative": negative},
+        "rewritten_query": rewritten_query if has_negative_metadata(negative) else query,
+    }
+
+
+def recommendation_prompt(retrieval_context, query, reference_doc=None, reference_wine_present=False,
+                          num_results=1):
     plural_suffix = "s" if num_results > 1 else ""
+    prompt_key = "final_recommendation_with_reference" if reference_wine_present else "final_recommendation"
 
     if reference_wine_present:
         final_prompt = get_prompt(
-            "final_recommendation_with_reference",
+            prompt_key,
             retrieval_context=retrieval_context,
             query=query,
             reference_wine=reference_doc,
@@ -63,12 +93,26 @@ def get_recommendation(client, retrieval_context, query, reference_doc=None, ref
         )
     else:
         final_prompt = get_prompt(
-            "final_recommendation",
+            prompt_key,
             retrieval_context=retrieval_context,
             query=query,
             num_results=num_results,
             plural_suffix=plural_suffix
         )
 
-    recommendation = prompt_llm(client, final_prompt)
+    return prompt_key, final_prompt
+
+
+def get_recommendation(client, retrieval_context, query, reference_doc=None, reference_wine_present=False,
+                       num_results=1):
+    prompt_key, final_prompt = recommendation_prompt(retrieval_context, query, reference_doc,
+                                                     reference_wine_present, num_results)
+    recommendation = prompt_llm(client, final_prompt, prompt_key=prompt_key)
     return recommendation
+
+
+def stream_recommendation(client, retrieval_context, query, reference_doc=None, reference_wine_present=False,
+                          num_results=1):
+    prompt_key, final_prompt = recommendation_prompt(retrieval_context, query, reference_doc,
+                                                     reference_wine_present, num_results)
+    return prompt_llm_stream(client, final_prompt, prompt_key=prompt_key)
@@ -0,0 +1,180 @@
+import numpy as np
+import pandas as pd
+
+from monitoring.metrics import relaxation_levels
+
+NUMERIC_FIELDS = ["price", "points", "vintage"]
+CATEGORICAL_FIELDS = ["variety", "designation", "province", "region_1", "country", "wine_color"]
+
+RELAXATION_GROUPS = [
+    ["min_price", "max_price"],
+    ["points"],
+    ["min_vintage", "max_vintage"],
+    ["country"],
+    ["province"]
+]
+
+# positive constraint key -> (column, comparison that rejects a row)
+NUMERIC_CONSTRAINTS = {
+    "min_price": ("price", np.less),
+    "max_price": ("price", np.greater),
+    "points": ("points", np.less),
+    "min_vintage": ("vintage", np.less),
+    "max_vintage": ("vintage", np.greater),
+}
+
+# constraint key -> columns any of which may satisfy it
+CATEGORICAL_CONSTRAINTS = {
+    "variety_designation": ["variety", "designation"],
+    "province": ["province", "region_1"],
+    "country": ["country"],
+    "wine_color": ["wine_color"],
+}
+
+
+def normalize_value(value):
+    return str(value).strip().lower()
+
+
+def as_targets(value):
+    return [normalize_value(v) for v in (value if isinstance(value, list) else [value])]
+
+
+class MetadataColumns:
+    """Columnar copy of the wine metadata used by metadata filtering.
+
+    Numeric fields are float arrays (NaN when missing), categorical fields are integer
+    codes into a per-field vocabulary of normalized values (-1 when missing). Rows are
+    addressed by position; ``id_to_row`` maps document ids to positions.
+    """
+
+    def __init__(self, df):
+        if "id" in df.columns:
+            ids = [doc_id if pd.notna(doc_id) else f"doc_{idx}" for idx, doc_id in zip(df.index, df["id"])]
+        else:
+            ids = [f"doc_{idx}" for idx in df.index]
+        self.ids = ids
+        self.id_to_row = {doc_id: row for row, doc_id in enumerate(ids)}
+        self.num_rows = len(df)
+
+        self.numeric = {}
+        for col in NUMERIC_FIELDS:
+            if col in df.columns:
+                values = pd.to_numeric(df[col], errors="coerce")
+            else:
+                values = pd.Series(np.nan, index=df.index)
+            self.numeric[col] = values.to_numpy(dtype=np.float64)
+
+        self.codes = {}
+        self.categories = {}
+        for col in CATEGORICAL_FIELDS:
+            if col in df.columns:
+                values = df[col].astype(object)
+                normalized = values.where(values.isna(), values.astype(str).str.strip().str.lower())
+                codes, uniques = pd.factorize(normalized)
+            else:
+                codes, uniques = np.full(len(df), -1), []
+            self.codes[col] = codes.astype(np.int32)
+            self.categories[col] = {value: code for code, value in enumerate(uniques)}
+
+    def rows_for(self, documents):
+        return np.fromiter((self.id_to_row.get(doc.metadata.get("id"), -1) for doc in documents),
+                           dtype=np.int64, count=len(documents))
+
+    def categorical_mask(self, columns, targets):
+        mask = np.zeros(self.num_rows, dtype=bool)
+        for col in columns:
+            codes = [self.categories[col][t] for t in targets if t in self.categories[col]]
+            if codes:
+                mask |= np.isin(self.codes[col], codes)
+        return mask
+
+    def compile(self, constraints):
+        return CompiledConstraints(self, constraints)
+
+
+class CompiledConstraints:
+    """Constraints from ``match_metadata_all`` compiled into catalog-wide boolean masks.
+
+    Relaxation level ``i`` drops the first ``i`` groups of ``RELAXATION_GROUPS`` from the
+    positive constraints; the final fallback level keeps only the desired wine color.
+    """
+
+    def __init__(self, columns, constraints):
+        self.columns = columns
+        self.constraints = constraints
+        positive = constraints.get("positive", {})
+        negative = constraints.get("negative", {})
+
+        self.positive_masks = {}
+        for key, limit in positive.items():
+            if limit == "-":
+                continue
+            if key in NUMERIC_CONSTRAINTS:
+                col, rejects = NUMERIC_CONSTRAINTS[key]
+                try:
+                    limit = float(limit)
+                except (TypeError, ValueError):
+                    continue
+                self.positive_masks[key] = ~rejects(columns.numeric[col], limit)
+            elif key in CATEGORICAL_CONSTRAINTS:
+                self.positive_masks[key] = columns.categorical_mask(CATEGORICAL_CONSTRAINTS[key], as_targets(limit))
+
+        self.negative_mask = np.ones(columns.num_rows, dtype=bool)
+        for key, bad_val in negative.items():
+            if bad_val == "-" or key not in CATEGORICAL_CONSTRAINTS:
+                continue
+            self.negative_mask &= ~columns.categorical_mask(CATEGORICAL_CONSTRAINTS[key], as_targets(bad_val))
+
+        desired_color = normalize_value(positive.get("wine_color", "-"))
+        if desired_color == "-":
+            self.color_mask = np.ones(columns.num_rows, dtype=bool)
+        else:
+            self.color_mask = columns.categorical_mask(["wine_color"], [desired_color])
+
+    @property
+    def num_levels(self):
+        return len(RELAXATION_GROUPS) + 1
+
+    def level_mask(self, level, rows=None):
+        """Rows matching relaxation level ``level`` (``num_levels`` is the color-only fallback)."""
+        def take(mask):
+            return mask if rows is None else mask[rows]
+
+        if level >= self.num_levels:
+            return take(self.color_mask)
+        relaxed = {key for group in RELAXATION_GROUPS[:level] for key in group}
+        mask = take(self.negative_mask).copy()
+        for key, key_mask in self.positive_masks.items():
+            if key not in relaxed:
+                mask &= take(key_mask)
+        return mask
+
+    def allowed_mask(self, min_count):
+        """Catalog mask of the strictest relaxation level with at least ``min_count`` rows."""
+        for level in range(self.num_levels + 1):
+            mask = self.level_mask(level)
+            if mask.sum() >= min_count:
+                return mask
+        return mask
+
+    def select(self, rows, k=15):
+        """Positions into ``rows`` of the first ``k`` matches, strictest relaxation level first.
+
+        Within a level, candidates keep their input order; rows that match no level
+        (or are unknown, -1) are dropped.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        known = rows >= 0
+        safe_rows = np.where(known, rows, 0)
+        excluded = self.num_levels + 1
+        levels = np.full(len(rows), excluded, dtype=np.int64)
+
+        for level in range(self.num_levels + 1):
+            matched = (levels == excluded) & known & self.level_mask(level, safe_rows)
+            levels[matched] = level
+
+        order = np.argsort(levels, kind="stable")
+        selected = order[levels[order] < excluded][:k]
+        relaxation_levels.inc(level=int(levels[selected[-1]]) if len(selected) else "none", path="postfilter")
+        return selected
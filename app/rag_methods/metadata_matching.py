@@ -1,61 +1,77 @@
-from fuzzywuzzy import process, fuzz
-from vectorstore.create_vectorstore import create_documents
+from fuzzywuzzy.utils import full_process
 
+from rag_methods.fuzzy_index import NgramIndex
 
-def fuzzy_match_all(value, candidates, threshold=80):
+
+VOCABULARY_FIELDS = {
+    "variety_designation": ["variety", "designation"],
+    "province": ["province", "region_1"],
+    "country": ["country"],
+    "wine_color": ["wine_color"],
+}
+
+
+class MetadataVocabularies:
+    """Immutable, deduplicated matching vocabularies per constraint field, built once from ``get_allowed_values``.
+
+    Each field gets an ``NgramIndex`` so a lookup scores a bounded candidate set instead
+    of the whole vocabulary; values that only differ after fuzzywuzzy's processing are
+    kept once (first spelling wins).
+    """
+
+    def __init__(self, allowed_values):
+        self.indexes = {}
+        for field, columns in VOCABULARY_FIELDS.items():
+            values = {}
+            for col in columns:
+                for value in allowed_values.get(col, []):
+                    values.setdefault(full_process(str(value)), str(value))
+            self.indexes[field] = NgramIndex(values.values())
+
+    def __getitem__(self, field):
+        return self.indexes[field]
+
+
+def fuzzy_match_all(value, index, threshold=80, limit=5):
     if value == "-":
         return value
-    matches = process.extractBests(value, candidates, score_cutoff=threshold)
+    matches = index.extract(value, score_cutoff=threshold, limit=limit)
     if matches:
-        return [match[0] for match in matches]
+        return [index.strings[position] for position, _ in matches]
     else:
         return value
 
 
-def fuzzy_match_one(value, candidates, threshold=80):
+def fuzzy_match_one(value, index, threshold=80):
     if value == "-":
         return value
-    match = process.extractOne(value, candidates, score_cutoff=threshold)
+    match = index.extract_one(value, score_cutoff=threshold)
     return match[0] if match else value
 
 
-def match_metadata_all(extracted_metadata, allowed_values):
+def match_metadata_all(extracted_metadata, vocabularies):
     matched_positive = {}
     for key in ["min_price", "max_price", "points", "min_vintage", "max_vintage"]:
         matched_positive[key] = extracted_metadata["positive"].get(key, -1)
 
-    combined_candidates = list(set(allowed_values.get("variety", []) + allowed_values.get("designation", [])))
-    allowed_provinces = allowed_values.get("province", [])
-    if "region_1" in allowed_values:
-        allowed_provinces += allowed_values["region_1"]
-    allowed_provinces = list(set(allowed_provinces))
-
     matched_positive["variety_designation"] = fuzzy_match_all(
-        extracted_metadata["positive"].get("variety_designation", "-"), combined_candidates
+        extracted_metadata["positive"].get("variety_designation", "-"), vocabularies["variety_designation"]
     )
     matched_positive["province"] = fuzzy_match_all(
-        extracted_metadata["positive"].get("province", "-"), allowed_provinces
+        extracted_metadata["positive"].get("province", "-"), vocabularies["province"]
     )
     matched_positive["country"] = fuzzy_match_one(
-        extracted_metadata["positive"].get("country", "-"), allowed_values.get("country", [])
+        extracted_metadata["positive"].get("country", "-"), vocabularies["country"]
     )
     matched_positive["wine_color"] = fuzzy_match_one(
-        extracted_metadata["positive"].get("wine_color", "-"), allowed_values.get("wine_color", [])
+        extracted_metadata["positive"].get("wine_color", "-"), vocabularies["wine_color"]
     )
 
     matched_negative = {}
-    matched_negative["variety_designation"] = fuzzy_match_one(
-        extracted_metadata["negative"].get("variety_designation", "-"), combined_candidates
-    )
-    matched_negative["province"] = fuzzy_match_one(
-        extracted_metadata["negative"].get("province", "-"), allowed_provinces
-    )
-    matched_negative["country"] = fuzzy_match_one(
-        extracted_metadata["negative"].get("country", "-"), allowed_values.get("country", [])
-    )
-    matched_negative["wine_color"] = fuzzy_match_one(
-        extracted_metadata["negative"].get("wine_color", "-"), allowed_values.get("wine_color", [])
-    )
+    for field in VOCABULARY_FIELDS:
+        matched_negative[field] = fuzzy_match_one(
+            extracted_metadata["negative"].get(field, "-"), vocabularies[field]
+        )
 
     return {
         "positive": matched_positive,
@@ -74,105 +90,13 @@ def get_allowed_values(df):
     return allowed_values
 
 
-def metadata_matches(doc_meta, constraints):
-    positive = constraints.get("positive", {})
-    negative = constraints.get("negative", {})
-    # --- Positive Constraints ---
-    for key, limit in positive.items():
-        if limit == "-":
-            continue
-        if key in ["min_price", "max_price", "min_vintage", "max_vintage", "points"]:
-            value = doc_meta.get(key.replace("min_", "").replace("max_", ""), None)
-            if value is None:
-                return False
-            if key.startswith("min_") and value < limit:
-                return False
-            if key.startswith("max_") and value > limit:
-                return False
-            if key == "points" and value < limit:
-                return False
-        elif key == "variety_designation":
-            val1 = doc_meta.get("variety", "").lower()
-            val2 = doc_meta.get("designation", "").lower()
-            targets = [v.lower() for v in (limit if isinstance(limit, list) else [limit])]
-            if not any(t in [val1, val2] for t in targets):
-                return False
-
-        elif key == "province":
-            val1 = doc_meta.get("province", "").lower()
-            val2 = doc_meta.get("region_1", "").lower()
-            targets = [v.lower() for v in (limit if isinstance(limit, list) else [limit])]
-            if not any(t in [val1, val2] for t in targets):
-                return False
-
-        else:
-            val = str(doc_meta.get(key, "")).lower()
-            target = str(limit).lower()
-            if val != target:
-                return False
-
-    # --- Negative Constraints ---
-    for key, bad_val in negative.items():
-        if bad_val == "-":
-            continue
-
-        values = [v.lower() for v in (bad_val if isinstance(bad_val, list) else [bad_val])]
-
-        if key == "variety_designation":
-            val1 = doc_meta.get("variety", "").lower()
-            val2 = doc_meta.get("designation", "").lower()
-            if any(v in [val1, val2] for v in values):
-                return False
-
-        elif key == "province":
-            val1 = doc_meta.get("province", "").lower()
-            val2 = doc_meta.get("region_1", "").lower()
-            if any(v in [val1, val2] for v in values):
-                return False
-
-        else:
-            val = str(doc_meta.get(key, "")).lower()
-            if val in values:
-                return False
-
-    return True
-
-def get_similar_wine(df, wine_name):
-    def match_wine_name_best(df, wine_name, threshold=80):
-        titles = df['title'].dropna().unique().tolist()
-        best_match = process.extractOne(wine_name, titles, scorer=fuzz.token_set_ratio)
-
-        if best_match and best_match[1] >= threshold:
-            return best_match[0]
-        return None
-
-    def get_document_by_title(df, target_title):
-        target = target_title.strip().lower()
-
-        df["title_normalized"] = df["title"].astype(str).str.strip().str.lower()
-
-        filtered_df = df[df["title_normalized"] == target]
-
-        if filtered_df.empty:
-            print(f"[ERROR] No exact match for title: {target_title}")
-            print("[INFO] Top fuzzy matches:")
-            titles = df["title"].dropna().unique().tolist()
-            print(process.extract(target_title, titles, limit=5))
-            raise ValueError(f"Could not find document for matched title '{target_title}'")
-
-        documents = create_documents(filtered_df)
-
-        if not documents:
-            raise ValueError(f"Document creation failed for matched title '{target_title}'")
-
-        return documents[0]
-
-    matched_wine_title = match_wine_name_best(df, wine_name)
+def get_similar_wine(title_index, documents, wine_name):
+    matched_wine_title = title_index.match(wine_name)
     if not matched_wine_title:
         raise ValueError(f"No wine matched the title '{wine_name}' with sufficient confidence.")
 
-    matched_wine_document = get_document_by_title(df, matched_wine_title)
-    if not matched_wine_document:
+    row = title_index.row_for_title(matched_wine_title)
+    if row is None:
         raise ValueError(f"Could not find document for matched title '{matched_wine_title}'")
 
-    return matched_wine_document
+    return documents[row]
@@ -1,7 +1,9 @@
 from llm_setup.setup_llm import set_up_llm
-from rag_methods.metadata_matching import match_metadata_all, get_allowed_values, get_similar_wine
+from rag_methods.metadata_matching import match_metadata_all, get_similar_wine
+from rag_methods.catalog import Catalog
 from rag_methods.llm_calls import extract_metadata, get_recommendation, rewrite_query_remove_negative_metadata, \
-    classify_query_intent
+    classify_query_intent, understand_query, stream_recommendation, generate_hypothetical_document, \
+    generate_queries_llm
 from rag_methods.retrieval_strategies import (
     hyde_retrieval,
     fusion_retrieval,
@@ -9,12 +11,18 @@ from rag_methods.retrieval_strategies import (
     naive_retrieval,
     hybrid_retrieval
 )
-from vectorstore.load_vectorstore import load_vectorstore
-
-from vectorstore.create_vectorstore import create_vectorstore, create_documents
-
-
-# from langchain_community.embeddings import HuggingFaceEmbeddings
+from vectorstore.registry import vectorstore_registry
+from vectorstore.search import BatchSearch
+from rag_methods.concurrency import run_async
+from rag_methods.context_builder import DEFAULT_CONTEXT_TOKENS, build_recommendation_context, condensed_reference
+from llm_setup.llm_clients import count_tokens
+from monitoring.metrics import batch_search_failures, observe_stage, timed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextvars
+import logging
+import time
+from dataclasses import dataclass
+from openai import OpenAIError
 
 
 class RetrievalStrategy:
@@ -30,83 +38,298 @@ class EmbeddingModel:
     ROBERTA = 'roberta'
 
 
+def options(cls):
+    return [value for name, value in vars(cls).items() if not name.startswith("_")]
+
+
+@dataclass(frozen=True)
+class RequestConfig:
+    """Per-request pipeline settings; the shared ``RAG`` instance is never mutated to apply them."""
+    strategy: str = RetrievalStrategy.FUSION
+    emb_model: str = EmbeddingModel.OPENAI
+    k: int = 10
+    num_results: int = 1
+    prefilter: bool = False
+    single_call: bool = False
+    context_tokens: int = DEFAULT_CONTEXT_TOKENS
+
+    def __post_init__(self):
+        if self.strategy not in options(RetrievalStrategy):
+            raise ValueError(f"Invalid strategy. Available strategies: {options(RetrievalStrategy)}")
+        if self.emb_model not in options(EmbeddingModel):
+            raise ValueError(f"Invalid embedding model. Available models: {options(EmbeddingModel)}")
+        if self.k < 1 or self.num_results < 1 or self.context_tokens < 1:
+            raise ValueError("k, num_results and context_tokens must be positive")
+
+
+BATCH_SEARCH_K = 100
+# Failures of a batched search (embedding API errors, an index that can't be loaded) after which
+# each query of the chunk searches on its own, so only the queries that fail again report an error.
+BATCH_SEARCH_ERRORS = (OpenAIError, OSError, RuntimeError)
+
+logger = logging.getLogger(__name__)
+
+
 class RAG:
-    def __init__(self, df, emb_model_name, retrieval_strategy, k=10):
-        self.vectorstore = load_vectorstore(emb_model_name)
+    """Read-only after construction, so one instance can serve concurrent requests.
+
+    Everything that varies per request travels in a ``RequestConfig``. The only exception is
+    ``catalog``, which ingestion replaces as a whole (``set_catalog``); each request reads it once.
+    """
+
+    def __init__(self, df, emb_model_name, retrieval_strategy, k=10, registry=vectorstore_registry, max_workers=16):
+        self.default_config = RequestConfig(strategy=retrieval_strategy, emb_model=emb_model_name, k=k)
+        self.registry = registry
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag")
 
-        # embedding_fn = HuggingFaceEmbeddings(model_name="all-mpnet-base-v2")
-        # self.vectorstore = create_vectorstore(embedding_fn, self.documents)
+        # Indexes are built offline: ``PYTHONPATH=app python app/vectorstore/build_vectorstore.py <emb_model>``.
 
-        self.documents = create_documents(df)
+        self.catalog = Catalog.from_frame(df)
+        self.vectorstore(emb_model_name)
 
         self.client = set_up_llm()
-        self.retrieval_strategy = retrieval_strategy
-        self.k = k
-        self.allowed_values = get_allowed_values(df)
-        self.df = df
-
-    def set_retrieval_strategy(self, strategy: str):
-        if strategy not in vars(RetrievalStrategy).values():
-            raise ValueError(f"Invalid strategy. Available strategies: {vars(RetrievalStrategy).values()}")
-        self.retrieval_strategy = strategy
-
-    def set_emb_model(self, emb_model):
-        if emb_model not in vars(EmbeddingModel).values():
-            raise ValueError(f"Invalid embedding model. Available models: {vars(EmbeddingModel).values()}")
-        self.vectorstore = load_vectorstore(emb_model)
-
-    def extracted_and_match_metadata(self, query):
+
+    def set_catalog(self, catalog):
+        """Serve ``catalog`` from now on, with the loaded indexes brought up to date with it in place."""
+        self.registry.refresh()
+        self.catalog = catalog
+
+    def vectorstore(self, emb_model, catalog=None):
+        catalog = catalog or self.catalog
+        return catalog.vectorstore(self.registry.get(emb_model))
+
+    def extracted_and_match_metadata(self, query, catalog=None):
+        catalog = catalog or self.catalog
         extracted_metadata = extract_metadata(self.client, query)
-        matched_metadata = match_metadata_all(extracted_metadata, self.allowed_values)
+        with timed("match_metadata"):
+            matched_metadata = match_metadata_all(extracted_metadata, catalog.vocabularies)
         return extracted_metadata, matched_metadata
 
-    def retrieve(self, query: str, matched_metadata, similar_intent=False):
-        k = self.k + 1
+    def retrieve(self, query: str, matched_metadata, config=None, similar_intent=False, catalog=None,
+                 expanded=None, batch=None):
+        """Retrieved documents by strategy name.
+
+        ``expanded`` are the texts ``expand_query`` generated for ``query`` and ``batch`` a
+        ``BatchSearch`` holding their neighbours; both are optional and skip that work here.
+        """
+        config = config or self.default_config
+        catalog = catalog or self.catalog
+        vectorstore = self.vectorstore(config.emb_model, catalog)
+        k = config.k + 1
         if similar_intent:
             k += 1
+        constraints = catalog.metadata_columns.compile(matched_metadata)
+        prefilter = config.prefilter
 
-        if self.retrieval_strategy == RetrievalStrategy.NAIVE:
-            return {'naive': naive_retrieval(query, self.vectorstore, k=k)}
+        if config.strategy == RetrievalStrategy.NAIVE:
+            return {'naive': naive_retrieval(query, vectorstore, k=k, batch=batch)}
 
-        elif self.retrieval_strategy == RetrievalStrategy.HYBRID:
-            return {'hybrid': hybrid_retrieval(query, self.vectorstore, self.documents, matched_metadata, k=k)}
+        elif config.strategy == RetrievalStrategy.HYBRID:
+            return {'hybrid': hybrid_retrieval(query, vectorstore, catalog.bm25_index, catalog.store,
+                                                constraints, k=k, prefilter=prefilter, executor=self.executor,
+                                                batch=batch)}
 
-        elif self.retrieval_strategy == RetrievalStrategy.HYDE:
-            return {'hyde': hyde_retrieval(query, self.client, self.vectorstore, matched_metadata, k=k)}
+        elif config.strategy == RetrievalStrategy.HYDE:
+            return {'hyde': hyde_retrieval(query, self.client, vectorstore, constraints, k=k, prefilter=prefilter,
+                                           hypo_doc=expanded[0] if expanded else None, batch=batch)}
 
-        elif self.retrieval_strategy == RetrievalStrategy.FUSION:
-            return {'fusion': fusion_retrieval(query, self.client, self.vectorstore, matched_metadata, num_queries=3,
-                                               top_k=k, dense_k=k)}
+        elif config.strategy == RetrievalStrategy.FUSION:
+            return {'fusion': fusion_retrieval(query, self.client, vectorstore, constraints, num_queries=3,
+                                               top_k=k, dense_k=k, prefilter=prefilter, executor=self.executor,
+                                               fusion_queries=expanded[:-1] if expanded else None, batch=batch)}
         else:
-            raise ValueError(f"Unknown retrieval strategy: {self.retrieval_strategy}")
+            raise ValueError(f"Unknown retrieval strategy: {config.strategy}")
+
+    def expand_query(self, query, config):
+        """The texts ``retrieve`` searches for ``query`` (generating them with the LLM for hyde and fusion)."""
+        if config.strategy == RetrievalStrategy.HYDE:
+            return [generate_hypothetical_document(self.client, query)]
+        if config.strategy == RetrievalStrategy.FUSION:
+            return generate_queries_llm(self.client, query, num_queries=3) + [query]
+        return [query]
+
+    @staticmethod
+    def recommendation_context(retrieval_context, reference_doc=None, num_results=1,
+                               context_tokens=DEFAULT_CONTEXT_TOKENS):
+        """Prompt context and reference wine, together within ``context_tokens`` tokens (a quarter at most
+        for the reference)."""
+        documents = [doc for strategy_results in retrieval_context.values() for doc in strategy_results]
+        if reference_doc is not None:
+            reference_doc = condensed_reference(reference_doc, context_tokens // 4)
+            context_tokens -= count_tokens(reference_doc.page_content)
+        return build_recommendation_context(documents, num_results, context_tokens), reference_doc
 
     def get_final_recommendation(self, retrieval_context, query, reference_doc=None, reference_wine_present=False,
-                                 num_results=1) -> str:
-        retrieval_context = "\n\n".join(
-            [doc.page_content for strategy_results in retrieval_context.values() for doc in strategy_results]
-        )
+                                 num_results=1, context_tokens=DEFAULT_CONTEXT_TOKENS) -> str:
+        retrieval_context, reference_doc = self.recommendation_context(retrieval_context, reference_doc, num_results,
+                                                                       context_tokens)
 
         recommendation = get_recommendation(self.client, retrieval_context, query, reference_doc,
                                             reference_wine_present, num_results)
         return recommendation
 
-    def recommend(self, query, num_results):
+    def understand_query(self, query, single_call=False, catalog=None):
+        """Matched metadata and the negative-free query, plus a future for the intent and reference wine."""
+        catalog = catalog or self.catalog
+
+        def find_reference(query_intent):
+            similar_wine = None
+            if query_intent['intent'] == 'similar':
+                with timed("reference_lookup"):
+                    similar_wine = get_similar_wine(catalog.title_index, catalog.store, query_intent['reference'])
+            return query_intent, similar_wine
+
+        if single_call:
+            understanding = understand_query(self.client, query)
+            intent_future = run_async(self.executor, find_reference, understanding['intent'])
+            with timed("match_metadata"):
+                matched_metadata = match_metadata_all(understanding['metadata'], catalog.vocabularies)
+            return intent_future, matched_metadata, understanding['rewritten_query']
+
+        # Intent classification (plus the reference lookup it enables) is independent of metadata
+        # extraction, the rewrite and retrieval, so it runs alongside them instead of before them.
+        intent_future = run_async(self.executor, lambda: find_reference(classify_query_intent(self.client, query)))
+
+        extracted_metadata, matched_metadata = self.extracted_and_match_metadata(query, catalog)
+        rewritten_query = rewrite_query_remove_negative_metadata(self.client, query, extracted_metadata['negative'])
+        return intent_future, matched_metadata, rewritten_query
+
+    def resolve_reference(self, intent_future, retrieval_context):
+        """Wait for the intent; for "similar" queries drop the reference wine from the context and return it."""
         def filter_reference_doc(result, reference_doc):
             ref_id = reference_doc.metadata.get("id")
             return [doc for doc in result if doc.metadata.get("id") != ref_id]
 
-        query_intent = classify_query_intent(self.client, query)
+        query_intent, similar_wine = intent_future.result()
+        if query_intent['intent'] != 'similar':
+            return None
+        for strategy, docs in retrieval_context.items():
+            retrieval_context[strategy] = filter_reference_doc(docs, similar_wine)
+        return similar_wine
 
-        extracted_metadata, matched_metadata = self.extracted_and_match_metadata(query)
-        rewritten_query = rewrite_query_remove_negative_metadata(self.client, query, extracted_metadata['negative'])
-        retrieval_context = self.retrieve(rewritten_query, matched_metadata)
-        if query_intent['intent'] == 'normal':
-            recommendation = self.get_final_recommendation(retrieval_context, query, num_results=num_results)
-            return recommendation
-        if query_intent['intent'] == 'similar':
-            similar_wine = get_similar_wine(self.df, query_intent['reference'])
-            retrieval_context[self.retrieval_strategy] = filter_reference_doc(
-                retrieval_context[self.retrieval_strategy], similar_wine)
-            recommendation = self.get_final_recommendation(retrieval_context, query, reference_doc=similar_wine,
-                                                           reference_wine_present=True, num_results=num_results)
-            return recommendation
+    def recommend(self, query, config=None):
+        config = config or self.default_config
+        catalog = self.catalog
+        with timed("understanding"):
+            intent_future, matched_metadata, rewritten_query = self.understand_query(query,
+                                                                                     single_call=config.single_call,
+                                                                                     catalog=catalog)
+        with timed("retrieval"):
+            retrieval_context = self.retrieve(rewritten_query, matched_metadata, config, catalog=catalog)
+        with timed("reference"):
+            similar_wine = self.resolve_reference(intent_future, retrieval_context)
+        with timed("generation"):
+            return self.get_final_recommendation(retrieval_context, query, reference_doc=similar_wine,
+                                                 reference_wine_present=similar_wine is not None,
+                                                 num_results=config.num_results,
+                                                 context_tokens=config.context_tokens)
+
+    def recommend_stream(self, query, config=None):
+        """Yields ``(event, data)`` pairs: pipeline stages as they start, the retrieved wines, then the tokens."""
+        config = config or self.default_config
+        catalog = self.catalog
+        yield "stage", {"stage": "understanding"}
+        with timed("understanding"):
+            intent_future, matched_metadata, rewritten_query = self.understand_query(query,
+                                                                                     single_call=config.single_call,
+                                                                                     catalog=catalog)
+
+        yield "stage", {"stage": "retrieval"}
+        with timed("retrieval"):
+            retrieval_context = self.retrieve(rewritten_query, matched_metadata, config, catalog=catalog)
+        with timed("reference"):
+            similar_wine = self.resolve_reference(intent_future, retrieval_context)
+        yield "retrieval", {
+            "strategy": config.strategy,
+            "documents": [doc.metadata for docs in retrieval_context.values() for doc in docs],
+            "reference": similar_wine.metadata if similar_wine is not None else None
+        }
+
+        yield "stage", {"stage": "generation"}
+        parts = []
+        with timed("generation"):
+            start = time.perf_counter()
+            context, reference_doc = self.recommendation_context(retrieval_context, similar_wine,
+                                                                 config.num_results, config.context_tokens)
+            for token in stream_recommendation(self.client, context, query, reference_doc=reference_doc,
+                                               reference_wine_present=similar_wine is not None,
+                                               num_results=config.num_results):
+                if not parts:
+                    observe_stage("generation_first_token", start)
+                parts.append(token)
+                yield "token", {"text": token}
+        yield "done", {"recommendation": "".join(parts)}
+
+    def _prepare_batch_item(self, query, config, catalog):
+        intent_future, matched_metadata, rewritten_query = self.understand_query(query,
+                                                                                 single_call=config.single_call,
+                                                                                 catalog=catalog)
+        # Prefiltered searches depend on each query's constraints, so they can't share the batch search.
+        expanded = None if config.prefilter else self.expand_query(rewritten_query, config)
+        return intent_future, matched_metadata, rewritten_query, expanded
+
+    def _finish_batch_item(self, query, config, catalog, prepared, batch):
+        intent_future, matched_metadata, rewritten_query, expanded = prepared
+        retrieval_context = self.retrieve(rewritten_query, matched_metadata, config, catalog=catalog,
+                                          expanded=expanded, batch=batch)
+        similar_wine = self.resolve_reference(intent_future, retrieval_context)
+        return self.get_final_recommendation(retrieval_context, query, reference_doc=similar_wine,
+                                             reference_wine_present=similar_wine is not None,
+                                             num_results=config.num_results, context_tokens=config.context_tokens)
+
+    def recommend_batch(self, items, max_concurrency=8, chunk_size=64):
+        """Recommend for many ``(query, config)`` pairs; yields ``(index, recommendation, error)`` as they complete.
+
+        Items go through in chunks of ``chunk_size``. Within a chunk the LLM steps (query
+        understanding and expansion, then generation) run on at most ``max_concurrency``
+        threads, while all search texts of an embedding model are embedded in one batched
+        call and searched as one matrix (``BatchSearch``). Generation of one chunk overlaps
+        the understanding of the next. A failing item yields its error; the others go on.
+        """
+        catalog = self.catalog
+        items = list(items)
+        with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="rag-batch") as pool:
+            def submit(fn, *args):
+                return pool.submit(contextvars.copy_context().run, fn, *args)
+
+            def completed(futures, block):
+                done, _ = wait(futures, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = futures.pop(future)
+                    error = future.exception()
+                    yield index, None if error else future.result(), error
+
+            generating = {}
+            for start in range(0, len(items), chunk_size):
+                chunk = range(start, min(start + chunk_size, len(items)))
+                preparing = {submit(self._prepare_batch_item, items[i][0], items[i][1], catalog): i for i in chunk}
+                prepared = {}
+                while preparing:
+                    for index, result, error in completed(preparing, block=True):
+                        if error:
+                            yield index, None, error
+                        else:
+                            prepared[index] = result
+                    yield from completed(generating, block=False)
+
+                with timed("batch_search"):
+                    searches = {}
+                    for emb_model in {items[i][1].emb_model for i in prepared}:
+                        texts = [text for i, result in prepared.items() if items[i][1].emb_model == emb_model
+                                 for text in result[3] or []]
+                        k = max([BATCH_SEARCH_K] + [items[i][1].k + 2 for i in prepared])
+                        try:
+                            searches[emb_model] = BatchSearch(self.vectorstore(emb_model, catalog), texts, k)
+                        except BATCH_SEARCH_ERRORS as e:
+                            logger.warning("Batch search with %s failed, searching %d queries one by one",
+                                           emb_model, len(texts), exc_info=True)
+                            batch_search_failures.inc(emb_model=emb_model, error=type(e).__name__)
+                            searches[emb_model] = None
+
+                for index, result in prepared.items():
+                    query, config = items[index]
+                    future = submit(self._finish_batch_item, query, config, catalog, result, searches[config.emb_model])
+                    generating[future] = index
+
+            while generating:
+                yield from completed(generating, block=True)
@@ -1,110 +1,140 @@
-from rag_methods.metadata_matching import metadata_matches
+import numpy as np
+
 from rag_methods.llm_calls import generate_hypothetical_document, generate_queries_llm
-from rank_bm25 import BM25Okapi
+from rag_methods.concurrency import run_async
+from monitoring.metrics import timed
+from vectorstore.search import catalog_positions, hydrate_documents, multi_query_search, prefiltered_similarity_search
 
 
 def metadata_filtering(candidates, constraints, k=15):
-    results = []
-    seen_ids = set()
-
-    relaxation_groups = [
-        ["min_price", "max_price"],
-        ["points"],
-        ["min_vintage", "max_vintage"],
-        ["country"],
-        ["province"]
-    ]
-
-    current_constraints = constraints.copy()
-    group_index = 0
-
-    while group_index <= len(relaxation_groups) and len(results) < k:
-        for doc in candidates:
-            doc_id = doc.metadata.get("id")
-            if doc_id in seen_ids:
-                continue
-            if metadata_matches(doc.metadata, current_constraints):
-                results.append(doc)
-                seen_ids.add(doc_id)
-        if len(results) >= k:
-            break
-        if group_index < len(relaxation_groups):
-            for key in relaxation_groups[group_index]:
-                current_constraints[key] = "-"
-        group_index += 1
-
-    if len(results) < k:
-        desired_color = constraints.get("wine_color", "-").strip().lower()
+    with timed("metadata_filtering"):
+        unique_candidates = []
+        seen_ids = set()
         for doc in candidates:
             doc_id = doc.metadata.get("id")
             if doc_id not in seen_ids:
-                doc_color = doc.metadata.get("wine_color", "").strip().lower()
-                if desired_color != "-" and doc_color != desired_color:
-                    continue
-                results.append(doc)
+                unique_candidates.append(doc)
                 seen_ids.add(doc_id)
-            if len(results) >= k:
-                break
-
-    return results[:k]
 
+        rows = constraints.columns.rows_for(unique_candidates)
+        return [unique_candidates[i] for i in constraints.select(rows, k=k)]
 
-def hyde_retrieval(query, client, vectorstore, metadata, k=15, dense_k=50):
-    hypo_doc = generate_hypothetical_document(client, query)
-    candidates = vectorstore.similarity_search(hypo_doc, k=dense_k)
-    retrieved_docs = metadata_filtering(candidates, metadata, k=k)
-    return retrieved_docs
 
+def similarity_search(vectorstore, query, k, embedding=None):
+    # ``vectorstore.similarity_search`` split in two, so embedding and search are timed separately.
+    if embedding is None:
+        with timed("embedding"):
+            embedding = vectorstore.embedding_function.embed_query(query)
+    with timed("faiss_search"):
+        return vectorstore.similarity_search_by_vector(embedding, k=k)
 
-def reciprocal_rank_fusion(vectorstore, queries, metadata_constraints, top_k=10, dense_k=10, rrf_k=10):
-    fusion_scores = {}
-    query_results = {}
-    candidate_docs = {}
 
-    for query in queries:
-        results = vectorstore.similarity_search(query, k=dense_k)
-        query_results[query] = results
-        for rank, doc in enumerate(results):
-            score = 1.0 / (rank + rrf_k)
-            doc_id = doc.metadata.get("id")
-            fusion_scores[doc_id] = fusion_scores.get(doc_id, 0) + score
-            candidate_docs[doc_id] = doc
+def dense_search(query, vectorstore, metadata, k, prefilter=False, embedding=None, batch=None):
+    if prefilter:
+        return prefiltered_similarity_search(vectorstore, query, metadata, k=k, embedding=embedding)
+    if batch is not None and batch.has(query, k):
+        return batch.documents(query, k)
+    return similarity_search(vectorstore, query, k, embedding=embedding)
 
-    filtered = metadata_filtering(
-        list(candidate_docs.values()),
-        metadata_constraints,
-        k=top_k
-    )
 
-    fused_docs = sorted(
-        filtered,
-        key=lambda d: fusion_scores.get(d.metadata.get("id"), 0.0),
-        reverse=True
-    )
-    return fused_docs[:top_k], query_results, fusion_scores
+def hyde_retrieval(query, client, vectorstore, metadata, k=15, dense_k=50, prefilter=False, hypo_doc=None,
+                   batch=None):
+    if hypo_doc is None:
+        hypo_doc = generate_hypothetical_document(client, query)
+    candidates = dense_search(hypo_doc, vectorstore, metadata, dense_k, prefilter=prefilter, batch=batch)
+    retrieved_docs = metadata_filtering(candidates, metadata, k=k)
+    return retrieved_docs
 
 
-def fusion_retrieval(query, client, vectorstore, metadata, top_k=15, dense_k=15, rrf_k=10, num_queries=3):
-    fusion_queries = generate_queries_llm(client, query, num_queries=num_queries)
+def rrf_scores(positions, rrf_k=10):
+    """Reciprocal rank fusion over a (queries x ranks) matrix of index positions, -1 padded.
+
+    Returns the distinct positions in order of first appearance (row by row) and their
+    summed ``1 / (rank + rrf_k)`` scores, both as arrays.
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    ranks = np.broadcast_to(np.arange(positions.shape[1]), positions.shape)
+    valid = positions >= 0
+    flat_positions = positions[valid]
+    if flat_positions.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    candidates, first_seen, inverse = np.unique(flat_positions, return_index=True, return_inverse=True)
+    scores = np.bincount(inverse, weights=1.0 / (ranks[valid] + rrf_k), minlength=len(candidates))
+    order = np.argsort(first_seen, kind="stable")
+    return candidates[order], scores[order]
+
+
+def reciprocal_rank_fusion(vectorstore, queries, metadata_constraints, top_k=10, dense_k=10, rrf_k=10,
+                           prefilter=False, precomputed_results=None):
+    """Fuse the dense results of ``queries`` and keep the ``top_k`` that pass ``metadata_constraints``.
+
+    All pending queries are embedded together and searched as one matrix;
+    ``precomputed_results`` maps a query to positions that were already retrieved.
+    Only the final ``top_k`` positions are turned into documents. Returns the documents,
+    the per-query positions matrix and the fusion scores of the returned documents.
+    """
+    precomputed_results = precomputed_results or {}
+    pending = [query for query in queries if query not in precomputed_results]
+    pending_positions = {}
+    if pending:
+        constraints = metadata_constraints if prefilter else None
+        searched = multi_query_search(vectorstore, pending, dense_k, constraints=constraints)
+        pending_positions = dict(zip(pending, searched))
+
+    positions = np.full((len(queries), dense_k), -1, dtype=np.int64)
+    for i, query in enumerate(queries):
+        results = precomputed_results.get(query)
+        if results is None:
+            results = pending_positions[query]
+        results = np.asarray(results, dtype=np.int64)[:dense_k]
+        positions[i, :len(results)] = results
+
+    candidates, scores = rrf_scores(positions, rrf_k=rrf_k)
+    with timed("metadata_filtering"):
+        pos_to_row, _ = catalog_positions(vectorstore, metadata_constraints.columns)
+        selected = metadata_constraints.select(pos_to_row[candidates], k=top_k)
+        selected = selected[np.argsort(-scores[selected], kind="stable")][:top_k]
+
+    fused_docs = hydrate_documents(vectorstore, candidates[selected])
+    return fused_docs, positions, scores[selected]
+
+
+def fusion_retrieval(query, client, vectorstore, metadata, top_k=15, dense_k=15, rrf_k=10, num_queries=3,
+                     prefilter=False, executor=None, fusion_queries=None, batch=None):
+    """``fusion_queries`` (generated beforehand) and ``batch`` (their searches) skip the LLM call and the search."""
+    if fusion_queries is not None and batch is not None and not prefilter:
+        queries = list(fusion_queries) + [query]
+        precomputed = {q: batch.positions(q, dense_k) for q in queries if batch.has(q, dense_k)}
+        fusion_results, _, _ = reciprocal_rank_fusion(vectorstore, queries, metadata, top_k=top_k, dense_k=dense_k,
+                                                      rrf_k=rrf_k, precomputed_results=precomputed)
+        return fusion_results
+
+    # The original query does not depend on the generated variations, so search it while the LLM is working.
+    queries_future = run_async(executor, generate_queries_llm, client, query, num_queries=num_queries)
+    original_positions = multi_query_search(vectorstore, [query], dense_k,
+                                            constraints=metadata if prefilter else None)[0]
+
+    fusion_queries = queries_future.result()
     fusion_queries.append(query)
-    fusion_results, query_results, fusion_scores = reciprocal_rank_fusion(vectorstore, fusion_queries, metadata,
-                                                                          top_k=top_k, dense_k=dense_k, rrf_k=rrf_k)
+    fusion_results, _, _ = reciprocal_rank_fusion(vectorstore, fusion_queries, metadata, top_k=top_k,
+                                                  dense_k=dense_k, rrf_k=rrf_k, prefilter=prefilter,
+                                                  precomputed_results={query: original_positions})
     return fusion_results
 
 
-def bm25_retrieval(query, documents, k=15):
-    tokenized_docs = [doc.page_content.lower().split() for doc in documents]
-    bm25 = BM25Okapi(tokenized_docs)
-    tokenized_query = query.lower().split()
-    scores = bm25.get_scores(tokenized_query)
-    ranked_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
-    return [documents[i] for i in ranked_indices[:k]]
-
+def bm25_retrieval(query, bm25_index, documents, k=15, mask=None):
+    with timed("bm25_search"):
+        ranked_indices, _ = bm25_index.top_k(query, k=k, mask=mask)
+    return [documents[i] for i in ranked_indices]
 
-def hybrid_fusion_retrieval(query, vectorstore, documents, bm25_weight=0.5, semantic_weight=0.5, k=50, dense_k=70):
-    dense_results = vectorstore.similarity_search(query, k=dense_k)
 
-    bm25_results = bm25_retrieval(query, documents, k=dense_k)
+def hybrid_fusion_retrieval(query, vectorstore, bm25_index, documents, bm25_weight=0.5, semantic_weight=0.5, k=50,
+                            dense_k=70, metadata=None, prefilter=False, executor=None, batch=None):
+    bm25_mask = metadata.allowed_mask(dense_k) if prefilter else None
+    bm25_future = run_async(executor, bm25_retrieval, query, bm25_index, documents, k=dense_k, mask=bm25_mask)
+    dense_results = dense_search(query, vectorstore, metadata, dense_k, prefilter=prefilter, batch=batch)
+    bm25_results = bm25_future.result()
     fusion_scores = {}
     candidate_docs = {}
 
@@ -124,12 +154,18 @@ def hybrid_fusion_retrieval(query, vectorstore, documents, bm25_weight=0.5, sema
     return [candidate_docs[doc_id] for doc_id in ranked_doc_ids[:k]]
 
 
-def hybrid_retrieval(query, vectorstore, documents, metadata, bm25_weight=0.5, semantic_weight=0.5, k=15, dense_k=50):
-    ranked_documents = hybrid_fusion_retrieval(query, vectorstore, documents, k=dense_k, dense_k=dense_k + 25,
-                                               bm25_weight=bm25_weight, semantic_weight=semantic_weight)
+def hybrid_retrieval(query, vectorstore, bm25_index, documents, metadata, bm25_weight=0.5, semantic_weight=0.5, k=15,
+                     dense_k=50, prefilter=False, executor=None, batch=None):
+    ranked_documents = hybrid_fusion_retrieval(query, vectorstore, bm25_index, documents, k=dense_k,
+                                               dense_k=dense_k + 25,
+                                               bm25_weight=bm25_weight, semantic_weight=semantic_weight,
+                                               metadata=metadata, prefilter=prefilter, executor=executor,
+                                               batch=batch)
     filtered_documents = metadata_filtering(ranked_documents, metadata, k=k)
     return filtered_documents
 
 
-def naive_retrieval(query, vectorstore, k=15):
-    return vectorstore.similarity_search(query, k=k)
+def naive_retrieval(query, vectorstore, k=15, batch=None):
+    if batch is not None and batch.has(query, k):
+        return batch.documents(query, k)
+    return similarity_search(vectorstore, query, k)
@@ -0,0 +1,206 @@
+import argparse
+import math
+import os
+import time
+
+import faiss
+import numpy as np
+
+from vectorstore.index_versions import staged_version
+
+INDEX_TYPES = ["flat", "ivf", "hnsw", "ivfpq"]
+
+DEFAULT_PARAMS = {
+    "nlist": None,
+    "nprobe": 16,
+    "hnsw_m": 32,
+    "ef_construction": 200,
+    "ef_search": 128,
+    "pq_m": None,
+    "pq_nbits": 8,
+}
+
+
+def index_file(index_type):
+    return "index.faiss" if index_type == "flat" else f"index_{index_type}.faiss"
+
+
+def default_nlist(num_vectors):
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39 or 1))
+
+
+def default_pq_m(dim):
+    """Largest sub-quantizer count <= 64 that divides ``dim`` (PQ needs ``dim % m == 0``)."""
+    return next(m for m in range(min(64, dim), 0, -1) if dim % m == 0)
+
+
+def factory_string(index_type, dim, num_vectors, params):
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "hnsw":
+        return f"HNSW{params['hnsw_m']}"
+    nlist = params["nlist"] or default_nlist(num_vectors)
+    if index_type == "ivf":
+        return f"IVF{nlist},Flat"
+    if index_type == "ivfpq":
+        return f"IVF{nlist},PQ{params['pq_m'] or default_pq_m(dim)}x{params['pq_nbits']}"
+    raise ValueError(f"Unknown index type '{index_type}'. Valid options: {', '.join(INDEX_TYPES)}")
+
+
+def configure_search(index, nprobe=None, ef_search=None):
+    """Apply query-time parameters and make IVF indexes reconstructable (used by prefiltered search)."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        if nprobe is not None:
+            ivf.nprobe = nprobe
+        ivf.make_direct_map()
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None and ef_search is not None:
+        hnsw.efSearch = ef_search
+    return index
+
+
+def build_index(vectors, index_type="flat", metric=faiss.METRIC_L2, **params):
+    """A FAISS index of ``index_type`` over ``vectors``, rows added in order so positions stay the same."""
+    params = {**DEFAULT_PARAMS, **{key: value for key, value in params.items() if value is not None}}
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    num_vectors, dim = vectors.shape
+
+    index = faiss.index_factory(dim, factory_string(index_type, dim, num_vectors, params), metric)
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        hnsw.efConstruction = params["ef_construction"]
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return configure_search(index, nprobe=params["nprobe"], ef_search=params["ef_search"])
+
+
+def refill_index(index, vectors):
+    """Replace every vector of a built index, keeping its IVF/PQ training (HNSW graphs are rebuilt on add)."""
+    index.reset()
+    index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+    return configure_search(index)
+
+
+def index_vectors(index):
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def save_index(index, path, index_type):
+    target = os.path.join(path, index_file(index_type))
+    faiss.write_index(index, target + ".tmp")
+    os.replace(target + ".tmp", target)
+    return target
+
+
+def load_index(path, index_type, nprobe=None, ef_search=None):
+    target = os.path.join(path, index_file(index_type))
+    if not os.path.exists(target):
+        raise FileNotFoundError(f"No {index_type} index at {target}; build it with "
+                                f"'PYTHONPATH=app python app/vectorstore/ann_index.py build'")
+    return configure_search(faiss.read_index(target), nprobe=nprobe, ef_search=ef_search)
+
+
+def use_index_type(vectorstore, path, index_type, nprobe=None, ef_search=None):
+    """Swap the exhaustive index of a loaded store for a prebuilt ANN variant over the same positions."""
+    if index_type == "flat":
+        return vectorstore
+    index = load_index(path, index_type, nprobe=nprobe, ef_search=ef_search)
+    if index.ntotal != vectorstore.index.ntotal:
+        raise ValueError(f"{index_type} index has {index.ntotal} vectors, the store has {vectorstore.index.ntotal}; "
+                         f"rebuild it")
+    vectorstore.index = index
+    return vectorstore
+
+
+def benchmark(flat_index, variants, queries, k=10):
+    """Recall@k against the exhaustive index and single-query / batch latency for each variant."""
+    _, truth = flat_index.search(queries, k)
+    results = []
+    for name, index in variants.items():
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query[None, :], k)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        _, found = index.search(queries, k)
+        batch_seconds = time.perf_counter() - start
+
+        recall = np.mean([len(np.intersect1d(t, f[f >= 0])) / k for t, f in zip(truth, found)])
+        latencies = np.asarray(latencies) * 1000
+        results.append({
+            "index": name,
+            "recall@k": round(float(recall), 4),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+            "batch_qps": round(len(queries) / batch_seconds, 1),
+            "bytes": len(faiss.serialize_index(index)),
+        })
+    return results
+
+
+def print_table(results, k):
+    header = ["index", "recall@k", "p50_ms", "p95_ms", "batch_qps", "bytes"]
+    print(f"k={k}")
+    print("  ".join(f"{col:>12}" for col in header))
+    for row in results:
+        print("  ".join(f"{row[col]:>12}" for col in header))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build approximate FAISS indexes and benchmark them against flat.")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--emb-model", default="openai")
+    parser.add_argument("--index-types", nargs="+", default=["ivf", "hnsw", "ivfpq"], choices=INDEX_TYPES)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--num-queries", type=int, default=500)
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="benchmark on N random vectors instead of a saved index")
+    parser.add_argument("--dim", type=int, default=3072, help="dimension of the synthetic vectors")
+    parser.add_argument("--nlist", type=int)
+    parser.add_argument("--nprobe", type=int)
+    parser.add_argument("--hnsw-m", type=int)
+    parser.add_argument("--ef-construction", type=int)
+    parser.add_argument("--ef-search", type=int)
+    parser.add_argument("--pq-m", type=int)
+    parser.add_argument("--pq-nbits", type=int)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    params = {key: getattr(args, key) for key in DEFAULT_PARAMS}
+
+    if args.synthetic:
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((args.synthetic, args.dim)).astype(np.float32)
+        metric, path = faiss.METRIC_L2, None
+    else:
+        from vectorstore.load_vectorstore import VECTORSTORE_CONFIG
+
+        path = VECTORSTORE_CONFIG[args.emb_model]["default_path"]
+        flat = load_index(path, "flat")
+        vectors, metric = index_vectors(flat), flat.metric_type
+
+    flat = build_index(vectors, "flat", metric)
+    built = {}
+    for index_type in args.index_types:
+        start = time.perf_counter()
+        built[index_type] = build_index(vectors, index_type, metric, **params)
+        print(f"built {index_type} in {time.perf_counter() - start:.1f}s")
+
+    if args.command == "build" and path is not None:
+        with staged_version(path, copy_current=True) as version:
+            for index_type, index in built.items():
+                if index_type != "flat":
+                    print(f"wrote {save_index(index, version, index_type)}")
+
+    if args.command == "benchmark":
+        rng = np.random.default_rng(1)
+        sample = rng.choice(len(vectors), size=min(args.num_queries, len(vectors)), replace=False)
+        noise = rng.standard_normal((len(sample), vectors.shape[1])).astype(np.float32) * 0.1 * vectors.std()
+        queries = vectors[sample] + noise
+        print_table(benchmark(flat, {"flat": flat, **built}, queries, k=args.k), args.k)
@@ -0,0 +1,218 @@
+import os
+import tempfile
+from collections import Counter
+
+import numpy as np
+
+from vectorstore.file_lock import file_lock
+
+BM25_INDEX_PATH = "app/vectorstore/bm25_index.npz"
+
+
+def tokenize(text):
+    return text.lower().split()
+
+
+def tokenize_postings(texts, vocab):
+    """``(term ids, document positions, term frequencies, document lengths)`` of ``texts``; terms missing
+    from ``vocab`` are added to it."""
+    term_ids, doc_positions, freqs = [], [], []
+    doc_len = np.zeros(len(texts), dtype=np.float64)
+    for doc_pos, text in enumerate(texts):
+        counts = Counter(tokenize(text))
+        doc_len[doc_pos] = sum(counts.values())
+        for term, tf in counts.items():
+            term_ids.append(vocab.setdefault(term, len(vocab)))
+            doc_positions.append(doc_pos)
+            freqs.append(tf)
+    return (np.asarray(term_ids, dtype=np.int64), np.asarray(doc_positions, dtype=np.int64),
+            np.asarray(freqs, dtype=np.int32), doc_len)
+
+
+class BM25Index:
+    """Okapi BM25 over a sparse inverted index (same scoring as rank_bm25.BM25Okapi).
+
+    Postings are stored in CSR layout: for term ``t`` the documents containing it are
+    ``doc_idx[indptr[t]:indptr[t + 1]]`` and ``weights`` holds the precomputed
+    length-normalised term-frequency part of the BM25 formula, so scoring a query is
+    a handful of vectorized scatter-adds. The raw term frequencies and document lengths
+    are kept too, so ``updated`` can re-weight the postings without tokenizing again.
+    """
+
+    def __init__(self, vocab, indptr, doc_idx, weights, idf, doc_ids, k1=1.5, b=0.75, fingerprint=None, freqs=None,
+                 doc_len=None):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_idx = doc_idx
+        self.weights = weights
+        self.idf = idf
+        self.doc_ids = doc_ids
+        self.k1 = k1
+        self.b = b
+        self.fingerprint = fingerprint
+        self.freqs = freqs
+        self.doc_len = doc_len
+
+    @property
+    def num_docs(self):
+        return len(self.doc_ids)
+
+    @classmethod
+    def build(cls, texts, doc_ids, k1=1.5, b=0.75, epsilon=0.25, fingerprint=None):
+        vocab = {}
+        term_ids, doc_positions, freqs, doc_len = tokenize_postings(texts, vocab)
+        return cls.from_postings(vocab, term_ids, doc_positions, freqs, doc_len, doc_ids, k1=k1, b=b,
+                                 epsilon=epsilon, fingerprint=fingerprint)
+
+    @classmethod
+    def from_postings(cls, vocab, term_ids, doc_positions, freqs, doc_len, doc_ids, k1=1.5, b=0.75, epsilon=0.25,
+                      fingerprint=None):
+        """Index over unordered postings; terms of ``vocab`` without any are dropped, as rank_bm25 never sees them."""
+        doc_freq = np.bincount(term_ids, minlength=len(vocab))
+        if not doc_freq.all():
+            present = doc_freq > 0
+            renumbered = np.cumsum(present) - 1
+            vocab = {term: int(renumbered[term_id]) for term, term_id in vocab.items() if present[term_id]}
+            term_ids, doc_freq = renumbered[term_ids], doc_freq[present]
+
+        order = np.lexsort((doc_positions, term_ids))
+        doc_positions, freqs = doc_positions[order].astype(np.int32), freqs[order]
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(doc_freq, out=indptr[1:])
+
+        num_docs = len(doc_len)
+        idf = np.log(num_docs - doc_freq + 0.5) - np.log(doc_freq + 0.5)
+        if len(idf):
+            idf[idf < 0] = epsilon * idf.mean()
+
+        avgdl = doc_len.sum() / num_docs if num_docs else 0.0
+        norm = k1 * (1 - b + b * doc_len[doc_positions] / avgdl) if avgdl else k1
+        weights = (freqs * (k1 + 1) / (freqs + norm)).astype(np.float32)
+
+        return cls(vocab, indptr, doc_positions, weights, idf, np.asarray([str(doc_id) for doc_id in doc_ids]),
+                   k1=k1, b=b, fingerprint=fingerprint, freqs=freqs, doc_len=doc_len)
+
+    def updated(self, reuse_rows, texts, doc_ids, epsilon=0.25, fingerprint=None):
+        """Index over a new catalog: row ``i`` has the text of row ``reuse_rows[i]`` of this index, or when that
+        is ``-1`` the next of ``texts``.
+
+        Postings of reused rows are carried over and only ``texts`` are tokenized; the
+        weights are recomputed for the new document count and lengths, so scores are the
+        same as those of ``build`` over the whole catalog.
+        """
+        reuse_rows = np.asarray(reuse_rows, dtype=np.int64)
+        reused = np.flatnonzero(reuse_rows >= 0)
+        fresh = np.flatnonzero(reuse_rows < 0)
+        old_to_new = np.full(self.num_docs, -1, dtype=np.int64)
+        old_to_new[reuse_rows[reused]] = reused
+
+        term_ids = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        doc_positions = old_to_new[self.doc_idx]
+        kept = doc_positions >= 0
+
+        vocab = dict(self.vocab)
+        fresh_terms, fresh_positions, fresh_freqs, fresh_len = tokenize_postings(texts, vocab)
+        doc_len = np.zeros(len(reuse_rows), dtype=np.float64)
+        doc_len[reused] = self.doc_len[reuse_rows[reused]]
+        doc_len[fresh] = fresh_len
+
+        return BM25Index.from_postings(vocab, np.concatenate([term_ids[kept], fresh_terms]),
+                                       np.concatenate([doc_positions[kept], fresh[fresh_positions]]),
+                                       np.concatenate([self.freqs[kept], fresh_freqs]), doc_len, doc_ids,
+                                       k1=self.k1, b=self.b, epsilon=epsilon, fingerprint=fingerprint)
+
+    @classmethod
+    def from_documents(cls, documents, **kwargs):
+        return cls.build([doc.page_content for doc in documents],
+                         [doc.metadata.get("id") for doc in documents], **kwargs)
+
+    def get_scores(self, query):
+        scores = np.zeros(self.num_docs, dtype=np.float64)
+        for term in tokenize(query):
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            scores[self.doc_idx[start:end]] += self.idf[term_id] * self.weights[start:end]
+        return scores
+
+    def top_k(self, query, k=15, mask=None):
+        scores = self.get_scores(query)
+        if mask is not None:
+            scores[~mask] = -np.inf
+            k = min(k, int(mask.sum()))
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        if k < len(scores):
+            # Every document tied with the k-th score is a candidate, so ties go to the lower position
+            # (the order rank_bm25's scores were sorted in) whichever of them argpartition picked.
+            kth_score = scores[np.argpartition(-scores, k - 1)[k - 1]]
+            candidates = np.flatnonzero(scores >= kth_score)
+        else:
+            candidates = np.arange(len(scores))
+        candidates = candidates[np.lexsort((candidates, -scores[candidates]))][:k]
+        return candidates, scores[candidates]
+
+    def matches(self, doc_ids):
+        return len(doc_ids) == self.num_docs and all(
+            str(doc_id) == indexed_id for doc_id, indexed_id in zip(doc_ids, self.doc_ids)
+        )
+
+    def save(self, path=BM25_INDEX_PATH):
+        terms = np.empty(len(self.vocab), dtype=object)
+        for term, term_id in self.vocab.items():
+            terms[term_id] = term
+        frequencies = {"freqs": self.freqs, "doc_len": self.doc_len} if self.freqs is not None else {}
+        # A temporary name of its own, so concurrent writers never write into the same file.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".",
+                                        suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, terms=terms.astype(str), indptr=self.indptr, doc_idx=self.doc_idx, weights=self.weights,
+                         idf=self.idf, doc_ids=self.doc_ids, params=np.array([self.k1, self.b]),
+                         fingerprint=np.array(self.fingerprint or ""), **frequencies)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path=BM25_INDEX_PATH):
+        with np.load(path, allow_pickle=False) as data:
+            vocab = {term: term_id for term_id, term in enumerate(data["terms"].tolist())}
+            k1, b = data["params"].tolist()
+            fingerprint = str(data["fingerprint"]) if "fingerprint" in data.files else ""
+            # Indexes saved before ``updated`` existed have no frequencies; they can only be rebuilt.
+            freqs, doc_len = (data["freqs"], data["doc_len"]) if "freqs" in data.files else (None, None)
+            return cls(vocab, data["indptr"], data["doc_idx"], data["weights"], data["idf"], data["doc_ids"],
+                       k1=k1, b=b, fingerprint=fingerprint or None, freqs=freqs, doc_len=doc_len)
+
+
+def saved_bm25_index(store, fingerprint, path=BM25_INDEX_PATH):
+    """The index saved at ``path`` if it was built from the catalog of ``store``, else ``None``."""
+    if not os.path.exists(path):
+        return None
+    bm25_index = BM25Index.load(path)
+    if bm25_index.fingerprint == fingerprint and bm25_index.matches(store.ids):
+        return bm25_index
+    return None
+
+
+def load_or_build_bm25_index(store, fingerprint, path=BM25_INDEX_PATH):
+    """BM25 over the rows of a ``DocumentStore``, reusing the saved index when it was built from the same catalog.
+
+    ``fingerprint`` is the catalog's ``frame_fingerprint``; matching ids alone are not
+    enough, since an edited wine keeps its id. Building holds a lock next to ``path``, so
+    workers starting together build it once.
+    """
+    bm25_index = saved_bm25_index(store, fingerprint, path)
+    if bm25_index is not None:
+        return bm25_index
+
+    with file_lock(path + ".lock"):
+        bm25_index = saved_bm25_index(store, fingerprint, path)
+        if bm25_index is None:
+            bm25_index = BM25Index.build(list(store.texts()), store.ids, fingerprint=fingerprint)
+            bm25_index.save(path)
+    return bm25_index
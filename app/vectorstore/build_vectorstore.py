@@ -0,0 +1,177 @@
+import argparse
+import glob
+import json
+import os
+import pickle
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+
+import faiss
+import numpy as np
+import pandas as pd
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+
+from vectorstore.ann_index import INDEX_TYPES, build_index, index_file, load_index, refill_index, save_index
+from vectorstore.create_vectorstore import build_document_fields, frame_fingerprint
+from vectorstore.index_versions import staged_version
+from vectorstore.load_vectorstore import VECTORSTORE_CONFIG
+from vectorstore.mmap_store import write_mmap_documents
+
+DEFAULT_CSV_PATH = "data_processing/wine_data_final.csv"
+LOCAL_MODELS = ["mpnet", "roberta"]
+MANIFEST_FILE = "manifest.json"
+
+_worker_embeddings = None
+
+
+def checkpoint_dir(index_path):
+    return index_path.rstrip("/") + ".build"
+
+
+def shard_path(checkpoint, batch_id):
+    return os.path.join(checkpoint, f"shard_{batch_id:06d}.npy")
+
+
+def write_atomic(path, write):
+    with open(path + ".tmp", "wb") as f:
+        write(f)
+    os.replace(path + ".tmp", path)
+
+
+def _init_worker(emb_model, threads):
+    # Set before the model (and torch) is imported in this process, so the pool doesn't oversubscribe the CPU.
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    global _worker_embeddings
+    _worker_embeddings = VECTORSTORE_CONFIG[emb_model]["fn"]()
+
+
+def _embed_batch(batch_id, texts):
+    return batch_id, np.asarray(_worker_embeddings.embed_documents(texts), dtype=np.float32)
+
+
+def open_checkpoint(checkpoint, manifest, resume=True):
+    """Batch ids already embedded under ``checkpoint``; starts over if it belongs to another build."""
+    manifest_path = os.path.join(checkpoint, MANIFEST_FILE)
+    if resume and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) == manifest:
+                return {int(os.path.basename(path)[6:12]) for path in glob.glob(os.path.join(checkpoint, "shard_*.npy"))}
+        print(f"checkpoint at {checkpoint} is for a different catalog or model; starting over")
+
+    shutil.rmtree(checkpoint, ignore_errors=True)
+    os.makedirs(checkpoint)
+    write_atomic(manifest_path, lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+    return set()
+
+
+def embed_batches(emb_model, batches, checkpoint, done, workers=1):
+    """Embed every batch not in ``done``, writing each one to its own shard as soon as it finishes.
+
+    Local models run in a pool of ``workers`` processes, each loading the model once; at most
+    two batches per worker are in flight, so documents stream through without queueing them all.
+    """
+    pending = [batch_id for batch_id in range(len(batches)) if batch_id not in done]
+    total, start = len(batches), time.perf_counter()
+
+    def finished(batch_id, vectors):
+        write_atomic(shard_path(checkpoint, batch_id), lambda f: np.save(f, vectors))
+        done.add(batch_id)
+        rate = (len(done) - (total - len(pending))) / (time.perf_counter() - start)
+        print(f"\rembedded {len(done)}/{total} batches ({rate:.2f} batches/s)", end="", flush=True)
+
+    if workers <= 1:
+        _init_worker(emb_model, os.cpu_count() or 1)
+        for batch_id in pending:
+            finished(*_embed_batch(batch_id, batches[batch_id]))
+    else:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(workers, mp_context=get_context("spawn"), initializer=_init_worker,
+                                 initargs=(emb_model, threads)) as pool:
+            queue, in_flight = iter(pending), set()
+            while True:
+                for batch_id in queue:
+                    in_flight.add(pool.submit(_embed_batch, batch_id, batches[batch_id]))
+                    if len(in_flight) >= 2 * workers:
+                        break
+                if not in_flight:
+                    break
+                completed, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    finished(*future.result())
+    print()
+
+
+def load_shards(checkpoint, num_batches):
+    return np.concatenate([np.load(shard_path(checkpoint, batch_id)) for batch_id in range(num_batches)])
+
+
+def write_vectorstore(index_path, vectors, texts, metadatas, ann_types=(), retrain=True):
+    """Write ``index.faiss``/``index.pkl`` (the ``FAISS.save_local`` layout) and the mmap docstore.
+
+    The files go into a new version of ``index_path`` that replaces the current one as a
+    whole (see ``index_versions.py``). Approximate indexes are only carried over through
+    ``ann_types``; with ``retrain=False`` an existing one keeps its trained quantizer and
+    only has its vectors replaced.
+    """
+    current = os.path.realpath(index_path)
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+    ids = [str(pos) for pos in range(len(texts))]
+    documents = [Document(page_content=text, metadata=meta) for text, meta in zip(texts, metadatas)]
+    docstore = InMemoryDocstore(dict(zip(ids, documents)))
+    index_to_docstore_id = dict(enumerate(ids))
+
+    with staged_version(index_path) as version:
+        save_index(index, version, "flat")
+        write_atomic(os.path.join(version, "index.pkl"), lambda f: pickle.dump((docstore, index_to_docstore_id), f))
+
+        write_mmap_documents(documents, version)
+
+        for index_type in ann_types:
+            if not retrain and os.path.exists(os.path.join(current, index_file(index_type))):
+                save_index(refill_index(load_index(current, index_type), vectors), version, index_type)
+            else:
+                save_index(build_index(vectors, index_type, index.metric_type), version, index_type)
+
+
+def build_vectorstore(df, emb_model, batch_size=256, workers=1, resume=True, ann_types=()):
+    index_path = VECTORSTORE_CONFIG[emb_model]["default_path"]
+    checkpoint = checkpoint_dir(index_path)
+    texts, metadatas = build_document_fields(df)
+    batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+
+    manifest = {"emb_model": emb_model, "catalog": frame_fingerprint(df), "num_documents": len(texts),
+                "batch_size": batch_size}
+    done = open_checkpoint(checkpoint, manifest, resume=resume)
+    if done:
+        print(f"resuming: {len(done)}/{len(batches)} batches already embedded")
+    embed_batches(emb_model, batches, checkpoint, done, workers=workers)
+
+    write_vectorstore(index_path, load_shards(checkpoint, len(batches)), texts, metadatas, ann_types=ann_types)
+    shutil.rmtree(checkpoint)
+    print(f"{emb_model}: wrote {len(texts)} documents to {index_path}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Embed the catalog and write a FAISS index, resuming interrupted builds.")
+    parser.add_argument("emb_models", nargs="+", choices=list(VECTORSTORE_CONFIG))
+    parser.add_argument("--csv", default=DEFAULT_CSV_PATH)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, help="embedding processes for local models (default: CPU count)")
+    parser.add_argument("--no-resume", action="store_true", help="discard any checkpoint and embed everything")
+    parser.add_argument("--ann-types", nargs="*", default=[], choices=INDEX_TYPES[1:],
+                        help="also build these approximate indexes")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    df = pd.read_csv(args.csv)
+    for emb_model in args.emb_models:
+        workers = (args.workers or os.cpu_count() or 1) if emb_model in LOCAL_MODELS else 1
+        build_vectorstore(df, emb_model, batch_size=args.batch_size, workers=workers, resume=not args.no_resume,
+                          ann_types=args.ann_types)
@@ -1,72 +1,84 @@
+import hashlib
+
+import numpy as np
 import pandas as pd
 from langchain_community.vectorstores import FAISS
-from langchain.schema import Document
+from langchain_core.documents import Document
 
 
-def create_documents(df):
-    all_review_cols = [col for col in df.columns if col.startswith("review_")]
-    review_cols = all_review_cols[:5]
-
-    def clean_text(text):
-        return str(text).replace("\\n", " ").replace("\n", " ").replace("\r", " ").strip()
-
-    documents = []
-    meta_fields = ["price", "points", "province", "variety", "designation", "country", "region_1", "winery"]
-
-    for idx, row in df.iterrows():
-        sections = []
-
-        if "title" in df.columns and pd.notna(row["title"]):
-            title_clean = clean_text(row["title"])
-            sections.append(f"Title: {title_clean}")
-
-        if "description" in df.columns and pd.notna(row["description"]):
-            desc_clean = clean_text(row["description"])
-            sections.append(f"Description: {desc_clean}")
-
-        meta_parts = []
-        for col in meta_fields:
-            if col in df.columns and pd.notna(row[col]):
-                meta_parts.append(f"{col.capitalize()}: {row[col]}")
-
-        if "vintage" in df.columns and pd.notna(row["vintage"]):
-            meta_parts.append(f"Vintage: {row['vintage']}")
-        if "wine_color" in df.columns and pd.notna(row["wine_color"]):
-            meta_parts.append(f"Wine Color: {row['wine_color']}")
-
-        if meta_parts:
-            metadata_section = ", ".join(meta_parts)
-            sections.append(metadata_section)
-
-        review_texts = []
-        for col in review_cols:
-            if pd.notna(row[col]):
-                review_clean = clean_text(row[col])
-                review_texts.append(review_clean)
-        if review_texts:
-            reviews_section = "Reviews:\n" + "\n".join(review_texts)
-            sections.append(reviews_section)
-
-        meta = {}
-        for col in meta_fields + ["id"]:
-            if col in df.columns:
-                meta[col] = row[col]
-
-        if "vintage" in df.columns:
-            meta["vintage"] = row["vintage"]
-        if "wine_color" in df.columns:
-            meta["wine_color"] = row["wine_color"]
-
-        if "id" in df.columns and pd.notna(row["id"]):
-            meta["id"] = row["id"]
+DOCUMENTS_CACHE_DIR = "app/vectorstore/documents_cache"
+DOCUMENTS_FORMAT_VERSION = 1
+META_FIELDS = ["price", "points", "province", "variety", "designation", "country", "region_1", "winery"]
+
+
+def clean_text(series):
+    return series.astype(str).str.replace("\\n", " ", regex=False).str.replace("\n", " ", regex=False) \
+        .str.replace("\r", " ", regex=False).str.strip()
+
+
+def join_present(parts, sep):
+    """Row-wise ``sep.join`` of the non-missing entries of several string Series."""
+    joined = None
+    for part in parts:
+        if joined is None:
+            joined = part
         else:
-            meta["id"] = f"doc_{idx}"
+            joined = joined.where(part.isna(), joined + sep + part).where(joined.notna(), part)
+    return joined
+
+
+def labelled(df, col, label, clean=False):
+    values = clean_text(df[col]) if clean else df[col].astype(str)
+    return (label + ": " + values).where(df[col].notna())
+
+
+def build_document_fields(df):
+    """Page contents and metadata dicts for every row of ``df``, built column-wise."""
+    empty = pd.Series(None, index=df.index, dtype=object)
+    sections = []
+    if "title" in df.columns:
+        sections.append(labelled(df, "title", "Title", clean=True))
+    if "description" in df.columns:
+        sections.append(labelled(df, "description", "Description", clean=True))
+
+    meta_parts = [labelled(df, col, col.capitalize()) for col in META_FIELDS if col in df.columns]
+    if "vintage" in df.columns:
+        meta_parts.append(labelled(df, "vintage", "Vintage"))
+    if "wine_color" in df.columns:
+        meta_parts.append(labelled(df, "wine_color", "Wine Color"))
+    if meta_parts:
+        sections.append(join_present(meta_parts, ", "))
+
+    review_cols = [col for col in df.columns if col.startswith("review_")][:5]
+    reviews = [clean_text(df[col]).where(df[col].notna()) for col in review_cols]
+    if reviews:
+        sections.append("Reviews:\n" + join_present(reviews, "\n"))
+
+    texts = join_present(sections, "\n") if sections else empty
+    texts = texts.fillna("").tolist()
+
+    meta_cols = [col for col in META_FIELDS + ["id", "vintage", "wine_color"] if col in df.columns]
+    metadatas = df[meta_cols].to_dict("records")
+    if "id" in df.columns:
+        missing_ids = df["id"].isna().to_numpy()
+    else:
+        missing_ids = np.ones(len(df), dtype=bool)
+    for row in np.flatnonzero(missing_ids):
+        metadatas[row]["id"] = f"doc_{df.index[row]}"
+    return texts, metadatas
+
+
+def create_documents(df):
+    texts, metadatas = build_document_fields(df)
+    return [Document(page_content=text, metadata=meta) for text, meta in zip(texts, metadatas)]
 
-        full_text = "\n".join(sections)
 
-        doc = Document(page_content=full_text, metadata=meta)
-        documents.append(doc)
-    return documents
+def frame_fingerprint(df):
+    """Content hash of ``df`` (values, index and column names)."""
+    digest = hashlib.sha256()
+    digest.update("\x1f".join(map(str, df.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()[:16]
 
 
 def create_vectorstore(embedding_fn, documents):
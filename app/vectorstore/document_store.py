@@ -0,0 +1,239 @@
+import os
+import pickle
+import tempfile
+import zlib
+
+import numpy as np
+import pandas as pd
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from vectorstore.create_vectorstore import DOCUMENTS_CACHE_DIR, META_FIELDS, build_document_fields, \
+    frame_fingerprint
+from vectorstore.file_lock import file_lock
+from vectorstore.mmap_store import PositionIds
+from vectorstore.segments import SegmentedIndex, index_segments
+
+DOCUMENT_STORE_FORMAT_VERSION = 1
+CACHE_LOCK_FILE = ".lock"
+METADATA_COLUMNS = META_FIELDS + ["id", "vintage", "wine_color"]
+
+
+def compact_frame(df):
+    """The metadata columns (plus title) of ``df`` with repeated strings stored as categoricals."""
+    columns = [col for col in ["title"] + METADATA_COLUMNS if col in df.columns]
+    frame = df[columns].copy()
+    for col in columns:
+        if col != "id" and frame[col].dtype == object:
+            frame[col] = frame[col].astype("category")
+    if "id" in frame.columns:
+        missing = frame["id"].isna()
+        if missing.any():
+            frame["id"] = frame["id"].astype(object).where(~missing, [f"doc_{idx}" for idx in frame.index])
+    else:
+        frame["id"] = [f"doc_{idx}" for idx in frame.index]
+    return frame.reset_index(drop=True)
+
+
+def encode_texts(texts, compress=True):
+    chunks = [text.encode("utf-8") for text in texts]
+    return [zlib.compress(chunk) for chunk in chunks] if compress else chunks
+
+
+class DocumentStore:
+    """Every wine of the catalog once, addressed by integer row.
+
+    Page contents live in one byte blob (zlib-compressed per row by default) sliced
+    through an offsets array and decoded on access; metadata is a compact columnar
+    frame. ``Document`` objects are built on demand, so BM25, metadata filtering,
+    FAISS hydration and reference lookups all share this single copy.
+    """
+
+    def __init__(self, text_blob, text_offsets, frame, compressed=True):
+        self.text_blob = text_blob
+        self.text_offsets = text_offsets
+        self.frame = frame
+        self.compressed = compressed
+        self.ids = frame["id"].tolist()
+        self.id_to_row = {doc_id: row for row, doc_id in enumerate(self.ids)}
+
+        self._metadata_columns = [col for col in METADATA_COLUMNS if col in frame.columns]
+        self._metadata_values = {col: frame[col].to_numpy(dtype=object) for col in self._metadata_columns}
+
+    @classmethod
+    def from_chunks(cls, chunks, frame, compressed=True):
+        text_offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+        np.cumsum([len(chunk) for chunk in chunks], out=text_offsets[1:])
+        text_blob = np.frombuffer(b"".join(chunks), dtype=np.uint8)
+        return cls(text_blob, text_offsets, frame, compressed=compressed)
+
+    @classmethod
+    def from_frame(cls, df, compress=True):
+        texts, _ = build_document_fields(df)
+        return cls.from_chunks(encode_texts(texts, compress), compact_frame(df), compressed=compress)
+
+    def updated(self, df, reuse_rows):
+        """Store for the catalog ``df``: row ``i`` keeps the encoded text of row ``reuse_rows[i]`` of this
+        store, rows marked ``-1`` are built from ``df``."""
+        reuse_rows = np.asarray(reuse_rows, dtype=np.int64)
+        fresh = np.flatnonzero(reuse_rows < 0)
+        texts, _ = build_document_fields(df.iloc[fresh])
+        fresh_chunks = dict(zip(fresh.tolist(), encode_texts(texts, self.compressed)))
+        chunks = [fresh_chunks[row] if old_row < 0 else self.chunk(old_row) for row, old_row in
+                  enumerate(reuse_rows.tolist())]
+        return DocumentStore.from_chunks(chunks, compact_frame(df), compressed=self.compressed)
+
+    def __len__(self):
+        return len(self.text_offsets) - 1
+
+    def __getitem__(self, row):
+        return Document(page_content=self.text(row), metadata=self.metadata(row))
+
+    def __iter__(self):
+        return (self[row] for row in range(len(self)))
+
+    def chunk(self, row):
+        return self.text_blob[self.text_offsets[row]:self.text_offsets[row + 1]].tobytes()
+
+    def text(self, row):
+        chunk = self.chunk(row)
+        if self.compressed:
+            chunk = zlib.decompress(chunk)
+        return chunk.decode("utf-8")
+
+    def texts(self):
+        return (self.text(row) for row in range(len(self)))
+
+    def metadata(self, row):
+        return {col: self._metadata_values[col][row] for col in self._metadata_columns}
+
+    def documents(self, rows):
+        return [self[row] for row in rows]
+
+    def nbytes(self):
+        return int(self.text_blob.nbytes + self.text_offsets.nbytes + self.frame.memory_usage(deep=True).sum())
+
+    def save(self, path):
+        # A temporary name of its own, so concurrent writers never write into the same file.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".",
+                                        suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump({"text_blob": self.text_blob, "text_offsets": self.text_offsets, "frame": self.frame,
+                             "compressed": self.compressed}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        return cls(data["text_blob"], data["text_offsets"], data["frame"], compressed=data["compressed"])
+
+
+def document_store_path(fingerprint, cache_dir=DOCUMENTS_CACHE_DIR, compress=True):
+    """Cache path of the store of the catalog whose ``frame_fingerprint`` is ``fingerprint``."""
+    key = f"store_v{DOCUMENT_STORE_FORMAT_VERSION}_{'z' if compress else 'raw'}_{fingerprint}.pkl"
+    return os.path.join(cache_dir, key)
+
+
+def cache_lock(cache_dir):
+    """Held while a store is built, saved or swept from ``cache_dir``, so workers starting together don't race."""
+    os.makedirs(cache_dir, exist_ok=True)
+    return file_lock(os.path.join(cache_dir, CACHE_LOCK_FILE))
+
+
+def replace_cached_stores(store, path):
+    """Save ``store`` as the only cached store in its directory; the caller holds ``cache_lock``."""
+    cache_dir = os.path.dirname(path)
+    for name in os.listdir(cache_dir):
+        if name.endswith((".pkl", ".tmp")) and name != os.path.basename(path):
+            os.remove(os.path.join(cache_dir, name))
+    store.save(path)
+
+
+def save_document_store(store, path):
+    """Save ``store`` as the only cached store in its directory."""
+    with cache_lock(os.path.dirname(path)):
+        replace_cached_stores(store, path)
+
+
+def cached_document_store(path):
+    """The store saved at ``path``, or ``None`` when there is none (or another worker just swept it)."""
+    try:
+        return DocumentStore.load(path)
+    except FileNotFoundError:
+        return None
+
+
+def load_or_create_document_store(df, cache_dir=DOCUMENTS_CACHE_DIR, compress=True, fingerprint=None):
+    """``DocumentStore.from_frame(df)``, persisted under a key of the format version and the catalog's content hash.
+
+    ``fingerprint`` is ``frame_fingerprint(df)`` when the caller has already computed it.
+    """
+    path = document_store_path(fingerprint or frame_fingerprint(df), cache_dir, compress)
+    store = cached_document_store(path)
+    if store is not None:
+        return store
+
+    with cache_lock(cache_dir):
+        store = cached_document_store(path)
+        if store is None:
+            store = DocumentStore.from_frame(df, compress=compress)
+            replace_cached_stores(store, path)
+    return store
+
+
+class StoreDocstore(Docstore):
+    """LangChain docstore view of a ``DocumentStore``: docstore id ``str(pos)`` is FAISS position ``pos``."""
+
+    def __init__(self, store, pos_to_row):
+        self.store = store
+        self.pos_to_row = pos_to_row
+        ids = np.asarray(store.ids + [None], dtype=object)
+        self.wine_ids = ids[pos_to_row]
+
+    def search(self, search):
+        position = int(search)
+        if not 0 <= position < len(self.pos_to_row) or self.pos_to_row[position] < 0:
+            return f"ID {search} not found."
+        return self.store[int(self.pos_to_row[position])]
+
+    def add(self, texts):
+        raise NotImplementedError("StoreDocstore is read-only")
+
+    def delete(self, ids):
+        raise NotImplementedError("StoreDocstore is read-only")
+
+
+def index_wine_ids(vectorstore):
+    """Wine id stored at each FAISS position of ``vectorstore``."""
+    wine_ids = getattr(vectorstore.docstore, "wine_ids", None)
+    if wine_ids is not None:
+        return wine_ids.tolist()
+    return [vectorstore.docstore.search(vectorstore.index_to_docstore_id[pos]).metadata.get("id")
+            for pos in range(vectorstore.index.ntotal)]
+
+
+def bind_document_store(vectorstore, store):
+    """A view of ``vectorstore`` that hydrates search results from ``store``; ``vectorstore`` is not modified.
+
+    The view shares the index segments and the embedding function, so it costs one
+    position-to-row array. Positions holding wines ``store`` doesn't have (an index
+    published by ingestion before this process reloaded the catalog) are excluded from
+    searches like deleted ones.
+    """
+    index = vectorstore.index
+    pos_to_row = np.fromiter((store.id_to_row.get(wine_id, -1) for wine_id in index_wine_ids(vectorstore)),
+                             dtype=np.int64, count=index.ntotal)
+    dead = getattr(index, "dead", np.empty(0, dtype=np.int64))
+    pos_to_row[dead] = -1
+    unknown = np.flatnonzero(pos_to_row < 0)
+    if len(unknown) > len(dead):
+        index = SegmentedIndex(index_segments(index), unknown)
+    return FAISS(vectorstore.embedding_function, index, StoreDocstore(store, pos_to_row),
+                 PositionIds(index.ntotal), relevance_score_fn=vectorstore.override_relevance_score_fn,
+                 normalize_L2=vectorstore._normalize_L2, distance_strategy=vectorstore.distance_strategy)
@@ -0,0 +1,75 @@
+import os
+import threading
+from collections import OrderedDict
+
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_QUERY_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 4096))
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """Wraps an embedding model with an LRU cache of query text -> vector.
+
+    The wrapper is installed as the vectorstore's embedding function, so every strategy
+    (naive, hyde, hybrid, fusion) shares one cache per embedding model. ``embed_queries``
+    embeds all cache misses of a query set in a single batched call.
+    """
+
+    def __init__(self, embeddings, maxsize=DEFAULT_QUERY_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def client(self):
+        return getattr(self.embeddings, "client", None)
+
+    def _lookup(self, text):
+        with self._lock:
+            vector = self._cache.get(text)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(text)
+            self.hits += 1
+            return vector
+
+    def _store(self, text, vector):
+        with self._lock:
+            self._cache[text] = vector
+            self._cache.move_to_end(text)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def embed_query(self, text):
+        vector = self._lookup(text)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self._store(text, vector)
+        return vector
+
+    def embed_queries(self, texts):
+        vectors = {}
+        missing = []
+        for text in dict.fromkeys(texts):
+            vector = self._lookup(text)
+            if vector is None:
+                missing.append(text)
+            else:
+                vectors[text] = vector
+
+        if missing:
+            for text, vector in zip(missing, self.embeddings.embed_documents(missing)):
+                self._store(text, vector)
+                vectors[text] = vector
+        return [vectors[text] for text in texts]
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._cache), "hits": self.hits, "misses": self.misses}
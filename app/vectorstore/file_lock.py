@@ -0,0 +1,13 @@
+import fcntl
+from contextlib import contextmanager
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock on the file ``path``, held across processes (API workers and the CLIs) and threads."""
+    with open(path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
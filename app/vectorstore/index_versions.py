@@ -0,0 +1,91 @@
+import os
+import re
+import shutil
+import time
+from contextlib import contextmanager
+
+
+
+def version_dirs(path):
+    """``(timestamp, directory)`` of every version of ``path`` (``<path>.v<timestamp>``), oldest first."""
+    path = path.rstrip("/")
+    parent, name = os.path.split(path)
+    pattern = re.compile(re.escape(name) + r"\.v(\d+)$")
+    found = [(int(match.group(1)), os.path.join(parent, entry)) for entry in os.listdir(parent or ".")
+             if (match := pattern.match(entry)) and os.path.isdir(os.path.join(parent, entry))]
+    return sorted(found)
+
+
+def link_tree(source, target):
+    """Hardlink (or copy, across filesystems) every file of ``source`` into ``target``."""
+    for root, dirs, files in os.walk(source):
+        destination = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(destination, exist_ok=True)
+        for name in files:
+            try:
+                os.link(os.path.join(root, name), os.path.join(destination, name))
+            except OSError:
+                shutil.copy2(os.path.join(root, name), os.path.join(destination, name))
+
+
+def sync_tree(path):
+    for root, _, files in os.walk(path):
+        for name in files:
+            with open(os.path.join(root, name), "rb") as f:
+                os.fsync(f.fileno())
+        fd = os.open(root, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def publish(path, version):
+    """Point ``path`` at ``version`` with one rename, then delete older versions except the one it replaced.
+
+    The replaced version is kept for the processes that loaded it moments ago and are
+    still opening its files.
+
+    A ``path`` that is still a plain directory (written before versioning) is first
+    renamed to a version of its own; readers opening it at that instant find nothing.
+    """
+    path = path.rstrip("/")
+    previous = os.path.realpath(path)
+    if os.path.isdir(path) and not os.path.islink(path):
+        previous = f"{path}.v0"
+        os.rename(path, previous)
+    link = f"{path}.link.tmp"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(version), link)
+    os.replace(link, path)
+
+    # Versions newer than the published one may be another writer's, still being staged.
+    versions = version_dirs(path)
+    published = next(stamp for stamp, directory in versions if directory == version)
+    for stamp, directory in versions:
+        if stamp < published and os.path.realpath(directory) != os.path.realpath(previous):
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+@contextmanager
+def staged_version(path, copy_current=False):
+    """A fresh directory to write the next version of ``path`` into, published when the block succeeds.
+
+    ``path`` is a symlink to its current version, so readers that resolve it once (see
+    ``load_vectorstore``) always get a complete, consistent set of files. With
+    ``copy_current`` the new version starts with the current files hardlinked in; they
+    must then be replaced (write to a temporary name and rename), never modified in place.
+    """
+    path = path.rstrip("/")
+    version = f"{path}.v{time.time_ns()}"
+    os.makedirs(version)
+    try:
+        if copy_current and os.path.isdir(path):
+            link_tree(os.path.realpath(path), version)
+        yield version
+        sync_tree(version)
+    except BaseException:
+        shutil.rmtree(version, ignore_errors=True)
+        raise
+    publish(path, version)
@@ -0,0 +1,247 @@
+import argparse
+import os
+import pickle
+import shutil
+
+import faiss
+import numpy as np
+import pandas as pd
+
+from vectorstore.ann_index import INDEX_TYPES, index_file
+from vectorstore.bm25_index import BM25_INDEX_PATH, BM25Index, saved_bm25_index
+from vectorstore.build_vectorstore import write_vectorstore
+from vectorstore.create_vectorstore import DOCUMENTS_CACHE_DIR, frame_fingerprint
+from vectorstore.document_store import compact_frame, document_store_path, load_or_create_document_store, \
+    save_document_store
+from vectorstore.file_lock import file_lock
+from vectorstore.index_versions import staged_version
+from vectorstore.load_vectorstore import VECTORSTORE_CONFIG
+from vectorstore.mmap_store import DELTA_DIR, INDEX_FILE, MmapDocstore, has_mmap_layout, write_mmap_delta
+from vectorstore.registry import vectorstore_registry
+from vectorstore.segments import index_segments, load_segmented_index
+
+CATALOG_CSV_PATH = "data_processing/wine_data_final.csv"
+# Share of the index the delta (appended plus deleted positions) may reach before ingestion compacts it.
+COMPACT_FRACTION = float(os.getenv("INGEST_COMPACT_FRACTION", 0.1))
+
+
+def catalog_lock(csv_path):
+    """Serializes ingestion across processes (API workers and the CLI) on a lock file next to the catalog."""
+    return file_lock(csv_path + ".lock")
+
+
+def read_wines(path):
+    if path.endswith(".jsonl"):
+        return pd.read_json(path, lines=True)
+    if path.endswith(".json"):
+        return pd.read_json(path)
+    return pd.read_csv(path)
+
+
+def catalog_keys(df):
+    """Row key for merging: the wine id, or the row position for the (legacy) rows without one."""
+    ids = df["id"] if "id" in df.columns else pd.Series(np.nan, index=df.index)
+    return ids.astype(str).where(ids.notna(), [f"\x00row{row}" for row in range(len(df))])
+
+
+def apply_changes(df, upserts=None, delete_ids=()):
+    """The catalog ``df`` with each upserted wine replacing the row of the same id in place (or appended
+    when new) and the wines in ``delete_ids`` removed."""
+    merged = df.reset_index(drop=True)
+    if upserts is not None:
+        if "id" not in upserts.columns or upserts["id"].isna().any():
+            raise ValueError("Every upserted wine needs an 'id'")
+        merged = pd.concat([merged, upserts], ignore_index=True)
+    keys = catalog_keys(merged)
+    latest = pd.Series(np.arange(len(merged)), index=keys.to_numpy()).groupby(level=0, sort=False).last()
+    latest = latest[~latest.index.isin([str(wine_id) for wine_id in delete_ids])]
+    return merged.iloc[latest.to_numpy()].reset_index(drop=True)
+
+
+def write_csv_atomic(df, path):
+    df.to_csv(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+
+
+def saved_index(index_path):
+    """The flat index saved under ``index_path`` (with ingestion's delta applied), the wine id at each of its
+    positions and a function returning the page content at a position."""
+    index_path = os.path.realpath(index_path)
+    if has_mmap_layout(index_path):
+        index = faiss.read_index(os.path.join(index_path, INDEX_FILE), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        docstore = MmapDocstore(index_path)
+        return load_segmented_index(index, index_path), docstore.wine_ids.tolist(), docstore.page_content
+
+    index = faiss.read_index(os.path.join(index_path, INDEX_FILE))
+    with open(os.path.join(index_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    documents = [docstore.search(index_to_docstore_id[pos]) for pos in range(index.ntotal)]
+    return index, [doc.metadata.get("id") for doc in documents], lambda pos: documents[pos].page_content
+
+
+def update_vectorstore(emb_model, store, compact=None, registry=vectorstore_registry):
+    """Bring the saved index of ``emb_model`` in line with ``store`` without rebuilding it.
+
+    Saved vectors are kept for every wine whose document text is unchanged; the rest are
+    embedded and appended to the index's delta segment, and the positions of changed or
+    deleted wines are tombstoned. The delta is folded into a full rewrite (approximate
+    indexes keep their trained quantizers) when ``compact`` is true, or when it is ``None``
+    and the delta exceeds ``COMPACT_FRACTION`` of the index. Wines are embedded with the
+    model of the store ``registry`` holds for ``emb_model``. Returns the number of wines
+    embedded, whether the index was compacted and the size of its delta, or ``None`` when
+    no index was built for the model.
+    """
+    index_path = VECTORSTORE_CONFIG[emb_model]["default_path"]
+    current = os.path.realpath(index_path)
+    if not os.path.exists(os.path.join(current, INDEX_FILE)):
+        return None
+
+    index, wine_ids, page_content = saved_index(current)
+    live = getattr(index, "live_mask", np.ones(index.ntotal, dtype=bool))
+    live_positions = {str(wine_id): pos for pos, wine_id in enumerate(wine_ids) if live[pos]}
+    positions = np.asarray([live_positions.get(str(wine_id), -1) for wine_id in store.ids], dtype=np.int64)
+    for row in np.flatnonzero(positions >= 0).tolist():
+        if page_content(int(positions[row])) != store.text(row):
+            positions[row] = -1
+
+    fresh = np.flatnonzero(positions < 0)
+    fresh_vectors = np.empty((len(fresh), index.d), dtype=np.float32)
+    if len(fresh):
+        embedding_fn = registry.get(emb_model).embedding_function
+        fresh_vectors[:] = embedding_fn.embed_documents([store.text(row) for row in fresh.tolist()])
+
+    kept = np.zeros(index.ntotal, dtype=bool)
+    kept[positions[positions >= 0]] = True
+    deleted = np.flatnonzero(~kept)
+    base = index_segments(index)[0].ntotal
+    appended = index.ntotal - base + len(fresh)
+    if not has_mmap_layout(current):
+        compact = True  # the delta extends the memory-mapped docstore, which this index doesn't have yet
+    elif compact is None:
+        compact = appended + len(deleted) > COMPACT_FRACTION * base
+    summary = {"embedded": len(fresh), "compacted": bool(compact), "delta": {"appended": appended,
+                                                                             "deleted": len(deleted)}}
+
+    if compact:
+        vectors = np.empty((len(store), index.d), dtype=np.float32)
+        reused = positions >= 0
+        if reused.any():
+            vectors[reused] = index.reconstruct_batch(positions[reused])
+        vectors[fresh] = fresh_vectors
+        ann_types = [index_type for index_type in INDEX_TYPES[1:]
+                     if os.path.exists(os.path.join(current, index_file(index_type)))]
+        write_vectorstore(index_path, vectors, list(store.texts()), [store.metadata(row) for row in range(len(store))],
+                          ann_types=ann_types, retrain=False)
+        summary["delta"] = {"appended": 0, "deleted": 0}
+        return summary
+    if not len(fresh) and len(deleted) == len(getattr(index, "dead", ())):
+        return summary
+
+    documents = [store[row] for row in fresh.tolist()]
+    vectors = fresh_vectors
+    if index.ntotal > base:
+        delta = MmapDocstore(os.path.join(current, DELTA_DIR))
+        documents = [delta.search(pos) for pos in range(len(delta))] + documents
+        vectors = np.concatenate([index_segments(index)[1].reconstruct_n(0, index.ntotal - base), vectors])
+    with staged_version(index_path, copy_current=True) as version:
+        # Written from scratch, so no appended wine that has since been deleted again is left behind.
+        shutil.rmtree(os.path.join(version, DELTA_DIR), ignore_errors=True)
+        write_mmap_delta(version, documents, vectors, deleted)
+    return summary
+
+
+def update_bm25_index(old_store, old_fingerprint, store, reuse_rows, fingerprint, bm25_path=BM25_INDEX_PATH):
+    """Save the BM25 index of ``store``, whose row ``i`` is row ``reuse_rows[i]`` of ``old_store`` (``-1``: changed).
+
+    The saved index of ``old_store`` is updated in place of a rebuild when there is one
+    (see ``BM25Index.updated``); otherwise the whole catalog is tokenized.
+    """
+    bm25_index = saved_bm25_index(old_store, old_fingerprint, bm25_path)
+    if bm25_index is not None and bm25_index.freqs is not None:
+        fresh = np.flatnonzero(np.asarray(reuse_rows) < 0)
+        bm25_index = bm25_index.updated(reuse_rows, [store.text(row) for row in fresh.tolist()], store.ids,
+                                        fingerprint=fingerprint)
+    else:
+        bm25_index = BM25Index.build(list(store.texts()), store.ids, fingerprint=fingerprint)
+    bm25_index.save(bm25_path)
+    return bm25_index
+
+
+def ingest(upserts=None, delete_ids=(), csv_path=CATALOG_CSV_PATH, emb_models=None,
+           cache_dir=DOCUMENTS_CACHE_DIR, bm25_path=BM25_INDEX_PATH, compact=None, registry=vectorstore_registry):
+    """Upsert and delete wines by ``id`` in the catalog CSV and every artifact derived from it.
+
+    Unchanged wines keep their encoded text and their vectors; only wines whose document
+    text changed are embedded, once per embedding model with a saved index, and appended
+    to that index (see ``update_vectorstore``) with the embedding model ``registry`` has
+    loaded for it, so an API worker doesn't hold a second copy. The BM25 index keeps the
+    postings of unchanged wines and tokenizes only the changed ones (see ``update_bm25_index``).
+
+    The indexes are published before the CSV is replaced, and processes watching the CSV
+    (see ``main.py``) reload their catalog and indexes together once it is. A process that
+    opens an index in between binds it to its current catalog, which leaves out the wines
+    it doesn't know yet (see ``bind_document_store``).
+    """
+    with catalog_lock(csv_path):
+        df = pd.read_csv(csv_path)
+        old_fingerprint = frame_fingerprint(df)
+        old_store = load_or_create_document_store(df, cache_dir, fingerprint=old_fingerprint)
+
+        write_csv_atomic(apply_changes(df, upserts, delete_ids), csv_path + ".next")
+        new_df = pd.read_csv(csv_path + ".next")  # exactly what every process will read back
+
+        upserted_ids = {str(wine_id) for wine_id in upserts["id"]} if upserts is not None else set()
+        if new_df.dtypes.equals(df.dtypes):
+            old_rows = {str(wine_id): row for row, wine_id in enumerate(old_store.ids)}
+            reuse_rows = [-1 if wine_id in upserted_ids else old_rows.get(wine_id, -1)
+                          for wine_id in map(str, compact_frame(new_df)["id"])]
+        else:
+            # A column changed type (e.g. ints became floats), so old rows would no longer render the same.
+            reuse_rows = np.full(len(new_df), -1)
+        store = old_store.updated(new_df, reuse_rows)
+
+        indexes = {}
+        for emb_model in emb_models or list(VECTORSTORE_CONFIG):
+            indexes[emb_model] = update_vectorstore(emb_model, store, compact, registry)
+
+        fingerprint = frame_fingerprint(new_df)
+        save_document_store(store, document_store_path(fingerprint, cache_dir, store.compressed))
+        update_bm25_index(old_store, old_fingerprint, store, reuse_rows, fingerprint, bm25_path)
+        os.replace(csv_path + ".next", csv_path)
+
+    return {
+        "upserted": len(upserted_ids),
+        "deleted": len(df) + len(upserted_ids - set(catalog_keys(df))) - len(new_df),
+        "catalog_size": len(new_df),
+        "indexes": {emb_model: summary for emb_model, summary in indexes.items() if summary is not None},
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Upsert or delete wines by id without rebuilding the indexes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    upsert = subparsers.add_parser("upsert", help="add or replace the wines in a CSV, JSON or JSONL file")
+    upsert.add_argument("path")
+    delete = subparsers.add_parser("delete", help="remove wines by id")
+    delete.add_argument("ids", nargs="+")
+    compact = subparsers.add_parser("compact", help="fold the wines appended and deleted since the last full "
+                                                    "write into the indexes")
+    for subparser in (upsert, delete, compact):
+        subparser.add_argument("--csv", default=CATALOG_CSV_PATH)
+        subparser.add_argument("--emb-models", nargs="+", choices=list(VECTORSTORE_CONFIG))
+    for subparser in (upsert, delete):
+        subparser.add_argument("--compact", action=argparse.BooleanOptionalAction,
+                               help="always (or never) compact the indexes; by default once their delta is large")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "upsert":
+        summary = ingest(upserts=read_wines(args.path), csv_path=args.csv, emb_models=args.emb_models,
+                         compact=args.compact)
+    elif args.command == "delete":
+        summary = ingest(delete_ids=args.ids, csv_path=args.csv, emb_models=args.emb_models, compact=args.compact)
+    else:
+        summary = ingest(csv_path=args.csv, emb_models=args.emb_models, compact=True)
+    print(summary)
@@ -1,29 +1,87 @@
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import HuggingFaceEmbeddings, OpenAIEmbeddings
+import os
 
-def load_vectorstore(embedding="openai"):
+from vectorstore.embedding_cache import CachedQueryEmbeddings
+from vectorstore.ann_index import index_file, use_index_type
+from vectorstore.mmap_store import INDEX_FILE, MmapDocstore, PositionIds, has_mmap_layout, load_mmap_vectorstore
+from vectorstore.segments import index_segments, load_segments
+
+VECTORSTORE_CONFIG = {
+    "mpnet": {
+        "fn": lambda: HuggingFaceEmbeddings(model_name="all-mpnet-base-v2"),
+        "default_path": "app/vectorstore/faiss_index_all_mpnet_base_v2",
+    },
+    "roberta": {
+        "fn": lambda: HuggingFaceEmbeddings(model_name="all-roberta-large-v1"),
+        "default_path": "app/vectorstore/faiss_index_all_roberta_large_v1",
+    },
+    "openai": {
+        "fn": lambda: OpenAIEmbeddings(model="text-embedding-3-large"),
+        "default_path": "app/vectorstore/faiss_index_text_embedding_3_large",
+    },
+}
+
+
+USE_MMAP = os.getenv("VECTORSTORE_MMAP", "true").lower() == "true"
+INDEX_TYPE = os.getenv("VECTORSTORE_INDEX_TYPE", "flat").lower()
+NPROBE = int(os.getenv("VECTORSTORE_NPROBE", 16))
+EF_SEARCH = int(os.getenv("VECTORSTORE_EF_SEARCH", 128))
+
+
+def base_files(index_path, index_type):
+    """(device, inode) of the index files of the last full write under ``index_path``; ingestion hardlinks
+    them unchanged into every version that only adds a delta."""
+    names = [INDEX_FILE] if index_type == "flat" else [INDEX_FILE, index_file(index_type)]
+    return tuple((stat.st_dev, stat.st_ino) for stat in (os.stat(os.path.join(index_path, name)) for name in names))
+
+
+def loaded_from(vectorstore, index_path, index_type):
+    """Record which version ``vectorstore`` was opened from, for ``refresh_vectorstore``."""
+    vectorstore.index_path = index_path
+    vectorstore.base_files = base_files(index_path, index_type) if has_mmap_layout(index_path) else None
+    return vectorstore
+
+
+def load_vectorstore(embedding="openai", mmap=USE_MMAP, index_type=INDEX_TYPE, embedding_fn=None):
+    """Load the saved index for ``embedding``, memory-mapped when the index directory has the mmap layout.
+
+    ``index_type`` other than "flat" swaps in a prebuilt approximate index (see ``ann_index.py``).
+    Wines appended or deleted by ingestion since the last full write are applied on top.
+    ``embedding_fn`` reuses an embedding function already created for ``embedding``.
+    """
     embedding = embedding.lower()
-    config = {
-        "mpnet": {
-            "fn": HuggingFaceEmbeddings(model_name="all-mpnet-base-v2"),
-            "default_path": "app/vectorstore/faiss_index_all_mpnet_base_v2",
-        },
-        "roberta": {
-            "fn": HuggingFaceEmbeddings(model_name="all-roberta-large-v1"),
-            "default_path": "app/vectorstore/faiss_index_all_roberta_large_v1",
-        },
-        "openai": {
-            "fn": OpenAIEmbeddings(model="text-embedding-3-large"),
-            "default_path": "app/vectorstore/faiss_index_text_embedding_3_large",
-        },
-    }
-
-    if embedding not in config:
-        valid = ", ".join(config.keys())
+    if embedding not in VECTORSTORE_CONFIG:
+        valid = ", ".join(VECTORSTORE_CONFIG.keys())
         raise ValueError(f"Unknown embedding '{embedding}'. Valid options: {valid}")
 
-    embedding_fn = config[embedding]["fn"]
-    index_path = config[embedding]["default_path"]
+    embedding_fn = embedding_fn or CachedQueryEmbeddings(VECTORSTORE_CONFIG[embedding]["fn"]())
+    # Resolved once, so every file comes from the same version even if a new one is published meanwhile.
+    index_path = os.path.realpath(VECTORSTORE_CONFIG[embedding]["default_path"])
 
-    vectorstore = FAISS.load_local(index_path, embedding_fn, allow_dangerous_deserialization=True)
-    return vectorstore
+    if mmap and has_mmap_layout(index_path):
+        vectorstore = load_mmap_vectorstore(index_path, embedding_fn)
+    else:
+        vectorstore = FAISS.load_local(index_path, embedding_fn, allow_dangerous_deserialization=True)
+    vectorstore = use_index_type(vectorstore, index_path, index_type, nprobe=NPROBE, ef_search=EF_SEARCH)
+    return loaded_from(load_segments(vectorstore, index_path), index_path, index_type)
+
+
+def refresh_vectorstore(vectorstore, embedding="openai", mmap=USE_MMAP, index_type=INDEX_TYPE):
+    """``vectorstore`` as ingestion has published it since it was loaded, keeping its embedding function
+    (model and query cache).
+
+    When the new version only changed the delta, the open base index is kept and just the
+    appended vectors and deleted positions are read; after a full write the store is reopened.
+    """
+    embedding = embedding.lower()
+    index_path = os.path.realpath(VECTORSTORE_CONFIG[embedding]["default_path"])
+    if index_path == getattr(vectorstore, "index_path", None):
+        return vectorstore
+
+    if (mmap and isinstance(vectorstore.docstore, MmapDocstore) and has_mmap_layout(index_path)
+            and base_files(index_path, index_type) == getattr(vectorstore, "base_files", None)):
+        base = index_segments(vectorstore.index)[0]
+        refreshed = FAISS(vectorstore.embedding_function, base, MmapDocstore(index_path), PositionIds(base.ntotal))
+        return loaded_from(load_segments(refreshed, index_path), index_path, index_type)
+    return load_vectorstore(embedding, mmap, index_type, embedding_fn=vectorstore.embedding_function)
@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+from collections.abc import Mapping
+
+import faiss
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from vectorstore.index_versions import staged_version
+
+INDEX_FILE = "index.faiss"
+TEXT_FILE = "docstore_text.bin"
+TEXT_OFFSETS_FILE = "docstore_text_offsets.npy"
+METADATA_FILE = "docstore_metadata.bin"
+METADATA_OFFSETS_FILE = "docstore_metadata_offsets.npy"
+WINE_IDS_FILE = "ids.npy"
+# Written by ingestion between full writes: the appended wines (same docstore layout, plus their
+# vectors) and the positions whose wine was deleted or re-embedded.
+DELTA_DIR = "delta"
+DELTA_VECTORS_FILE = "vectors.npy"
+DELETED_FILE = "deleted.npy"
+
+
+def _plain(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _json_default(value):
+    value = _plain(value)
+    return value if isinstance(value, (int, float, bool)) else str(value)
+
+
+def _write_blob(path, offsets_path, chunks):
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    with open(path + ".tmp", "wb") as f:
+        for i, chunk in enumerate(chunks):
+            f.write(chunk)
+            offsets[i + 1] = offsets[i] + len(chunk)
+    np.save(offsets_path + ".tmp.npy", offsets)
+    os.replace(path + ".tmp", path)
+    os.replace(offsets_path + ".tmp.npy", offsets_path)
+
+
+def _open_blob(path):
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode="r")
+
+
+class PositionIds(Mapping):
+    """``index_to_docstore_id`` for a store whose docstore is addressed by FAISS position."""
+
+    def __init__(self, size):
+        self.size = size
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.size:
+            raise KeyError(position)
+        return str(position)
+
+    def __iter__(self):
+        return iter(range(self.size))
+
+    def __len__(self):
+        return self.size
+
+
+class MmapDocstore(Docstore):
+    """Read-only docstore backed by memory-mapped text and metadata blobs.
+
+    Document ``i`` is the one stored at FAISS position ``i``; its page content and its
+    JSON metadata are sliced out of the blobs through the offset arrays and decoded on
+    lookup, so nothing is deserialized up front and the pages are shared between processes.
+    Documents appended by ingestion (``delta/``) follow the ones of the last full write.
+    """
+
+    memory_mapped = True
+
+    def __init__(self, path):
+        self.path = path
+        self.text = _open_blob(os.path.join(path, TEXT_FILE))
+        self.text_offsets = np.load(os.path.join(path, TEXT_OFFSETS_FILE), mmap_mode="r")
+        self.metadata = _open_blob(os.path.join(path, METADATA_FILE))
+        self.metadata_offsets = np.load(os.path.join(path, METADATA_OFFSETS_FILE), mmap_mode="r")
+        self.wine_ids = np.load(os.path.join(path, WINE_IDS_FILE), mmap_mode="r")
+
+        self.delta = None
+        if os.path.exists(os.path.join(path, DELTA_DIR, WINE_IDS_FILE)):
+            self.delta = MmapDocstore(os.path.join(path, DELTA_DIR))
+            self.wine_ids = np.concatenate([self.wine_ids.astype(object), self.delta.wine_ids.astype(object)])
+
+    def __len__(self):
+        return len(self.text_offsets) - 1 + (len(self.delta) if self.delta is not None else 0)
+
+    def page_content(self, position):
+        base = len(self.text_offsets) - 1
+        if position >= base:
+            return self.delta.page_content(position - base)
+        start, end = self.text_offsets[position], self.text_offsets[position + 1]
+        return self.text[start:end].tobytes().decode("utf-8")
+
+    def search(self, search):
+        position = int(search)
+        if not 0 <= position < len(self):
+            return f"ID {search} not found."
+        base = len(self.text_offsets) - 1
+        if position >= base:
+            return self.delta.search(position - base)
+        start, end = self.metadata_offsets[position], self.metadata_offsets[position + 1]
+        metadata = json.loads(self.metadata[start:end].tobytes())
+        return Document(page_content=self.page_content(position), metadata=metadata)
+
+    def add(self, texts):
+        raise NotImplementedError("MmapDocstore is read-only")
+
+    def delete(self, ids):
+        raise NotImplementedError("MmapDocstore is read-only")
+
+
+def has_mmap_layout(path):
+    return all(os.path.exists(os.path.join(path, name))
+               for name in (INDEX_FILE, TEXT_OFFSETS_FILE, METADATA_OFFSETS_FILE, WINE_IDS_FILE))
+
+
+def write_mmap_docstore(vectorstore, path):
+    """Write the docstore of a loaded LangChain FAISS store next to its index, ordered by FAISS position."""
+    write_mmap_documents([vectorstore.docstore.search(vectorstore.index_to_docstore_id[pos])
+                          for pos in range(vectorstore.index.ntotal)], path)
+
+
+def write_mmap_documents(documents, path):
+    """Write ``documents`` (document ``i`` at FAISS position ``i``) in the memory-mapped docstore layout."""
+    os.makedirs(path, exist_ok=True)
+    _write_blob(os.path.join(path, TEXT_FILE), os.path.join(path, TEXT_OFFSETS_FILE),
+                [doc.page_content.encode("utf-8") for doc in documents])
+    _write_blob(os.path.join(path, METADATA_FILE), os.path.join(path, METADATA_OFFSETS_FILE),
+                [json.dumps(doc.metadata, default=_json_default).encode("utf-8") for doc in documents])
+
+    wine_ids = np.asarray([_plain(doc.metadata.get("id")) for doc in documents])
+    if wine_ids.dtype == object:
+        wine_ids = wine_ids.astype(str)
+    np.save(os.path.join(path, WINE_IDS_FILE + ".tmp.npy"), wine_ids)
+    os.replace(os.path.join(path, WINE_IDS_FILE + ".tmp.npy"), os.path.join(path, WINE_IDS_FILE))
+
+
+def write_mmap_delta(path, documents, vectors, deleted):
+    """Write the wines appended since the last full write of ``path`` and the deleted positions."""
+    delta_path = os.path.join(path, DELTA_DIR)
+    if documents:
+        write_mmap_documents(documents, delta_path)
+        np.save(os.path.join(delta_path, DELTA_VECTORS_FILE + ".tmp.npy"), np.asarray(vectors, dtype=np.float32))
+        os.replace(os.path.join(delta_path, DELTA_VECTORS_FILE + ".tmp.npy"),
+                   os.path.join(delta_path, DELTA_VECTORS_FILE))
+    np.save(os.path.join(path, DELETED_FILE + ".tmp.npy"), np.asarray(deleted, dtype=np.int64))
+    os.replace(os.path.join(path, DELETED_FILE + ".tmp.npy"), os.path.join(path, DELETED_FILE))
+
+
+def write_mmap_vectorstore(vectorstore, path):
+    os.makedirs(path, exist_ok=True)
+    faiss.write_index(vectorstore.index, os.path.join(path, INDEX_FILE + ".tmp"))
+    os.replace(os.path.join(path, INDEX_FILE + ".tmp"), os.path.join(path, INDEX_FILE))
+    write_mmap_docstore(vectorstore, path)
+
+
+def load_mmap_vectorstore(path, embedding_fn):
+    """Open a store written by ``write_mmap_vectorstore`` without reading the vectors or documents into memory.
+
+    Flat indexes are mapped zero-copy (``IO_FLAG_MMAP_IFC``), so worker processes share the
+    vector pages through the OS page cache. The returned store is read-only: adding to the
+    mapped index is not supported by FAISS.
+    """
+    index = faiss.read_index(os.path.join(path, INDEX_FILE), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    docstore = MmapDocstore(path)
+    return FAISS(embedding_fn, index, docstore, PositionIds(index.ntotal))
+
+
+if __name__ == "__main__":
+    from vectorstore.load_vectorstore import VECTORSTORE_CONFIG, load_vectorstore
+
+    parser = argparse.ArgumentParser(description="Add the memory-mapped docstore layout to saved FAISS indexes.")
+    parser.add_argument("emb_models", nargs="*", default=list(VECTORSTORE_CONFIG))
+    args = parser.parse_args()
+
+    for emb_model in args.emb_models:
+        path = VECTORSTORE_CONFIG[emb_model]["default_path"]
+        vectorstore = load_vectorstore(emb_model, mmap=False, index_type="flat")
+        with staged_version(path, copy_current=True) as version:
+            write_mmap_docstore(vectorstore, version)
+        print(f"{emb_model}: wrote memory-mapped docstore to {path}")
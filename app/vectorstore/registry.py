@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from vectorstore.load_vectorstore import load_vectorstore, refresh_vectorstore
+
+
+def estimate_vectorstore_bytes(vectorstore):
+    """Rough resident size of a loaded vectorstore: raw vectors plus local embedding model weights.
+
+    Returns ``(total, mapped)``. Memory-mapped vectors are part of the total: every flat
+    search reads all of them, so they stay resident (in the page cache, shared with other
+    workers) while the store is in use. ``mapped`` is that share of the total.
+    """
+    index = vectorstore.index
+    vector_bytes = index.ntotal * index.d * 4
+    mapped = vector_bytes if getattr(vectorstore.docstore, "memory_mapped", False) else 0
+    total = vector_bytes
+
+    model = getattr(vectorstore.embedding_function, "client", None) or getattr(vectorstore.embedding_function,
+                                                                                "_client", None)
+    parameters = getattr(model, "parameters", None)
+    if callable(parameters):
+        try:
+            total += sum(p.numel() * p.element_size() for p in parameters())
+        except TypeError:
+            pass
+    return total, mapped
+
+
+def query_cache_stats(vectorstore):
+    stats = getattr(vectorstore.embedding_function, "stats", None)
+    return stats() if callable(stats) else None
+
+
+class VectorstoreRegistry:
+    """Process-wide cache of loaded vectorstores, one per embedding model.
+
+    Each (embedding model, index) pair is loaded on first use and kept resident. When
+    ``memory_cap_bytes`` is set, least recently used stores are evicted once the
+    estimated total, memory-mapped vectors included, exceeds the cap; the store just
+    requested is never evicted. ``refresh`` brings the loaded stores up to date with
+    ingestion without loading them again.
+    """
+
+    def __init__(self, memory_cap_bytes=None, loader=load_vectorstore, refresher=refresh_vectorstore):
+        self.memory_cap_bytes = memory_cap_bytes
+        self.loader = loader
+        self.refresher = refresher
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def get(self, name):
+        name = name.lower()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+                entry["last_used"] = time.time()
+                return entry["vectorstore"]
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # Load outside the registry lock so requests for other models are not blocked.
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is not None:
+                    self._entries.move_to_end(name)
+                    return entry["vectorstore"]
+
+            start = time.perf_counter()
+            vectorstore = self.loader(name)
+            load_seconds = time.perf_counter() - start
+
+            total_bytes, mapped_bytes = estimate_vectorstore_bytes(vectorstore)
+            with self._lock:
+                self._entries[name] = {
+                    "vectorstore": vectorstore,
+                    "bytes": total_bytes,
+                    "mapped_bytes": mapped_bytes,
+                    "load_seconds": load_seconds,
+                    "last_used": time.time(),
+                }
+                self._evict()
+            return vectorstore
+
+    def refresh(self):
+        """Replace each loaded store with ``refresher(store, name)``; the entries, with their embedding
+        models and query caches, stay loaded."""
+        with self._lock:
+            loaded = [(name, entry["vectorstore"], self._load_locks.setdefault(name, threading.Lock()))
+                      for name, entry in self._entries.items()]
+
+        for name, vectorstore, load_lock in loaded:
+            with load_lock:
+                refreshed = self.refresher(vectorstore, name)
+                if refreshed is vectorstore:
+                    continue
+                total_bytes, mapped_bytes = estimate_vectorstore_bytes(refreshed)
+                with self._lock:
+                    entry = self._entries.get(name)
+                    if entry is not None and entry["vectorstore"] is vectorstore:
+                        entry.update(vectorstore=refreshed, bytes=total_bytes, mapped_bytes=mapped_bytes)
+
+    def _evict(self):
+        if self.memory_cap_bytes is None:
+            return
+        while len(self._entries) > 1 and self.total_bytes() > self.memory_cap_bytes:
+            self._entries.popitem(last=False)
+
+    def evict(self, name):
+        with self._lock:
+            return self._entries.pop(name.lower(), None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def total_bytes(self):
+        return sum(entry["bytes"] for entry in self._entries.values())
+
+    def loaded(self):
+        with self._lock:
+            return [
+                {
+                    "emb_model": name,
+                    "documents": entry["vectorstore"].index.ntotal,
+                    "bytes": entry["bytes"],
+                    "mapped_bytes": entry["mapped_bytes"],
+                    "load_seconds": round(entry["load_seconds"], 3),
+                    "last_used": entry["last_used"],
+                    "query_cache": query_cache_stats(entry["vectorstore"]),
+                }
+                for name, entry in reversed(self._entries.items())
+            ]
+
+
+def memory_cap_from_env():
+    cap_mb = os.getenv("VECTORSTORE_MEMORY_CAP_MB")
+    return int(float(cap_mb) * 1024 * 1024) if cap_mb else None
+
+
+vectorstore_registry = VectorstoreRegistry(memory_cap_bytes=memory_cap_from_env())
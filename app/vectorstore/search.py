@@ -0,0 +1,170 @@
+import weakref
+
+import faiss
+import numpy as np
+
+from monitoring.metrics import relaxation_levels, timed
+from vectorstore.segments import SegmentedIndex, merge_results, selector_params
+
+EXACT_SEARCH_MAX_ROWS = 4096
+
+_catalog_positions = weakref.WeakKeyDictionary()
+
+
+def catalog_positions(vectorstore, metadata_columns):
+    """Map FAISS positions to catalog rows (and back) for ``vectorstore``, computed once per store."""
+    cached = _catalog_positions.get(vectorstore)
+    if cached is not None and cached[0] is metadata_columns:
+        return cached[1], cached[2]
+
+    pos_to_row = np.full(vectorstore.index.ntotal, -1, dtype=np.int64)
+    wine_ids = getattr(vectorstore.docstore, "wine_ids", None)
+    if wine_ids is not None:
+        pos_to_row[:] = [metadata_columns.id_to_row.get(wine_id, -1) for wine_id in wine_ids.tolist()]
+    else:
+        for pos, docstore_id in vectorstore.index_to_docstore_id.items():
+            doc = vectorstore.docstore.search(docstore_id)
+            pos_to_row[pos] = metadata_columns.id_to_row.get(doc.metadata.get("id"), -1)
+
+    row_to_pos = np.full(metadata_columns.num_rows, -1, dtype=np.int64)
+    known = pos_to_row >= 0
+    row_to_pos[pos_to_row[known]] = np.flatnonzero(known)
+
+    _catalog_positions[vectorstore] = (metadata_columns, pos_to_row, row_to_pos)
+    return pos_to_row, row_to_pos
+
+
+def embed_queries(vectorstore, queries):
+    """Embed ``queries`` with one batched call (cached per embedding model when available)."""
+    embedding_fn = vectorstore.embedding_function
+    with timed("embedding"):
+        if hasattr(embedding_fn, "embed_queries"):
+            return embedding_fn.embed_queries(queries)
+        return embedding_fn.embed_documents(queries)
+
+
+def as_search_vector(vectorstore, embedding):
+    vector = np.asarray([embedding], dtype=np.float32)
+    if vectorstore._normalize_L2:
+        faiss.normalize_L2(vector)
+    return vector
+
+
+def search_subset(index, vector, positions, k):
+    """Top-``k`` (distances, positions) among ``positions``, exact for small subsets, ID selector otherwise
+    (applied segment by segment for a ``SegmentedIndex``)."""
+    if isinstance(index, SegmentedIndex):
+        positions = positions[index.live_mask[positions]]
+    k = min(k, len(positions))
+    if k == 0:
+        return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+
+    if len(positions) <= EXACT_SEARCH_MAX_ROWS:
+        vectors = index.reconstruct_batch(positions)
+        if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            distances = -(vectors @ vector[0])
+        else:
+            distances = ((vectors - vector[0]) ** 2).sum(axis=1)
+        top = np.argpartition(distances, k - 1)[:k] if k < len(positions) else np.arange(len(positions))
+        top = top[np.argsort(distances[top], kind="stable")]
+        if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            return -distances[top], positions[top]
+        return distances[top], positions[top]
+
+    if isinstance(index, SegmentedIndex):
+        distances, found = [], []
+        for segment, offset, local, _ in index.split(positions):
+            segment_distances, segment_found = search_subset(segment, vector, local, k)
+            distances.append(segment_distances[None, :])
+            found.append(segment_found[None, :] + offset)
+        distances, indices = merge_results(distances, found, k, index.metric_type)
+    else:
+        params = selector_params(index, faiss.IDSelectorBatch(positions))
+        distances, indices = index.search(vector, k, params=params)
+    found = indices[0] >= 0
+    return distances[0][found], indices[0][found]
+
+
+def prefiltered_search_positions(vectorstore, embedding, constraints, k=50):
+    """FAISS positions of the ``k`` nearest rows that satisfy ``constraints``.
+
+    Matches are collected level by level, strictest relaxation first, so selective
+    filters still return their true nearest neighbours instead of whatever happens
+    to survive in an unfiltered top-``k``.
+    """
+    _, row_to_pos = catalog_positions(vectorstore, constraints.columns)
+    vector = as_search_vector(vectorstore, embedding)
+
+    found = np.zeros(vectorstore.index.ntotal, dtype=bool)
+    results = []
+    with timed("faiss_search"):
+        for level in range(constraints.num_levels + 1):
+            positions = row_to_pos[constraints.level_mask(level)]
+            positions = positions[positions >= 0]
+            positions = positions[~found[positions]]
+            _, top_positions = search_subset(vectorstore.index, vector, positions, k - len(results))
+            found[top_positions] = True
+            results.extend(top_positions.tolist())
+            if len(results) >= k:
+                break
+    relaxation_levels.inc(level=level, path="prefilter")
+    return np.asarray(results, dtype=np.int64)
+
+
+def prefiltered_similarity_search(vectorstore, query, constraints, k=50, embedding=None):
+    if embedding is None:
+        with timed("embedding"):
+            embedding = vectorstore.embedding_function.embed_query(query)
+    return hydrate_documents(vectorstore, prefiltered_search_positions(vectorstore, embedding, constraints, k=k))
+
+
+def batched_search(vectorstore, embeddings, k):
+    """One FAISS search for a whole matrix of query vectors; returns (distances, positions), -1 padded."""
+    vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+    if vectorstore._normalize_L2:
+        faiss.normalize_L2(vectors)
+    with timed("faiss_search"):
+        return vectorstore.index.search(vectors, k)
+
+
+def multi_query_search(vectorstore, queries, k, constraints=None):
+    """Positions matrix (one row per query, -1 padded) for ``queries``, embedded in one batch."""
+    embeddings = embed_queries(vectorstore, queries)
+    if constraints is None:
+        return batched_search(vectorstore, embeddings, k)[1]
+
+    positions = np.full((len(queries), k), -1, dtype=np.int64)
+    for i, embedding in enumerate(embeddings):
+        found = prefiltered_search_positions(vectorstore, embedding, constraints, k=k)
+        positions[i, :len(found)] = found
+    return positions
+
+
+class BatchSearch:
+    """Unfiltered nearest neighbours of many query texts in one vectorstore, for batch workloads.
+
+    All texts are embedded in one batched call (through the query cache) and searched as
+    one matrix; strategies then read their top-``k`` from here instead of searching again.
+    """
+
+    def __init__(self, vectorstore, texts, k):
+        self.vectorstore = vectorstore
+        self.k = k
+        texts = list(dict.fromkeys(texts))
+        self._positions = dict(zip(texts, multi_query_search(vectorstore, texts, k))) if texts else {}
+
+    def has(self, text, k):
+        return k <= self.k and text in self._positions
+
+    def positions(self, text, k):
+        """Top-``k`` positions of ``text``, -1 padded like ``multi_query_search``."""
+        return self._positions[text][:k]
+
+    def documents(self, text, k):
+        positions = self.positions(text, k)
+        return hydrate_documents(self.vectorstore, positions[positions >= 0])
+
+
+def hydrate_documents(vectorstore, positions):
+    with timed("hydrate_documents"):
+        return [vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(pos)]) for pos in positions]
@@ -0,0 +1,149 @@
+import os
+
+import faiss
+import numpy as np
+
+from vectorstore.mmap_store import DELETED_FILE, DELTA_DIR, DELTA_VECTORS_FILE, MmapDocstore, PositionIds
+
+
+def selector_params(index, selector):
+    """Search parameters restricting ``index`` to ``selector``; IVF indexes need their own parameter type."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    return faiss.SearchParameters(sel=selector)
+
+
+def merge_results(distances, positions, k, metric_type):
+    """Top-``k`` of several (distances, positions) result matrices over the same queries, -1 padded."""
+    distances = np.concatenate(distances, axis=1)
+    positions = np.concatenate(positions, axis=1)
+    if metric_type == faiss.METRIC_INNER_PRODUCT:
+        keys = np.where(positions >= 0, -distances, np.inf)
+    else:
+        keys = np.where(positions >= 0, distances, np.inf)
+    order = np.argsort(keys, axis=1, kind="stable")[:, :k]
+    distances = np.take_along_axis(distances, order, axis=1)
+    positions = np.take_along_axis(positions, order, axis=1)
+    if positions.shape[1] < k:
+        pad = k - positions.shape[1]
+        worst = -np.inf if metric_type == faiss.METRIC_INNER_PRODUCT else np.inf
+        distances = np.pad(distances, ((0, 0), (0, pad)), constant_values=worst)
+        positions = np.pad(positions, ((0, 0), (0, pad)), constant_values=-1)
+    return distances, positions
+
+
+class SegmentedIndex:
+    """Read-only index over consecutive segments, with some positions excluded from every search.
+
+    The first segment is the index saved by the last full write (flat or approximate), the
+    next one the vectors appended by ingestion since; position ``p`` of segment ``i`` is
+    global position ``offsets[i] + p``. ``dead`` positions (wines deleted or re-embedded)
+    are filtered out with an ID selector. Implements the part of the FAISS index interface
+    the vectorstore and ``search.py`` use.
+    """
+
+    def __init__(self, segments, dead=()):
+        self.segments = list(segments)
+        self.offsets = np.zeros(len(self.segments) + 1, dtype=np.int64)
+        np.cumsum([segment.ntotal for segment in self.segments], out=self.offsets[1:])
+        self.ntotal = int(self.offsets[-1])
+        self.d = self.segments[0].d
+        self.metric_type = self.segments[0].metric_type
+        self.dead = np.unique(np.asarray(dead, dtype=np.int64))
+        self.live_mask = np.ones(self.ntotal, dtype=bool)
+        self.live_mask[self.dead] = False
+
+        # Selectors are immutable, so one per segment is built here and shared by every search.
+        self._selectors = []
+        for i, segment in enumerate(self.segments):
+            local = self.dead[(self.dead >= self.offsets[i]) & (self.dead < self.offsets[i + 1])] - self.offsets[i]
+            if len(local) == 0:
+                self._selectors.append(None)
+            else:
+                batch = faiss.IDSelectorBatch(local)
+                self._selectors.append((batch, faiss.IDSelectorNot(batch)))
+
+    def split(self, positions):
+        """``(segment, offset, local positions, index into positions)`` for each segment ``positions`` fall in."""
+        positions = np.asarray(positions, dtype=np.int64)
+        segment_ids = np.searchsorted(self.offsets, positions, side="right") - 1
+        for i, segment in enumerate(self.segments):
+            where = np.flatnonzero(segment_ids == i)
+            if len(where):
+                yield segment, self.offsets[i], positions[where] - self.offsets[i], where
+
+    def search(self, x, k, params=None):
+        if params is not None:
+            raise NotImplementedError("search each segment with its own parameters (see search.search_subset)")
+        distances, positions = [], []
+        for i, segment in enumerate(self.segments):
+            if segment.ntotal == 0:
+                continue
+            selector = self._selectors[i]
+            if selector is None:
+                found_distances, found = segment.search(x, min(k, segment.ntotal))
+            else:
+                found_distances, found = segment.search(x, min(k, segment.ntotal),
+                                                        params=selector_params(segment, selector[1]))
+            distances.append(found_distances)
+            positions.append(np.where(found >= 0, found + self.offsets[i], -1))
+        if not positions:
+            return merge_results([np.empty((len(x), 0), dtype=np.float32)], [np.empty((len(x), 0), dtype=np.int64)],
+                                 k, self.metric_type)
+        return merge_results(distances, positions, k, self.metric_type)
+
+    def reconstruct_batch(self, positions):
+        vectors = np.empty((len(positions), self.d), dtype=np.float32)
+        for segment, _, local, where in self.split(positions):
+            vectors[where] = segment.reconstruct_batch(local)
+        return vectors
+
+    def reconstruct(self, position):
+        return self.reconstruct_batch([position])[0]
+
+    def reconstruct_n(self, start, count):
+        return self.reconstruct_batch(np.arange(start, start + count))
+
+
+def index_segments(index):
+    return index.segments if isinstance(index, SegmentedIndex) else [index]
+
+
+def load_segmented_index(index, path):
+    """``index`` (the last full write under ``path``) followed by the vectors ingestion appended since,
+    with the positions it deleted hidden; ``index`` itself when there are none.
+
+    Appended vectors are held in memory in a flat index: ingestion compacts them into the
+    main index before they grow large.
+    """
+    delta_vectors = os.path.join(path, DELTA_DIR, DELTA_VECTORS_FILE)
+    segments = [index]
+    if os.path.exists(delta_vectors):
+        delta = faiss.IndexFlat(index.d, index.metric_type)
+        delta.add(np.load(delta_vectors))
+        segments.append(delta)
+    deleted_path = os.path.join(path, DELETED_FILE)
+    deleted = np.load(deleted_path) if os.path.exists(deleted_path) else np.empty(0, dtype=np.int64)
+    if len(segments) == 1 and len(deleted) == 0:
+        return index
+    return SegmentedIndex(segments, deleted)
+
+
+def load_segments(vectorstore, path):
+    """``vectorstore`` (loaded from ``path``) with the wines ingestion appended and deleted since its last full write."""
+    base = vectorstore.index
+    index = load_segmented_index(base, path)
+    if index is base:
+        return vectorstore
+
+    if isinstance(vectorstore.index_to_docstore_id, PositionIds):
+        # MmapDocstore already serves the appended documents after the base ones.
+        vectorstore.index_to_docstore_id = PositionIds(index.ntotal)
+    elif index.ntotal > base.ntotal:
+        appended = MmapDocstore(os.path.join(path, DELTA_DIR))
+        documents = {str(pos): appended.search(pos - base.ntotal) for pos in range(base.ntotal, index.ntotal)}
+        vectorstore.docstore.add(documents)
+        vectorstore.index_to_docstore_id.update(dict(zip(range(base.ntotal, index.ntotal), documents)))
+    vectorstore.index = index
+    return vectorstore
@@ -0,0 +1,239 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DEFAULT_RAW_PATH = "data_processing/winemag-data-130k-v2.csv"
+DEFAULT_SHARDS = "data_processing/reviews_scraping/wine_reviews_*.csv"
+DEFAULT_CSV_PATH = "data_processing/wine_data_final.csv"
+DEFAULT_CACHE_DIR = "data_processing/.etl_cache"
+MANIFEST_FILE = "manifest.json"
+ETL_VERSION = 1  # bump when the transformation changes, so every shard is processed again
+
+REVIEW_COLUMNS = ["title", "id"] + [f"review_{i + 1}" for i in range(10)]
+CATEGORICAL_COLUMNS = ["country", "province", "region_1", "region_2", "taster_name", "taster_twitter_handle",
+                       "variety", "winery", "wine_color"]
+ARROW_TYPES = {"id": pa.int64(), "points": pa.int64(), "price": pa.float64(), "vintage": pa.float64()}
+PANDAS_DTYPES = {"id": "Int64", "points": "Int64", "price": "float64", "vintage": "float64"}
+
+# Shared with data_processing.ipynb, so the mapping is maintained in one place.
+VARIETY_COLORS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "variety_colors.json")
+
+
+def natural_key(path):
+    """Sort key putting ``wine_reviews_9.csv`` before ``wine_reviews_10.csv``."""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", path)]
+
+
+def file_sha256(path, known=None):
+    """Content hash of ``path``; reused from ``known`` (a previous manifest entry) while size and mtime match."""
+    stat = os.stat(path)
+    if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+        return known
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+
+
+def load_variety_colors(path=VARIETY_COLORS_PATH):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_manifest(cache_dir):
+    path = os.path.join(cache_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {"files": {}, "parts": None, "outputs": None}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(cache_dir, manifest):
+    path = os.path.join(cache_dir, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def arrow_schema(columns):
+    return pa.schema([(column, pa.dictionary(pa.int32(), pa.string()) if column in CATEGORICAL_COLUMNS
+                       else ARROW_TYPES.get(column, pa.string())) for column in columns])
+
+
+def cast_columns(df):
+    """Column dtypes shared by every chunk, so CSV chunks format alike and Parquet row groups share a schema."""
+    for column in df.columns:
+        if column in CATEGORICAL_COLUMNS:
+            df[column] = df[column].astype("category")
+        elif column in PANDAS_DTYPES:
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype(PANDAS_DTYPES[column])
+    return df
+
+
+def raw_columns(raw_path):
+    return [column for column in pd.read_csv(raw_path, nrows=0).columns if not column.startswith("Unnamed: ")]
+
+
+def first_seen(values, seen):
+    """Mask of the values seen neither earlier in ``values`` nor in ``seen``, which they are added to."""
+    keep = []
+    for value in values.tolist():
+        keep.append(value not in seen)
+        seen.add(value)
+    return keep
+
+
+def build_raw_lookup(raw_path, lookup_path, chunksize):
+    """Stream the raw WineMag CSV into a Parquet file holding the first row of every title.
+
+    This is the row the notebook's left merge followed by ``drop_duplicates("title")`` keeps.
+    Only the titles seen so far are held in memory.
+    """
+    columns = raw_columns(raw_path)
+    dtypes = {column: PANDAS_DTYPES.get(column, "str") for column in columns}
+    schema = arrow_schema(columns)
+    seen = set()
+    with pq.ParquetWriter(lookup_path + ".tmp", schema) as writer:
+        for chunk in pd.read_csv(raw_path, usecols=columns, dtype=dtypes, chunksize=chunksize):
+            chunk = chunk[chunk["title"].notna()]
+            chunk = chunk[first_seen(chunk["title"], seen)]
+            writer.write_table(pa.Table.from_pandas(cast_columns(chunk[columns]), schema=schema, preserve_index=False))
+    os.replace(lookup_path + ".tmp", lookup_path)
+    print(f"raw: {len(seen)} distinct titles from {raw_path}")
+
+
+def read_shard(path):
+    reviews = pd.read_parquet(path) if path.endswith(".parquet") else pd.read_csv(path, dtype=str)
+    return reviews.reindex(columns=REVIEW_COLUMNS)
+
+
+def extract_vintage(titles):
+    return pd.to_numeric(titles.str.extract(r"(\b\d{4}\b)", expand=False), errors="coerce")
+
+
+def process_shard(shard_path, lookup_path, columns, part_path, variety_colors):
+    """Join one review shard with its wines' raw rows, derive ``vintage`` and ``wine_color``, save it as a part.
+
+    Duplicates are dropped later, across all shards, when the parts are assembled.
+    """
+    reviews = read_shard(shard_path)
+    titles = reviews["title"].dropna().unique().tolist()
+    raw = pd.read_parquet(lookup_path, filters=[("title", "in", titles)]) if titles else None
+    if raw is None or raw.empty:
+        raw = pd.DataFrame(columns=columns)
+    merged = reviews.merge(raw, how="left", on="title")
+    merged["vintage"] = extract_vintage(merged["title"])
+    merged["wine_color"] = merged["variety"].astype("object").map(variety_colors).fillna("Unknown")
+    output_columns = REVIEW_COLUMNS + [column for column in columns if column != "title"] + ["vintage", "wine_color"]
+    merged = cast_columns(merged[output_columns])
+    pq.write_table(pa.Table.from_pandas(merged, schema=arrow_schema(output_columns), preserve_index=False),
+                   part_path + ".tmp")
+    os.replace(part_path + ".tmp", part_path)
+
+
+def assemble(part_paths, csv_path, parquet_path):
+    """Stream the parts, in shard order, into the final CSV and Parquet files.
+
+    Same rows as the notebook: the first row of every wine id, then the first of every title.
+    Only the ids and titles seen so far are held in memory.
+    """
+    seen_ids, seen_titles = set(), set()
+    rows = 0
+    writer = None
+    with open(csv_path + ".tmp", "w", newline="") as csv_file:
+        for part_path in part_paths:
+            part = pq.read_table(part_path)
+            df = cast_columns(part.to_pandas())
+            df = df[first_seen(df["id"], seen_ids)]
+            df = df[first_seen(df["title"], seen_titles)]
+            df.to_csv(csv_file, header=csv_file.tell() == 0, index=False)
+            if parquet_path:
+                writer = writer or pq.ParquetWriter(parquet_path + ".tmp", part.schema)
+                writer.write_table(pa.Table.from_pandas(df, schema=part.schema, preserve_index=False))
+            rows += len(df)
+    if writer is not None:
+        writer.close()
+        os.replace(parquet_path + ".tmp", parquet_path)
+    os.replace(csv_path + ".tmp", csv_path)
+    return rows
+
+
+def build_dataset(raw_path, shard_paths, csv_path=DEFAULT_CSV_PATH, parquet_path=None, cache_dir=DEFAULT_CACHE_DIR,
+                  chunksize=20000, force=False, variety_colors_path=VARIETY_COLORS_PATH):
+    """Build the catalog from the raw WineMag CSV and the review shards, redoing only what changed.
+
+    Every shard is turned into a cached Parquet part named after the hashes of its content,
+    of the raw CSV, of the variety colors and of ``ETL_VERSION``, so a rerun only processes
+    new or modified shards (all of them when the raw data, the colors or the transformation
+    changed), and the outputs are only rewritten when the set of parts differs from the
+    last run's.
+    """
+    os.makedirs(os.path.join(cache_dir, "parts"), exist_ok=True)
+    manifest = load_manifest(cache_dir)
+    shard_paths = sorted(shard_paths, key=natural_key)
+    if not shard_paths:
+        raise ValueError("No review shards to process")
+    files = {path: file_sha256(path, manifest["files"].get(path))
+             for path in [raw_path, variety_colors_path] + shard_paths}
+    variety_colors = load_variety_colors(variety_colors_path)
+
+    raw_sha = files[raw_path]["sha256"]
+    lookup_path = os.path.join(cache_dir, f"raw-{raw_sha[:16]}.parquet")
+    if force or not os.path.exists(lookup_path):
+        build_raw_lookup(raw_path, lookup_path, chunksize)
+    columns = raw_columns(raw_path)
+
+    parts, processed = [], 0
+    for shard_path in shard_paths:
+        key = hashlib.sha256(f"{ETL_VERSION}:{raw_sha}:{files[variety_colors_path]['sha256']}:"
+                             f"{files[shard_path]['sha256']}".encode()).hexdigest()[:16]
+        part_path = os.path.join(cache_dir, "parts", f"{key}.parquet")
+        if force or not os.path.exists(part_path):
+            process_shard(shard_path, lookup_path, columns, part_path, variety_colors)
+            processed += 1
+        parts.append(part_path)
+
+    outputs = [csv_path, parquet_path]
+    rows = None
+    if force or manifest["parts"] != parts or manifest["outputs"] != outputs or \
+            not all(os.path.exists(path) for path in outputs if path):
+        rows = assemble(parts, csv_path, parquet_path)
+        print(f"wrote {rows} wines to {', '.join(path for path in outputs if path)}")
+    else:
+        print("outputs are up to date")
+
+    for path in glob.glob(os.path.join(cache_dir, "raw-*.parquet")) + glob.glob(os.path.join(cache_dir, "parts", "*")):
+        if path != lookup_path and path not in parts:
+            os.remove(path)
+    save_manifest(cache_dir, {"version": ETL_VERSION, "files": files, "parts": parts, "outputs": outputs})
+    return {"shards": len(shard_paths), "processed": processed, "rows": rows}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Merge the raw WineMag data with the scraped review shards into "
+                                                 "the catalog CSV (and Parquet), reprocessing only changed shards.")
+    parser.add_argument("--raw", default=DEFAULT_RAW_PATH)
+    parser.add_argument("--shards", nargs="+", default=[DEFAULT_SHARDS],
+                        help="review shard files or glob patterns (CSV or Parquet, title/id/review_1..review_10)")
+    parser.add_argument("--output", default=DEFAULT_CSV_PATH)
+    parser.add_argument("--parquet", help="Parquet output (default: the CSV path with a .parquet extension)")
+    parser.add_argument("--no-parquet", action="store_true")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--chunksize", type=int, default=20000, help="rows of the raw CSV read at a time")
+    parser.add_argument("--force", action="store_true", help="ignore the cache and reprocess everything")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    shard_paths = sorted({path for pattern in args.shards for path in glob.glob(pattern)})
+    parquet_path = None if args.no_parquet else args.parquet or os.path.splitext(args.output)[0] + ".parquet"
+    print(build_dataset(args.raw, shard_paths, args.output, parquet_path, args.cache_dir, args.chunksize, args.force))
@@ -1,26 +1,44 @@
-import pandas as pd
-import requests
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
 import time
+from urllib.parse import quote_plus
+
+import aiohttp
+import pandas as pd
 from bs4 import BeautifulSoup
-import logging
 from tqdm import tqdm
 
+BASE_URL = "https://www.vivino.com"
+HEADERS = {
+    "User-Agent": ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
+                   "AppleWebKit/537.36 (KHTML, like Gecko) "
+                   "Chrome/114.0.0.0 Safari/537.36")
+}
+NUM_REVIEWS = 10
+RECORDS_FILE = "reviews.jsonl"
+LEDGER_FILE = "progress.jsonl"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 
 # -------------------------------
 # Setup Logging: Log to file and console
 # -------------------------------
-logging.basicConfig(
-    level=logging.INFO,
-    filename='wine_reviews_1.log',
-    filemode='a',  # append mode
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+def setup_logging(log_path):
+    logging.basicConfig(
+        level=logging.INFO,
+        filename=log_path,
+        filemode='a',  # append mode
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
 
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console.setFormatter(formatter)
-logging.getLogger().addHandler(console)
+    console = logging.StreamHandler()
+    console.setLevel(logging.WARNING)  # progress is shown by tqdm
+    console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logging.getLogger().addHandler(console)
 
 
 # --------------------
@@ -42,141 +60,282 @@ def load_and_clean_data(csv_path):
     logging.info("DataFrame shape after dropna: %s", df.shape)
     return df
 
+
 # --------------------------------
-# Define the Helper Functions
+# Rate Limiting
 # --------------------------------
-def get_wine_id(wine_title):
-    """Search for the wine on Vivino and extract its Wine ID."""
-    search_url = f"https://www.vivino.com/search/wines?q={wine_title.replace(' ', '+')}"
-    logging.info("---------------------------------------------------------------")
-    logging.info("Searching: %s", search_url)
+class TokenBucket:
+    """Request rate limiter shared by all workers, adapting to the server.
+
+    Allows ``rate`` requests per second with bursts of ``capacity``. A 429 halves the rate
+    (down to ``min_rate``) and pauses everyone for the server's ``Retry-After``; the other
+    429s of requests already in flight during that pause don't halve it again. Every
+    success then adds back ``recovery`` of ``max_rate``.
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=0.1, max_rate=None, recovery=0.02):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate
+        self.recovery = recovery
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
-    headers = {
-        "User-Agent": ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
-                       "AppleWebKit/537.36 (KHTML, like Gecko) "
-                       "Chrome/114.0.0.0 Safari/537.36")
-    }
+    def throttled(self, retry_after):
+        now = time.monotonic()
+        if now >= self.paused_until:
+            self.rate = max(self.min_rate, self.rate / 2)
+            logging.warning("Rate limited; pausing %.1fs, rate now %.2f req/s", retry_after, self.rate)
+        self.tokens = 0
+        self.paused_until = max(self.paused_until, now + retry_after)
 
-    response = requests.get(search_url, headers=headers)
+    def succeeded(self):
+        self.rate = min(self.max_rate, self.rate + self.recovery * self.max_rate)
 
-    if response.status_code != 200:
-        logging.error("Failed to load search page. Status Code: %s", response.status_code)
-        return None, response.status_code
 
-    soup = BeautifulSoup(response.text, "html.parser")
+def retry_delay(response, attempt, base_delay):
+    retry_after = response.headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return base_delay * 2 ** attempt * (0.5 + random.random())
+
+
+async def fetch(session, bucket, url, as_json=False, max_retries=6, base_delay=2.0):
+    """GET ``url`` under the shared rate limit, retrying 429s and server errors with backoff.
+
+    Returns ``(status, body)``; the status of the last attempt once retries are exhausted.
+    """
+    for attempt in range(max_retries + 1):
+        await bucket.acquire()
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    bucket.succeeded()
+                    return 200, await (response.json(content_type=None) if as_json else response.text())
+                if response.status not in RETRY_STATUSES or attempt == max_retries:
+                    return response.status, None
+                delay = retry_delay(response, attempt, base_delay)
+                if response.status == 429:
+                    bucket.throttled(delay)
+                logging.info("HTTP %s for %s; retry %s in %.1fs", response.status, url, attempt + 1, delay)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == max_retries:
+                logging.error("Request failed for %s: %s", url, e)
+                return None, None
+            delay = base_delay * 2 ** attempt
+            logging.info("%s for %s; retry %s in %.1fs", type(e).__name__, url, attempt + 1, delay)
+        await asyncio.sleep(delay)
+
+
+# --------------------------------
+# Define the Helper Functions
+# --------------------------------
+def parse_wine_id(html):
+    """Vivino wine ID of a search result page, when it has exactly one result."""
+    soup = BeautifulSoup(html, "html.parser")
     wine_results = soup.find_all("div", class_="default-wine-card")
+    if len(wine_results) == 1 and wine_results[0].has_attr("data-wine"):
+        return wine_results[0]["data-wine"]
+    return None
 
-    if len(wine_results) == 1:
-        wine_div = wine_results[0]
-        if wine_div and wine_div.has_attr("data-wine"):
-            wine_id = wine_div["data-wine"]
-            logging.info("Found wine ID: %s", wine_id)
-            return wine_id, response.status_code
-    else:
-        logging.warning("Multiple (%s) results found. Returning None.", len(wine_results))
-        return None, response.status_code
+
+async def get_wine_id(session, bucket, base_url, wine_title, **retry):
+    """Search for the wine on Vivino and extract its Wine ID."""
+    status, html = await fetch(session, bucket, f"{base_url}/search/wines?q={quote_plus(wine_title)}", **retry)
+    if status != 200:
+        logging.error("Failed to load search page for %s. Status Code: %s", wine_title, status)
+        return None, status
+    return parse_wine_id(html), status
 
 
-def get_vivino_reviews(wine_id, per_page=10, language="en"):
+async def get_vivino_reviews(session, bucket, base_url, wine_id, per_page=NUM_REVIEWS, language="en", **retry):
     """Fetch reviews from Vivino's hidden API."""
-    api_url = f"https://www.vivino.com/api/wines/{wine_id}/reviews?per_page={per_page}&language={language}"
-    headers = {
-        "User-Agent": ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
-                       "AppleWebKit/537.36 (KHTML, like Gecko) "
-                       "Chrome/114.0.0.0 Safari/537.36")
-    }
-    response = requests.get(api_url, headers=headers)
-
-    if response.status_code != 200:
-        logging.error("API request failed for wine_id %s. Status Code: %s", wine_id, response.status_code)
-        return None, response.status_code
-
-    reviews_json = response.json()
-    if reviews_json:
-        return reviews_json, response.status_code
-    else:
-        logging.info("No reviews found for wine_id %s.", wine_id)
-        return None, response.status_code
-
-def process_json(wine_id, wine_reviews, wine_title, reviews_df=None):
-    if reviews_df is None:
-        columns = ["title", "id"] + [f"review_{i+1}" for i in range(10)]
-        reviews_df = pd.DataFrame(columns=columns)
-
-    reviews_list = [(rev["note"], rev["rating"]) for rev in wine_reviews.get("reviews", [])]
-    while len(reviews_list) < 10:
-        reviews_list.append((None, None))
-    new_row = pd.DataFrame([[wine_title, wine_id] + reviews_list], columns=reviews_df.columns)
-    reviews_df = pd.concat([reviews_df, new_row], ignore_index=True)
-    return reviews_df
+    url = f"{base_url}/api/wines/{wine_id}/reviews?per_page={per_page}&language={language}"
+    status, reviews_json = await fetch(session, bucket, url, as_json=True, **retry)
+    if status != 200:
+        logging.error("API request failed for wine_id %s. Status Code: %s", wine_id, status)
+        return None, status
+    return reviews_json, status
 
 
-def gather_reviews(title, reviews_df=None):
-    wine_id, status_code_1 = get_wine_id(title)
-    if wine_id:
-        logging.info("Wine matched: %s", wine_id)
-    elif status_code_1 == 200:
+async def gather_reviews(session, bucket, base_url, title, **retry):
+    """One ledger entry for the wine ``title``: matched (with its reviews), not_matched, no_reviews or error.
+
+    ``retry`` (``max_retries``, ``base_delay``) is passed on to every ``fetch``.
+    """
+    wine_id, status = await get_wine_id(session, bucket, base_url, title, **retry)
+    if status != 200:
+        return {"title": title, "status": "error", "http_status": status}
+    if wine_id is None:
         logging.info("Wine not matched for title: %s", title)
-        return reviews_df
-    else:
-        return reviews_df, 'error'
+        return {"title": title, "status": "not_matched"}
 
-    wine_reviews, status_code_2 = get_vivino_reviews(wine_id)
-    if wine_reviews:
-        logging.info("Reviews gathered for wine_id: %s", wine_id)
-    elif status_code_1 == 200:
+    wine_reviews, status = await get_vivino_reviews(session, bucket, base_url, wine_id, **retry)
+    if status != 200:
+        return {"title": title, "id": wine_id, "status": "error", "http_status": status}
+    reviews = [(rev["note"], rev["rating"]) for rev in (wine_reviews or {}).get("reviews", [])]
+    if not reviews:
         logging.info("No reviews found for wine_id: %s", wine_id)
-        return reviews_df
-    else:
-        return reviews_df, 'error'
+        return {"title": title, "id": wine_id, "status": "no_reviews"}
+    return {"title": title, "id": wine_id, "status": "matched", "reviews": reviews[:NUM_REVIEWS]}
+
+
+# --------------------------------
+# Output and Progress Ledger
+# --------------------------------
+def append_jsonl(f, record):
+    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    f.flush()
+
+
+def read_jsonl(path):
+    """Records of an append-only JSONL file; a line cut short by a crash is skipped."""
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logging.warning("Skipping truncated line in %s", path)
+    return records
+
+
+def completed_titles(output_dir):
+    """Titles a previous run finished; errors are not recorded, so those wines are retried.
+
+    Entries are keyed by title, which is what the search is made with, so the ledger stays
+    valid when rows are added to or removed from the input CSV.
+    """
+    entries = read_jsonl(os.path.join(output_dir, LEDGER_FILE))
+    legacy = sum("title" not in entry for entry in entries)
+    if legacy:
+        logging.warning("Ignoring %s ledger entries keyed by row position; those wines are scraped again", legacy)
+    return {entry["title"] for entry in entries if "title" in entry}
+
 
-    reviews_df = process_json(wine_id, wine_reviews, title, reviews_df)
+def export_reviews(output_dir, path, titles=None):
+    """Write the matched wines as one row each (title, id, review_1..review_10), as CSV or Parquet.
+
+    Rows follow ``titles`` (the input order) when given, title order otherwise. Missing
+    reviews are padded with ``(None, None)``, like the review shards always were.
+    """
+    records = {record["title"]: record for record in read_jsonl(os.path.join(output_dir, RECORDS_FILE))
+               if "title" in record}
+    order = [title for title in dict.fromkeys(titles) if title in records] if titles is not None else sorted(records)
+    columns = ["title", "id"] + [f"review_{i + 1}" for i in range(NUM_REVIEWS)]
+    rows = []
+    for title in order:
+        record = records[title]
+        reviews = [str(tuple(review)) for review in record["reviews"]]
+        rows.append([record["title"], record["id"]] + reviews + [str((None, None))] * (NUM_REVIEWS - len(reviews)))
+    reviews_df = pd.DataFrame(rows, columns=columns)
+    if path.endswith(".parquet"):
+        reviews_df.to_parquet(path, index=False)
+    else:
+        reviews_df.to_csv(path, index=False)
+    logging.info("Exported %s wines to %s", len(reviews_df), path)
     return reviews_df
 
+
 # ---------------------
 # Main Loop Execution
 # ---------------------
-# Since the reviews extraction is a long process due to rate limiting on the Vivino web page (check the .log file), the scraping was done thousand by thousand and later merged into one document that you can see _(scraped_reviews_final.csv)
+async def scrape(titles, output_dir, base_url=BASE_URL, workers=8, rate=2.0, max_retries=6, timeout=30,
+                 base_delay=2.0):
+    """Scrape ``titles`` with ``workers`` concurrent tasks, resuming from the ledger.
+
+    Each finished wine is appended to ``progress.jsonl`` (and, when matched, to ``reviews.jsonl``
+    first), so an interrupted run picks up where it stopped. A title is searched once however
+    often it appears. Returns the count per status.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    done = completed_titles(output_dir)
+    titles = list(dict.fromkeys(titles))
+    pending = [title for title in titles if title not in done]
+    logging.info("%s wines to scrape, %s already done", len(pending), len(titles) - len(pending))
+
+    bucket = TokenBucket(rate)
+    queue = asyncio.Queue()
+    for item in pending:
+        queue.put_nowait(item)
+    counts = {}
+
+    connector = aiohttp.TCPConnector(limit=workers)  # one keep-alive pool shared by all workers
+    timeout = aiohttp.ClientTimeout(total=timeout)
+    with open(os.path.join(output_dir, RECORDS_FILE), "a", encoding="utf-8") as records, \
+            open(os.path.join(output_dir, LEDGER_FILE), "a", encoding="utf-8") as ledger, \
+            tqdm(total=len(pending)) as progress:
+        async with aiohttp.ClientSession(connector=connector, headers=HEADERS, timeout=timeout) as session:
+            async def worker():
+                while True:
+                    try:
+                        title = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    entry = await gather_reviews(session, bucket, base_url, title, max_retries=max_retries,
+                                                 base_delay=base_delay)
+                    counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+                    if entry["status"] == "matched":
+                        append_jsonl(records, entry)
+                    if entry["status"] != "error":
+                        append_jsonl(ledger, {key: entry[key] for key in ("title", "status")})
+                    progress.update(1)
+                    progress.set_postfix(counts, refresh=False)
+
+            await asyncio.gather(*(worker() for _ in range(workers)))
+    logging.info("Review gathering completed: %s", counts)
+    return counts
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scrape Vivino reviews for the wines of the WineMag dataset.")
+    parser.add_argument("--csv", default="winemag-data-130k-v2.csv")
+    parser.add_argument("--output-dir", default="scraped_reviews")
+    parser.add_argument("--start", type=int, default=0, help="first row (after cleaning) to scrape")
+    parser.add_argument("--limit", type=int, help="number of rows to scrape (default: all)")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=2.0, help="requests per second across all workers")
+    parser.add_argument("--max-retries", type=int, default=6)
+    parser.add_argument("--base-url", default=BASE_URL, help="e.g. a local stub server for testing")
+    parser.add_argument("--export", help="also write the scraped reviews to this .csv or .parquet file")
+    parser.add_argument("--log", default="wine_reviews.log")
+    return parser.parse_args()
+
+
 def main():
-    csv_path = pd.read_csv("winemag-data-130k-v2.csv")
-    df = load_and_clean_data(csv_path)
-    names = df['title']
-    names_to_process = names.iloc[35750:35750+2000]
-
-    reviews_df = None
-    file_count = 98
-
-    check = 0
-
-    for idx, name in zip(range(35751, 35751 + len(names_to_process)), tqdm(names_to_process, total=len(names_to_process))):
-        print(f"\nProcessing wine #{idx}: {name}")
-        backoff = 8
-        while True:
-            result = gather_reviews(name, reviews_df)
-            if isinstance(result, tuple):
-                logging.info("Error processing %s (possibly due to rate limiting). Retrying in %s seconds...", name, backoff)
-                time.sleep(backoff)
-                backoff *= 2
-            else:
-                reviews_df = result
-                break
-        check += 1
-
-        # Every 1,000 gathered reviews, write the output to a CSV file and reset the DataFrame.
-        if reviews_df is not None and check >= 500:
-            check = 0
-            filename = f"wine_reviews_{file_count}.csv"
-            reviews_df.to_csv(filename, index=False)
-            logging.info("Saved %s reviews to %s", len(reviews_df), filename)
-            file_count += 1
-            reviews_df = None
-
-    if reviews_df is not None and not reviews_df.empty:
-        filename = f"wine_reviews_{file_count}.csv"
-        reviews_df.to_csv(filename, index=False)
-        logging.info("Final batch: Saved %s reviews to %s", len(reviews_df), filename)
-
-    logging.info("Review gathering completed.")
+    args = parse_args()
+    setup_logging(args.log)
+    df = load_and_clean_data(args.csv)
+    titles = df['title'].tolist()
+    stop = len(titles) if args.limit is None else args.start + args.limit
+    counts = asyncio.run(scrape(titles[args.start:stop], args.output_dir, base_url=args.base_url,
+                                workers=args.workers, rate=args.rate, max_retries=args.max_retries))
+    print(counts)
+    if args.export:
+        export_reviews(args.output_dir, args.export, titles)
+
 
 if __name__ == '__main__':
     main()
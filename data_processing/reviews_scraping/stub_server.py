@@ -0,0 +1,60 @@
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+
+from aiohttp import web
+
+
+# Local stand-in for the two Vivino endpoints the scraper uses, to try it without hitting the site:
+#   python stub_server.py --port 8081 --max-rps 20
+#   python scrape_reviews.py --base-url http://localhost:8081 ...
+def wine_id(title):
+    return str(int(hashlib.md5(title.encode("utf-8")).hexdigest()[:8], 16))
+
+
+def make_app(max_rps=None, error_rate=0.0, latency=0.0):
+    window = {"second": 0, "count": 0}
+
+    @web.middleware
+    async def limits(request, handler):
+        if latency:
+            await asyncio.sleep(latency)
+        if max_rps is not None:
+            second = int(time.monotonic())
+            if second != window["second"]:
+                window.update(second=second, count=0)
+            window["count"] += 1
+            if window["count"] > max_rps:
+                return web.Response(status=429, headers={"Retry-After": "1"})
+        if random.random() < error_rate:
+            return web.Response(status=503)
+        return await handler(request)
+
+    async def search(request):
+        title = request.query.get("q", "")
+        # Titles containing "ambiguous" match several wines, like real searches sometimes do.
+        ids = [wine_id(title)] * (2 if "ambiguous" in title.lower() else 1)
+        cards = "".join(f'<div class="default-wine-card" data-wine="{i}"></div>' for i in ids)
+        return web.Response(text=f"<html><body>{cards}</body></html>", content_type="text/html")
+
+    async def reviews(request):
+        count = int(request.match_info["wine_id"]) % 12
+        per_page = int(request.query.get("per_page", 10))
+        return web.json_response({"reviews": [{"note": f"Review {i} of wine {request.match_info['wine_id']}",
+                                               "rating": 3.0 + i % 3} for i in range(min(count, per_page))]})
+
+    app = web.Application(middlewares=[limits])
+    app.add_routes([web.get("/search/wines", search), web.get("/api/wines/{wine_id}/reviews", reviews)])
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub of the Vivino search page and reviews API.")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--max-rps", type=int, help="answer 429 beyond this many requests per second")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    args = parser.parse_args()
+    web.run_app(make_app(args.max_rps, args.error_rate, args.latency), port=args.port)
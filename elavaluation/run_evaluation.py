@@ -0,0 +1,342 @@
+import argparse
+import copy
+import json
+import math
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from llm_setup.llm_clients import UsageTrackingClient
+from llm_setup.setup_llm import set_llm_cache
+from rag_methods.context_builder import DEFAULT_CONTEXT_TOKENS
+from rag_methods.rag import RAG, EmbeddingModel, RequestConfig, RetrievalStrategy, options
+
+EVALUATION_DIR = os.path.dirname(os.path.abspath(__file__))
+CATALOG_PATH = "data_processing/wine_data_final.csv"
+
+SUITES = {
+    "llm_labels": {
+        "configs": os.path.join(EVALUATION_DIR, "evaluation_configs.json"),
+        "by_cat": "{name}_metrics_by_cat.csv",
+        "average": "{name}_avg_metrics.csv",
+        "random": "random_metrics_llm_labels.csv",
+    },
+    "journal": {
+        "configs": os.path.join(EVALUATION_DIR, "evaluation_configs_real.json"),
+        "by_cat": "{name}_journal_by_cat.csv",
+        "average": "{name}_journal_average.csv",
+        "random": "random_metrics_journal.csv",
+    },
+}
+EMBEDDING_MODEL_NAMES = {
+    EmbeddingModel.MPNET: "all-mpnet-base-v2",
+    EmbeddingModel.ROBERTA: "all-roberta-large-v1",
+    EmbeddingModel.OPENAI: "text-embedding-3-large",
+}
+METHOD_LABELS = {"naive": "naive", "hybrid": "hybrid", "hyde": "HyDE", "fusion": "fusion"}
+METRIC_GROUPS = ["Precision", "NDCG", "MRR", "Context"]
+STAGES = ["understanding", "retrieval", "reference", "generation", "total"]
+
+_NUM_RANGE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*-\s*(\d+(?:\.\d+)?)\s*$")
+_NUM_CMP = re.compile(r"^\s*(>=|<=|>|<)\s*(\d+(?:\.\d+)?)\s*$")
+
+
+def load_evaluation_frame(catalog_path, labels_path, journal_path):
+    """The labeled wines of the catalog with the wine-journal top-100 flags, as in evaluation.ipynb."""
+    df = pd.read_csv(catalog_path)
+    labels = pd.read_csv(labels_path)
+    label_columns = [col for col in labels.columns if col != "id"]
+    df = df.merge(labels, on="id", how="inner")
+    df[label_columns] = df[label_columns].fillna(0).astype(int)
+
+    journal = pd.read_csv(journal_path)
+    df = df.merge(journal, how="left", left_on="id", right_on="id_dataset", suffixes=("_catalog", ""))
+    df["is_in journal"] = df["top100_year"].notna().astype(int)
+    df["is_top_red"] = ((df["color"] == "red") & df["top100_year"].notna()).astype(int)
+    df["is_top_white"] = ((df["color"] == "white") & df["top100_year"].notna()).astype(int)
+    return df
+
+
+def _coerce_numeric(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.search(r"[-+]?\d*\.?\d+", str(value))
+    return float(match.group()) if match else math.nan
+
+
+def field_mask(df, field, value):
+    """Rows of ``df`` whose ``field`` satisfies ``value``: 0/1 flags, "lo-hi" ranges, ">= n" comparisons or text."""
+    col = df[field]
+    if value in {"1", "0"} and col.dropna().astype(str).isin({"0", "1", "True", "False"}).all():
+        return col.astype(bool) == (value == "1")
+
+    match = _NUM_RANGE.match(value)
+    if match:
+        lo, hi = map(float, match.groups())
+        numbers = col.map(_coerce_numeric)
+        return (numbers >= lo) & (numbers <= hi)
+
+    match = _NUM_CMP.match(value)
+    if match:
+        op, num = match.group(1), float(match.group(2))
+        numbers = col.map(_coerce_numeric)
+        return {">": numbers > num, ">=": numbers >= num, "<": numbers < num, "<=": numbers <= num}[op]
+
+    return col.astype(str).str.lower() == str(value).lower()
+
+
+def relevant_ids(df, fields, values):
+    mask = pd.Series(True, index=df.index)
+    for field, value in zip(fields, values):
+        mask &= field_mask(df, field, value)
+    return set(df.loc[mask, "id"].astype(str))
+
+
+def retrieval_metrics(relevance, total_relevant, k):
+    """Precision@k, NDCG@k, MRR and Context@5 of a ranked 0/1 relevance list (as in evaluation.ipynb)."""
+    dcg = sum(rel / math.log2(i + 2) for i, rel in enumerate(relevance[:k]))
+    idcg = sum(1 / math.log2(i + 2) for i in range(min(total_relevant, k)))
+    first_hit = next((i for i, rel in enumerate(relevance) if rel), None)
+    return {
+        f"Precision@{k}": sum(relevance[:k]) / k,
+        f"NDCG@{k}": dcg / idcg if idcg > 0 else 0,
+        "MRR": 1 / (first_hit + 1) if first_hit is not None else 0,
+        "Context@5": 1 if sum(relevance[:5]) > 0 else 0,
+    }
+
+
+def random_baseline_metrics(k, relevant, total):
+    p = relevant / total if total else 0.0
+    return {
+        f"Precision@{k}": p,
+        "MRR": sum(p * (1 - p) ** (i - 1) / i for i in range(1, k + 1)),
+        f"NDCG@{k}": p,
+        "Context@5": 1 - (1 - p) ** 5,
+    }
+
+
+def evaluate_query(rag, query, config, relevant, k, generate=False):
+    """Runs the pipeline stage by stage; returns the retrieval metrics and the seconds spent per stage."""
+    timings = {}
+    catalog = rag.catalog
+    start = time.perf_counter()
+    intent_future, matched_metadata, rewritten_query = rag.understand_query(query, single_call=config.single_call,
+                                                                            catalog=catalog)
+    timings["understanding"] = time.perf_counter() - start
+
+    stage_start = time.perf_counter()
+    retrieval_context = rag.retrieve(rewritten_query, matched_metadata, config, catalog=catalog)
+    timings["retrieval"] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    similar_wine = rag.resolve_reference(intent_future, retrieval_context)
+    timings["reference"] = time.perf_counter() - stage_start
+
+    if generate:
+        stage_start = time.perf_counter()
+        rag.get_final_recommendation(retrieval_context, query, reference_doc=similar_wine,
+                                     reference_wine_present=similar_wine is not None,
+                                     num_results=config.num_results, context_tokens=config.context_tokens)
+        timings["generation"] = time.perf_counter() - stage_start
+    timings["total"] = time.perf_counter() - start
+
+    docs = [doc for docs in retrieval_context.values() for doc in docs][:k]
+    relevance = [1 if str(doc.metadata.get("id")) in relevant else 0 for doc in docs]
+    return retrieval_metrics(relevance, len(relevant), k), timings
+
+
+def latency_summary(timings):
+    summary = {}
+    for stage in STAGES:
+        values = np.asarray([t[stage] for t in timings if stage in t]) * 1000
+        if len(values):
+            summary[stage] = {"p50_ms": round(float(np.percentile(values, 50)), 2),
+                              "p95_ms": round(float(np.percentile(values, 95)), 2),
+                              "max_ms": round(float(values.max()), 2)}
+    return summary
+
+
+def average_by_category(per_query, methods):
+    """``{method: {category: {metric: mean}}}`` -> notebook layout: methods x (category, metric) columns."""
+    frames = {}
+    for category in next(iter(per_query.values())):
+        frames[category] = pd.DataFrame({METHOD_LABELS[method]: pd.DataFrame(per_query[method][category]).mean()
+                                         for method in methods}).T
+    return pd.concat(frames, axis=1)
+
+
+def average_metrics_per_method(by_cat):
+    averages = {group: by_cat.loc[:, [col for col in by_cat.columns if col[1].startswith(group)]].mean(axis=1)
+                for group in METRIC_GROUPS}
+    return pd.DataFrame(averages)[METRIC_GROUPS]
+
+
+def run(args):
+    if args.llm == "stub":
+        os.environ["LLM_BACKEND"] = "stub"
+        os.environ["STUB_LLM_LATENCY"] = str(args.stub_latency)
+    if not args.llm_cache:
+        set_llm_cache(None)
+
+    eval_df = load_evaluation_frame(args.catalog, args.labels, args.journal)
+    rag = RAG(df=pd.read_csv(args.catalog), emb_model_name=args.emb_models[0],
+              retrieval_strategy=RetrievalStrategy.FUSION, k=args.k)
+
+    suites = {}
+    for suite in args.suites:
+        with open(SUITES[suite]["configs"]) as f:
+            configs = json.load(f)
+        suites[suite] = {category: [(query, relevant_ids(eval_df, fields, values))
+                                    for query, fields, values in zip(cfg["queries"], cfg["test_fields"],
+                                                                     cfg["target_values"])]
+                         for category, cfg in configs.items()}
+
+    combinations = {}
+    for emb_model in args.emb_models:
+        for strategy in args.strategies:
+            combination_rag = copy.copy(rag)
+            combination_rag.client = UsageTrackingClient(rag.client)
+            config = RequestConfig(strategy=strategy, emb_model=emb_model, k=args.k, prefilter=args.prefilter,
+                                   single_call=args.single_call, context_tokens=args.context_tokens)
+            combinations[emb_model, strategy] = (combination_rag, config)
+
+    tasks = [(combination, suite, category, query, relevant)
+             for combination in combinations
+             for suite, categories in suites.items()
+             for category, queries in categories.items()
+             for query, relevant in queries]
+
+    def run_task(task):
+        combination, suite, category, query, relevant = task
+        combination_rag, config = combinations[combination]
+        return evaluate_query(combination_rag, query, config, relevant, args.k, generate=args.generate)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+        outcomes = list(executor.map(run_task, tasks))
+    wall_seconds = time.perf_counter() - start
+
+    per_query = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(list))))
+    timings = defaultdict(list)
+    for (combination, suite, category, _, _), (metrics, stage_seconds) in zip(tasks, outcomes):
+        emb_model, strategy = combination
+        per_query[emb_model][suite][strategy][category].append(metrics)
+        timings[combination].append(stage_seconds)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    summary = {"k": args.k, "llm": args.llm, "wall_seconds": round(wall_seconds, 2), "combinations": {}}
+    for emb_model in args.emb_models:
+        name = EMBEDDING_MODEL_NAMES[emb_model]
+        model_dir = os.path.join(args.output_dir, name)
+        os.makedirs(model_dir, exist_ok=True)
+        for suite in args.suites:
+            by_cat = average_by_category(per_query[emb_model][suite], args.strategies)
+            average = average_metrics_per_method(by_cat)
+            by_cat.to_csv(os.path.join(model_dir, SUITES[suite]["by_cat"].format(name=name)))
+            average.to_csv(os.path.join(model_dir, SUITES[suite]["average"].format(name=name)))
+            for strategy in args.strategies:
+                entry = summary["combinations"].setdefault(f"{emb_model}/{strategy}", {"metrics": {}})
+                entry["metrics"][suite] = average.loc[METHOD_LABELS[strategy]].round(4).to_dict()
+
+    random_dir = os.path.join(args.output_dir, "random_metrics")
+    os.makedirs(random_dir, exist_ok=True)
+    for suite in args.suites:
+        random_metrics = {category: pd.DataFrame([random_baseline_metrics(args.k, len(relevant), len(eval_df))
+                                                  for _, relevant in queries]).mean()
+                          for category, queries in suites[suite].items()}
+        pd.DataFrame(random_metrics).rename_axis("Metric").to_csv(os.path.join(random_dir, SUITES[suite]["random"]))
+
+    performance = []
+    for (emb_model, strategy), (combination_rag, _) in combinations.items():
+        usage = combination_rag.client.totals()
+        num_queries = len(timings[emb_model, strategy])
+        entry = summary["combinations"][f"{emb_model}/{strategy}"]
+        entry["queries"] = num_queries
+        entry["latency_ms"] = latency_summary(timings[emb_model, strategy])
+        entry["llm"] = usage
+        row = {"emb_model": emb_model, "strategy": strategy, "queries": num_queries,
+               "llm_calls": usage["calls"], "prompt_tokens": usage["prompt_tokens"],
+               "completion_tokens": usage["completion_tokens"],
+               "tokens_per_query": round((usage["prompt_tokens"] + usage["completion_tokens"]) / num_queries, 1)}
+        for stage, stats in entry["latency_ms"].items():
+            row.update({f"{stage}_{stat}": value for stat, value in stats.items()})
+        performance.append(row)
+    pd.DataFrame(performance).to_csv(os.path.join(args.output_dir, "performance.csv"), index=False)
+
+    with open(os.path.join(args.output_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def compare_to_baseline(summary, baseline, max_latency_increase, max_token_increase, max_metric_drop):
+    """Regressions of ``summary`` against a previous ``summary.json``, as human-readable lines."""
+    regressions = []
+    for combination, entry in summary["combinations"].items():
+        previous = baseline["combinations"].get(combination)
+        if previous is None:
+            continue
+        old_p95 = previous["latency_ms"]["total"]["p95_ms"]
+        new_p95 = entry["latency_ms"]["total"]["p95_ms"]
+        if old_p95 and new_p95 > old_p95 * (1 + max_latency_increase):
+            regressions.append(f"{combination}: total p95 {old_p95} -> {new_p95} ms")
+
+        old_tokens = previous["llm"]["prompt_tokens"] + previous["llm"]["completion_tokens"]
+        new_tokens = entry["llm"]["prompt_tokens"] + entry["llm"]["completion_tokens"]
+        if old_tokens and new_tokens > old_tokens * (1 + max_token_increase):
+            regressions.append(f"{combination}: tokens {old_tokens} -> {new_tokens}")
+
+        for suite, metrics in entry["metrics"].items():
+            for metric, value in metrics.items():
+                old_value = previous["metrics"].get(suite, {}).get(metric)
+                if old_value is not None and value < old_value - max_metric_drop:
+                    regressions.append(f"{combination}: {suite} {metric} {old_value} -> {value}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Evaluate every strategy x embedding model on the evaluation configs.")
+    parser.add_argument("--emb-models", nargs="+", default=options(EmbeddingModel), choices=options(EmbeddingModel))
+    parser.add_argument("--strategies", nargs="+", default=options(RetrievalStrategy),
+                        choices=options(RetrievalStrategy))
+    parser.add_argument("--suites", nargs="+", default=list(SUITES), choices=list(SUITES))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--llm", choices=["openai", "stub"], default="openai")
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="seconds each stub LLM call sleeps")
+    parser.add_argument("--llm-cache", action="store_true", help="serve repeated prompts from the LLM cache")
+    parser.add_argument("--generate", action="store_true", help="also time the final recommendation call")
+    parser.add_argument("--context-tokens", type=int, default=DEFAULT_CONTEXT_TOKENS,
+                        help="token budget of the final recommendation context")
+    parser.add_argument("--prefilter", action="store_true")
+    parser.add_argument("--single-call", action="store_true")
+    parser.add_argument("--parallel", type=int, default=8, help="queries evaluated concurrently")
+    parser.add_argument("--catalog", default=CATALOG_PATH)
+    parser.add_argument("--labels", default=os.path.join(EVALUATION_DIR, "llm_labeled.csv"))
+    parser.add_argument("--journal", default=os.path.join(EVALUATION_DIR, "top_wines_journal.csv"))
+    parser.add_argument("--output-dir", default=os.path.join(EVALUATION_DIR, "results_metrics", "runs",
+                                                             time.strftime("%Y%m%d-%H%M%S")))
+    parser.add_argument("--baseline", help="summary.json of an earlier run; exit 1 on regressions against it")
+    parser.add_argument("--max-latency-increase", type=float, default=0.2)
+    parser.add_argument("--max-token-increase", type=float, default=0.1)
+    parser.add_argument("--max-metric-drop", type=float, default=0.02)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    summary = run(args)
+    print(pd.read_csv(os.path.join(args.output_dir, "performance.csv")).to_string(index=False))
+    print(f"wrote {args.output_dir}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(summary, json.load(f), args.max_latency_increase,
+                                              args.max_token_increase, args.max_metric_drop)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
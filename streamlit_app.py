@@ -1,5 +1,6 @@
 import streamlit as st
 import requests
+import json
 from streamlit_chat import message
 
 st.set_page_config(page_title="Wine Recommender Assistant", page_icon=None)
@@ -59,6 +60,46 @@ with st.sidebar.expander("🛠 Debug Info"):
     st.write("Messages:", st.session_state.messages)
     st.write("Num Results:", num_results)
 
+STAGE_LABELS = {
+    "understanding": "Understanding your request...",
+    "retrieval": "Searching the cellar...",
+    "generation": "Writing your recommendation...",
+}
+
+
+def stream_recommendation(query):
+    """Renders the /recommend/stream events into a placeholder as they arrive and returns the final text."""
+    placeholder = st.empty()
+    text = ""
+    event = None
+    with requests.get("http://wine-rec-app:8000/recommend/stream", params={
+        "query": query,
+        "strategy": strategy,
+        "num_results": num_results,
+        "emb_model": embedding_model,
+    }, stream=True) as response:
+        if response.status_code != 200:
+            placeholder.empty()
+            return f"Server error during recommendation: {response.status_code}"
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+                if event == "stage":
+                    placeholder.markdown(f"_{STAGE_LABELS.get(data['stage'], data['stage'])}_")
+                elif event == "retrieval":
+                    placeholder.markdown(f"_Found {len(data['documents'])} candidate wines, writing your recommendation..._")
+                elif event == "token":
+                    text += data["text"]
+                    placeholder.markdown(text + "▌")
+                elif event == "done":
+                    text = data["recommendation"]
+                elif event == "error":
+                    text = f"Recommendation failed: {data['error']}"
+    placeholder.empty()
+    return text.strip('"')
+
 # Chat input
 user_input = st.chat_input("Type your message...")
 
@@ -95,27 +136,14 @@ if user_input and user_input != st.session_state.last_handled_input:
                     })
                     st.rerun()
         else:
-            with st.spinner("Getting wine recommendation..."):
-                try:
-                    final_response = requests.get("http://wine-rec-app:8000/recommend", params={
-                        "query": st.session_state.query,
-                        "strategy": strategy,
-                        "num_results": num_results,
-                        "emb_model": embedding_model,
-                    })
-                    if final_response.status_code == 200:
-                        recommendation = final_response.json()["recommendation"].strip('"')
-                        st.session_state.messages.append({"role": "assistant", "content": recommendation})
-                    else:
-                        st.session_state.messages.append({
-                            "role": "assistant",
-                            "content": f"Server error during recommendation: {final_response.status_code}"
-                        })
-                except Exception as e:
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": f"Final request failed: {e}"
-                    })
+            try:
+                recommendation = stream_recommendation(st.session_state.query)
+                st.session_state.messages.append({"role": "assistant", "content": recommendation})
+            except Exception as e:
+                st.session_state.messages.append({
+                    "role": "assistant",
+                    "content": f"Final request failed: {e}"
+                })
 
             st.session_state.step = "done"
             st.rerun()
@@ -141,24 +169,6 @@ if user_input and user_input != st.session_state.last_handled_input:
                     enriched_query = response_json.get("rewritten_query", st.session_state.query)
 
                     st.session_state.query = enriched_query
-
-                    final_response = requests.get("http://wine-rec-app:8000/recommend", params={
-                        "query": enriched_query,
-                        "strategy": strategy,
-                        "num_results": num_results,
-                        "emb_model": embedding_model,
-                    })
-                    if final_response.status_code == 200:
-                        recommendation = final_response.json()["recommendation"].strip('"')
-                        st.session_state.messages.append({"role": "assistant", "content": recommendation})
-                        st.session_state.step = "done"
-                        st.rerun()
-                    else:
-                        st.session_state.messages.append({
-                            "role": "assistant",
-                            "content": f"Server error during recommendation: {final_response.status_code}"
-                        })
-                        st.rerun()
                 except Exception as e:
                     st.session_state.messages.append({
                         "role": "assistant",
@@ -166,6 +176,17 @@ if user_input and user_input != st.session_state.last_handled_input:
                     })
                     st.rerun()
 
+            try:
+                recommendation = stream_recommendation(enriched_query)
+                st.session_state.messages.append({"role": "assistant", "content": recommendation})
+                st.session_state.step = "done"
+            except Exception as e:
+                st.session_state.messages.append({
+                    "role": "assistant",
+                    "content": f"Final request failed: {e}"
+                })
+            st.rerun()
+
     elif st.session_state.step == "done":
         with st.spinner("Updating your preferences and rerunning the search..."):
             context = [f"Q: {q}\nA: {a}" for q, a in zip(st.session_state.clarifying_questions, st.session_state.answers)]
@@ -179,21 +200,17 @@ if user_input and user_input != st.session_state.last_handled_input:
                 rewritten_query = rewrite_response.json().get("rewritten_query", st.session_state.query)
 
                 st.session_state.query = rewritten_query
-
-                final_response = requests.get("http://wine-rec-app:8000/recommend", params={
-                    "query": rewritten_query,
-                    "strategy": strategy,
-                    "num_results": num_results,
-                    "emb_model": embedding_model,
+            except Exception as e:
+                st.session_state.messages.append({
+                    "role": "assistant",
+                    "content": f"Follow-up request failed: {e}"
                 })
-                if final_response.status_code == 200:
-                    recommendation = final_response.json()["recommendation"].strip('"')
-                    st.session_state.messages.append({"role": "assistant", "content": recommendation})
-                else:
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": f"Server error during recommendation: {final_response.status_code}"
-                    })
+                rewritten_query = None
+
+        if rewritten_query is not None:
+            try:
+                recommendation = stream_recommendation(rewritten_query)
+                st.session_state.messages.append({"role": "assistant", "content": recommendation})
             except Exception as e:
                 st.session_state.messages.append({
                     "role": "assistant",
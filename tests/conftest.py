@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+# The app runs with app/ on the path (gunicorn --pythonpath app), so its modules import each other absolutely.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+
+@pytest.fixture
+def wines():
+    return pd.DataFrame({
+        "id": [11, 12, 13, 14],
+        "title": ["Dr. Loosen 2019 Riesling", "Domaine X 2018 Pinot Noir", "Y 2017 Cabernet", "Z 2020 Rosé"],
+        "description": ["Lime and slate.", "Cherry and earth.", "Cassis and cedar.", "Strawberry."],
+        "price": [18.0, 45.0, 60.0, 15.0],
+        "points": [90, 92, 94, 87],
+        "country": ["Germany", "France", "US", "France"],
+        "province": ["Mosel", "Burgundy", "California", "Provence"],
+        "region_1": [None, "Gevrey-Chambertin", "Napa Valley", "Côtes de Provence"],
+        "designation": ["Kabinett", None, "Reserve", None],
+        "winery": ["Dr. Loosen", "Domaine X", "Y", "Z"],
+        "vintage": [2019, 2018, 2017, 2020],
+        "variety": ["Riesling", "Pinot Noir", "Cabernet Sauvignon", "Rosé"],
+        "wine_color": ["White", "Red", "Red", "Rosé"],
+        "review_1": ["Great value.", None, "Needs time.", "Summer wine."],
+    })
+
+
+@pytest.fixture
+def embeddings():
+    return DeterministicFakeEmbedding(size=16)
@@ -0,0 +1,40 @@
+import logging
+
+import pytest
+
+from monitoring.metrics import batch_search_failures
+from rag_methods import rag
+from rag_methods.rag import RAG, RequestConfig
+
+
+def batch_rag(monkeypatch, search_error):
+    """A ``RAG`` whose batched search raises ``search_error`` and whose items report the search they got."""
+    def batch_search(vectorstore, texts, k):
+        raise search_error
+
+    monkeypatch.setattr(rag, "BatchSearch", batch_search)
+    instance = RAG.__new__(RAG)
+    instance.catalog = None
+    instance.vectorstore = lambda emb_model, catalog=None: None
+    instance._prepare_batch_item = lambda query, config, catalog: (None, None, query, [query])
+    instance._finish_batch_item = lambda query, config, catalog, prepared, batch: f"{query}:{batch}"
+    return instance
+
+
+def test_failed_batch_search_falls_back_to_per_query_search_and_is_reported(monkeypatch, caplog):
+    instance = batch_rag(monkeypatch, OSError("index missing"))
+    before = batch_search_failures._values[(("emb_model", "openai"), ("error", "OSError"))]
+    items = [(f"query {i}", RequestConfig(emb_model="openai")) for i in range(3)]
+
+    with caplog.at_level(logging.WARNING, logger=rag.__name__):
+        results = sorted(instance.recommend_batch(items, max_concurrency=2))
+
+    assert results == [(i, f"query {i}:None", None) for i in range(3)]
+    assert batch_search_failures._values[(("emb_model", "openai"), ("error", "OSError"))] == before + 1
+    assert "Batch search with openai failed" in caplog.text
+
+
+def test_unexpected_batch_search_errors_are_not_swallowed(monkeypatch):
+    instance = batch_rag(monkeypatch, TypeError("bug"))
+    with pytest.raises(TypeError):
+        list(instance.recommend_batch([("query", RequestConfig(emb_model="openai"))]))
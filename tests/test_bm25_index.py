@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from vectorstore import bm25_index
+from vectorstore.bm25_index import BM25Index, load_or_build_bm25_index
+
+TEXTS = [
+    "Crisp dry riesling with lime and slate",
+    "Bold cabernet sauvignon, black currant and cedar",
+    "Dry rose with strawberry and citrus notes",
+    "Oaky chardonnay with butter and vanilla",
+    "Light pinot noir, cherry and earth, dry finish",
+    "Sweet late harvest riesling with honey",
+]
+IDS = [101, 102, 103, 104, 105, 106]
+
+
+class FakeStore:
+    def __init__(self, texts, ids):
+        self._texts = texts
+        self.ids = ids
+
+    def texts(self):
+        return iter(self._texts)
+
+
+@pytest.mark.parametrize("query", ["dry riesling", "cherry earth", "vanilla butter oak", "unknown words"])
+def test_scores_match_rank_bm25(query):
+    rank_bm25 = pytest.importorskip("rank_bm25")
+    reference = rank_bm25.BM25Okapi([text.lower().split() for text in TEXTS])
+    index = BM25Index.build(TEXTS, IDS)
+    np.testing.assert_allclose(index.get_scores(query), reference.get_scores(query.lower().split()), rtol=1e-6)
+
+
+def test_top_k_orders_by_score_and_respects_mask():
+    index = BM25Index.build(TEXTS, IDS)
+    positions, scores = index.top_k("dry riesling", k=3)
+    assert set(positions[:2]) == {0, 5}
+    assert list(scores) == sorted(scores, reverse=True)
+
+    mask = np.zeros(len(TEXTS), dtype=bool)
+    mask[[2, 4]] = True
+    positions, _ = index.top_k("dry riesling", k=5, mask=mask)
+    assert sorted(positions) == [2, 4]
+
+    positions, _ = index.top_k("dry riesling", k=5, mask=np.zeros(len(TEXTS), dtype=bool))
+    assert len(positions) == 0
+
+
+def test_tied_scores_keep_the_baseline_order():
+    texts = ["oak vanilla"] + ["dry riesling"] * 6 + ["riesling"] * 3
+    index = BM25Index.build(texts, list(range(len(texts))))
+    scores = index.get_scores("dry riesling")
+    baseline = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+    for k in range(1, len(texts) + 1):
+        positions, _ = index.top_k("dry riesling", k=k)
+        assert positions.tolist() == baseline[:k]
+
+    mask = np.ones(len(texts), dtype=bool)
+    mask[[2, 8]] = False
+    positions, _ = index.top_k("dry riesling", k=7, mask=mask)
+    assert positions.tolist() == [i for i in baseline if mask[i]][:7]
+
+
+def test_update_tokenizes_only_changed_rows_and_scores_like_a_rebuild(monkeypatch):
+    original = BM25Index.build(TEXTS, IDS)
+    # 104 and 106 deleted, 102 edited, 107 and 108 appended and the remaining rows reordered.
+    texts = [TEXTS[4], "Bold cabernet franc, graphite", TEXTS[0], "Dry fino sherry, almonds", TEXTS[2],
+             "Sparkling riesling"]
+    ids = [105, 102, 101, 107, 103, 108]
+    reuse_rows = [4, -1, 0, -1, 2, -1]
+
+    tokenized = []
+    monkeypatch.setattr(bm25_index, "tokenize", lambda text: tokenized.append(text) or text.lower().split())
+    updated = original.updated(reuse_rows, [texts[1], texts[3], texts[5]], ids, fingerprint="v2")
+    assert tokenized == [texts[1], texts[3], texts[5]]
+
+    rebuilt = BM25Index.build(texts, ids)
+    assert updated.matches(ids) and updated.fingerprint == "v2"
+    assert set(updated.vocab) == set(rebuilt.vocab)
+    for query in ["dry riesling", "bold cabernet", "vanilla butter oak", "cherry earth almonds"]:
+        np.testing.assert_allclose(updated.get_scores(query), rebuilt.get_scores(query), rtol=1e-6)
+        assert updated.top_k(query, k=4)[0].tolist() == rebuilt.top_k(query, k=4)[0].tolist()
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "bm25.npz")
+    index = BM25Index.build(TEXTS, IDS, fingerprint="abc")
+    index.save(path)
+    loaded = BM25Index.load(path)
+    assert loaded.fingerprint == "abc"
+    assert loaded.matches(IDS)
+    np.testing.assert_allclose(loaded.get_scores("dry riesling"), index.get_scores("dry riesling"))
+    np.testing.assert_array_equal(loaded.freqs, index.freqs)
+    np.testing.assert_array_equal(loaded.doc_len, index.doc_len)
+
+
+def test_saved_index_is_rebuilt_when_content_changes(tmp_path):
+    path = str(tmp_path / "bm25.npz")
+    load_or_build_bm25_index(FakeStore(TEXTS, IDS), "v1", path)
+    assert load_or_build_bm25_index(FakeStore(TEXTS, IDS), "v1", path).fingerprint == "v1"
+
+    edited = TEXTS[:-1] + ["Sparkling prosecco with green apple"]
+    index = load_or_build_bm25_index(FakeStore(edited, IDS), "v2", path)
+    assert index.fingerprint == "v2"
+    assert index.top_k("prosecco", k=1)[0][0] == 5
+    assert BM25Index.load(path).fingerprint == "v2"
+
+
+def test_workers_starting_together_build_the_index_once(tmp_path, monkeypatch):
+    path = str(tmp_path / "bm25.npz")
+    built = []
+    build = BM25Index.build.__func__
+
+    def slow_build(cls, *args, **kwargs):
+        built.append(1)
+        time.sleep(0.05)
+        return build(cls, *args, **kwargs)
+
+    monkeypatch.setattr(BM25Index, "build", classmethod(slow_build))
+    results = []
+
+    def worker_start():
+        results.append(load_or_build_bm25_index(FakeStore(TEXTS, IDS), "v1", path))
+
+    workers = [threading.Thread(target=worker_start) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert len(built) == 1
+    assert [index.fingerprint for index in results] == ["v1"] * 4
+    assert sorted(os.listdir(tmp_path)) == ["bm25.npz", "bm25.npz.lock"]
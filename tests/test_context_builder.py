@@ -0,0 +1,42 @@
+from langchain_core.documents import Document
+
+from llm_setup.llm_clients import count_tokens
+from rag_methods.context_builder import build_recommendation_context, documents_for, parse_document, profile_tokens
+
+
+def wine(i):
+    return Document(page_content=f"Title: Wine {i}\n"
+                                 f"Description: Ripe plum, violet and graphite on a long finish, number {i}.\n"
+                                 f"Price: {10 + i}, Points: 90, Country: France\n"
+                                 f"Reviews:\nSupple tannins carry dark berries into a savory finish.\n"
+                                 f"Another bottle showing cassis, tobacco leaf and cedar.")
+
+
+def titles(context):
+    return [line for line in context.split("\n") if line.startswith("Title: ")]
+
+
+def test_a_roomy_budget_fits_more_documents_than_the_minimum():
+    documents = [wine(i) for i in range(10)]
+    context = build_recommendation_context(documents, num_results=1, max_tokens=4000)
+    assert titles(context) == [f"Title: Wine {i}" for i in range(10)]
+
+
+def test_further_documents_come_in_retrieval_order_while_their_profiles_fit():
+    documents = [wine(i) for i in range(10)]
+    per_document = profile_tokens(parse_document(documents[0].page_content))
+    budget = 5 * per_document + per_document // 2
+    context = build_recommendation_context(documents, num_results=1, max_tokens=budget)
+    assert titles(context) == [f"Title: Wine {i}" for i in range(5)]
+    assert count_tokens(context) <= budget + 5
+
+
+def test_the_minimum_is_kept_even_when_the_budget_is_tight():
+    documents = [wine(i) for i in range(10)]
+    context = build_recommendation_context(documents, num_results=2, max_tokens=10)
+    assert titles(context) == [f"Title: Wine {i}" for i in range(documents_for(2))]
+    assert "Description:" not in context
+
+
+def test_fewer_documents_than_the_minimum():
+    assert titles(build_recommendation_context([wine(0)], num_results=3)) == ["Title: Wine 0"]
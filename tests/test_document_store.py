@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+
+import pandas as pd
+from langchain_community.vectorstores import FAISS
+
+from rag_methods import catalog
+from rag_methods.catalog import Catalog
+from vectorstore import document_store
+from vectorstore.bm25_index import BM25Index
+from vectorstore.create_vectorstore import create_documents, frame_fingerprint
+from vectorstore.document_store import DocumentStore, bind_document_store
+from vectorstore.mmap_store import load_mmap_vectorstore, write_mmap_vectorstore
+
+
+def raw_vectorstore(df, embeddings):
+    return FAISS.from_documents(create_documents(df), embeddings)
+
+
+def catalog_for(df):
+    store = DocumentStore.from_frame(df)
+    return Catalog(store, BM25Index.build(list(store.texts()), store.ids))
+
+
+def test_view_hydrates_from_the_catalog_without_touching_the_shared_store(wines, embeddings):
+    raw = raw_vectorstore(wines, embeddings)
+    docstore, index_to_docstore_id = raw.docstore, raw.index_to_docstore_id
+    store = DocumentStore.from_frame(wines)
+
+    view = bind_document_store(raw, store)
+    assert view is not raw and view.index is raw.index
+    assert raw.docstore is docstore and raw.index_to_docstore_id is index_to_docstore_id
+    assert view.docstore.store is store
+    results = view.similarity_search(wines.loc[2, "description"], k=4)
+    assert sorted(doc.metadata["id"] for doc in results) == [11, 12, 13, 14]
+    assert [doc.page_content for doc in results] == [store.text(store.id_to_row[doc.metadata["id"]])
+                                                     for doc in results]
+
+
+def test_memory_mapped_stores_are_bound_too(wines, embeddings, tmp_path):
+    write_mmap_vectorstore(raw_vectorstore(wines, embeddings), str(tmp_path))
+    raw = load_mmap_vectorstore(str(tmp_path), embeddings)
+    view = bind_document_store(raw, DocumentStore.from_frame(wines.iloc[::-1]))
+    assert view is not raw
+    assert view.docstore.wine_ids.tolist() == raw.docstore.wine_ids.tolist() == [11, 12, 13, 14]
+    assert view.docstore.search("0").metadata["id"] == 11
+
+
+def test_wines_the_catalog_lacks_are_excluded_from_searches(wines, embeddings):
+    raw = raw_vectorstore(wines, embeddings)
+    view = bind_document_store(raw, DocumentStore.from_frame(wines.iloc[:3]))
+    assert view.index is not raw.index and view.index.ntotal == raw.index.ntotal
+    results = view.similarity_search(wines.loc[3, "description"], k=4)
+    assert sorted(doc.metadata["id"] for doc in results) == [11, 12, 13]
+
+
+def test_catalog_binds_each_store_once(wines, embeddings):
+    raw, other = raw_vectorstore(wines, embeddings), raw_vectorstore(wines, embeddings)
+    catalog = catalog_for(wines)
+    assert catalog.vectorstore(raw) is catalog.vectorstore(raw)
+    assert catalog.vectorstore(other) is not catalog.vectorstore(raw)
+    assert catalog_for(pd.concat([wines, wines.assign(id=wines["id"] + 10)])).vectorstore(raw) is not \
+        catalog.vectorstore(raw)
+
+
+def test_catalog_hashes_the_frame_once_for_both_caches(wines, tmp_path, monkeypatch):
+    hashed = []
+
+    def counting_fingerprint(df):
+        hashed.append(len(df))
+        return frame_fingerprint(df)
+
+    monkeypatch.setattr(catalog, "frame_fingerprint", counting_fingerprint)
+    monkeypatch.setattr(document_store, "frame_fingerprint", counting_fingerprint)
+    built = Catalog.from_frame(wines, cache_dir=str(tmp_path / "documents"), bm25_path=str(tmp_path / "bm25.npz"))
+    assert hashed == [len(wines)]
+    assert built.bm25_index.fingerprint == frame_fingerprint(wines)
+    assert os.path.exists(document_store.document_store_path(frame_fingerprint(wines), str(tmp_path / "documents")))
+
+
+def test_workers_starting_together_build_the_store_once_and_sweep_the_old_ones(wines, tmp_path, monkeypatch):
+    cache_dir = tmp_path / "documents"
+    cache_dir.mkdir()
+    (cache_dir / "store_v1_z_old.pkl").write_bytes(b"")
+    (cache_dir / "store_v1_z_old.pkl.abc.tmp").write_bytes(b"")
+    built = []
+    from_frame = DocumentStore.from_frame.__func__
+
+    def slow_from_frame(cls, *args, **kwargs):
+        built.append(1)
+        time.sleep(0.05)
+        return from_frame(cls, *args, **kwargs)
+
+    monkeypatch.setattr(DocumentStore, "from_frame", classmethod(slow_from_frame))
+    stores = []
+
+    def worker_start():
+        stores.append(document_store.load_or_create_document_store(wines, str(cache_dir)))
+
+    workers = [threading.Thread(target=worker_start) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert len(built) == 1
+    assert [store.ids for store in stores] == [[11, 12, 13, 14]] * 4
+    path = document_store.document_store_path(frame_fingerprint(wines), str(cache_dir))
+    assert sorted(os.listdir(cache_dir)) == sorted([os.path.basename(path), document_store.CACHE_LOCK_FILE])
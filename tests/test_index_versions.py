@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+import pytest
+
+from vectorstore.ann_index import load_index
+from vectorstore.build_vectorstore import write_vectorstore
+from vectorstore.index_versions import staged_version, version_dirs
+from vectorstore.mmap_store import MmapDocstore
+
+
+def write(path, name, content):
+    with open(os.path.join(path, name), "w") as f:
+        f.write(content)
+
+
+def read(path, name):
+    with open(os.path.join(path, name)) as f:
+        return f.read()
+
+
+def test_each_version_is_published_whole_and_old_ones_are_pruned(tmp_path):
+    path = str(tmp_path / "index")
+    published = []
+    for i in range(3):
+        with staged_version(path) as version:
+            write(version, "a", f"a{i}")
+            write(version, "b", f"b{i}")
+            assert read(path, "a") == f"a{i - 1}" if i else not os.path.exists(path)
+        published.append(version)
+        assert os.path.islink(path) and os.path.realpath(path) == os.path.realpath(version)
+        assert (read(path, "a"), read(path, "b")) == (f"a{i}", f"b{i}")
+    # the version just replaced stays for readers that resolved it a moment ago
+    assert [directory for _, directory in version_dirs(path)] == published[1:]
+
+
+def test_failed_write_publishes_nothing(tmp_path):
+    path = str(tmp_path / "index")
+    with staged_version(path) as version:
+        write(version, "a", "good")
+    with pytest.raises(RuntimeError):
+        with staged_version(path) as version:
+            write(version, "a", "half")
+            raise RuntimeError("crashed")
+    assert read(path, "a") == "good"
+    assert len(version_dirs(path)) == 1
+
+
+def test_copied_files_are_shared_until_replaced(tmp_path):
+    path = str(tmp_path / "index")
+    with staged_version(path) as first:
+        write(first, "a", "old")
+        write(first, "b", "kept")
+    with staged_version(path, copy_current=True) as second:
+        write(second, "a.tmp", "new")
+        os.replace(os.path.join(second, "a.tmp"), os.path.join(second, "a"))
+    assert (read(first, "a"), read(path, "a"), read(path, "b")) == ("old", "new", "kept")
+    assert os.path.samefile(os.path.join(first, "b"), os.path.join(second, "b"))
+
+
+def test_plain_directory_from_before_versioning_is_migrated(tmp_path):
+    path = str(tmp_path / "index")
+    os.makedirs(path)
+    write(path, "a", "legacy")
+    with staged_version(path, copy_current=True) as version:
+        write(version, "b", "new")
+    assert os.path.islink(path)
+    assert (read(path, "a"), read(path, "b")) == ("legacy", "new")
+    assert read(str(tmp_path / "index.v0"), "a") == "legacy"
+
+
+def test_write_vectorstore_replaces_the_whole_directory(tmp_path):
+    path = str(tmp_path / "index")
+    vectors = np.random.default_rng(0).standard_normal((300, 8)).astype(np.float32)
+    texts = [f"wine {i}" for i in range(300)]
+    write_vectorstore(path, vectors, texts, [{"id": i} for i in range(300)], ann_types=["ivf"])
+    old = os.path.realpath(path)
+    ivf = load_index(path, "ivf")
+
+    write_vectorstore(path, vectors[:200], texts[:200], [{"id": i} for i in range(200)], ann_types=["ivf"],
+                      retrain=False)
+    assert os.path.realpath(path) != old
+    assert len(MmapDocstore(path)) == load_index(path, "flat").ntotal == load_index(path, "ivf").ntotal == 200
+    assert len(MmapDocstore(old)) == 300
+    # refilled, not retrained
+    np.testing.assert_array_equal(faiss_centroids(load_index(path, "ivf")), faiss_centroids(ivf))
+
+    write_vectorstore(path, vectors[:100], texts[:100], [{"id": i} for i in range(100)])
+    assert not os.path.exists(os.path.join(path, "index_ivf.faiss"))
+
+
+def faiss_centroids(index):
+    import faiss
+
+    ivf = faiss.extract_index_ivf(index)
+    return ivf.quantizer.reconstruct_n(0, ivf.nlist)
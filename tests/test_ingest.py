@@ -0,0 +1,170 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from rag_methods.catalog import Catalog
+from rag_methods.rag import RAG
+from vectorstore.bm25_index import BM25Index
+from vectorstore.build_vectorstore import write_vectorstore
+from vectorstore.create_vectorstore import build_document_fields, frame_fingerprint
+from vectorstore.document_store import DocumentStore
+from vectorstore.ingest import apply_changes, ingest, saved_index
+from vectorstore.load_vectorstore import VECTORSTORE_CONFIG, load_vectorstore
+from vectorstore.mmap_store import DELETED_FILE, DELTA_DIR, INDEX_FILE
+from vectorstore.registry import VectorstoreRegistry
+from vectorstore.segments import index_segments
+
+
+class CountingEmbeddings:
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+
+@pytest.fixture
+def saved(tmp_path, wines, embeddings, monkeypatch):
+    csv_path = str(tmp_path / "wines.csv")
+    index_path = str(tmp_path / "index")
+    wines.to_csv(csv_path, index=False)
+    counting = CountingEmbeddings(embeddings)
+    counting.created = 0
+
+    def create():
+        counting.created += 1
+        return counting
+
+    monkeypatch.setitem(VECTORSTORE_CONFIG, "mpnet", {"fn": create, "default_path": index_path})
+
+    df = pd.read_csv(csv_path)
+    texts, metadatas = build_document_fields(df)
+    write_vectorstore(index_path, np.asarray(embeddings.embed_documents(texts), dtype=np.float32), texts, metadatas)
+    store = DocumentStore.from_frame(df)
+    BM25Index.build(list(store.texts()), store.ids, fingerprint=frame_fingerprint(df)).save(str(tmp_path / "bm25.npz"))
+    return {"csv_path": csv_path, "cache_dir": str(tmp_path / "documents"), "bm25_path": str(tmp_path / "bm25.npz"),
+            "emb_models": ["mpnet"], "registry": VectorstoreRegistry()}, index_path, counting
+
+
+def served(index_path):
+    """``{wine id: (vector, page content)}`` of the live positions of the saved index."""
+    index, wine_ids, page_content = saved_index(index_path)
+    live = getattr(index, "live_mask", np.ones(index.ntotal, dtype=bool))
+    return {wine_ids[pos]: (index.reconstruct(pos), page_content(pos)) for pos in np.flatnonzero(live).tolist()}
+
+
+def assert_matches_catalog(index_path, csv_path, embeddings, bm25_path):
+    store = DocumentStore.from_frame(pd.read_csv(csv_path))
+    bm25_index, rebuilt = BM25Index.load(bm25_path), BM25Index.build(list(store.texts()), store.ids)
+    assert bm25_index.matches(store.ids)
+    for query in ["raspberry.", "cherry and earth.", "gamay 2021"]:
+        np.testing.assert_allclose(bm25_index.get_scores(query), rebuilt.get_scores(query), rtol=1e-6)
+    wines = served(index_path)
+    assert sorted(wines) == sorted(store.ids)
+    for row, wine_id in enumerate(store.ids):
+        vector, text = wines[wine_id]
+        assert text == store.text(row)
+        assert np.allclose(vector, embeddings.embed_documents([text])[0])
+
+
+def test_apply_changes_replaces_in_place_appends_and_deletes(wines):
+    upserts = pd.DataFrame([{**wines.iloc[1].to_dict(), "price": 50.0}, {**wines.iloc[0].to_dict(), "id": 15}])
+    merged = apply_changes(wines, upserts, delete_ids=["13"])
+    assert merged["id"].tolist() == [11, 12, 14, 15]
+    assert merged["price"].tolist() == [18.0, 50.0, 15.0, 18.0]
+    with pytest.raises(ValueError):
+        apply_changes(wines, upserts.drop(columns="id"))
+
+
+def test_changes_are_appended_to_a_delta_instead_of_rewriting_the_index(saved, wines, embeddings):
+    kw, index_path, counting = saved
+    base_file = os.path.join(os.path.realpath(index_path), INDEX_FILE)
+    upserts = pd.concat([wines.iloc[[1]].assign(description="Raspberry."), wines.iloc[[2]],
+                         wines.iloc[[0]].assign(id=15, title="W 2021 Gamay")])
+
+    summary = ingest(upserts=upserts, delete_ids=[14], compact=False, **kw)
+
+    assert summary["indexes"]["mpnet"] == {"embedded": 2, "compacted": False, "delta": {"appended": 2, "deleted": 2}}
+    assert len(counting.embedded) == 2
+    assert counting.created == 1 and kw["registry"].loaded()[0]["emb_model"] == "mpnet"
+    assert os.path.samefile(base_file, os.path.join(os.path.realpath(index_path), INDEX_FILE))
+    assert_matches_catalog(index_path, kw["csv_path"], embeddings, kw["bm25_path"])
+
+    vectorstore = load_vectorstore("mpnet", mmap=True, index_type="flat")
+    assert vectorstore.index.ntotal == 6
+    assert sorted(doc.metadata["id"] for doc in vectorstore.similarity_search("Raspberry.", k=10)) == [11, 12, 13, 15]
+
+
+def test_deleting_an_appended_wine_drops_it_from_the_delta(saved, wines, embeddings):
+    kw, index_path, _ = saved
+    ingest(upserts=wines.iloc[[0]].assign(id=15), compact=False, **kw)
+    summary = ingest(delete_ids=["15"], compact=False, **kw)
+    assert summary["indexes"]["mpnet"]["delta"] == {"appended": 1, "deleted": 1}
+    assert_matches_catalog(index_path, kw["csv_path"], embeddings, kw["bm25_path"])
+
+
+def test_compaction_folds_the_delta_into_a_full_write(saved, wines, embeddings):
+    kw, index_path, counting = saved
+    ingest(upserts=wines.iloc[[1]].assign(description="Raspberry."), compact=False, **kw)
+    summary = ingest(compact=True, **kw)
+
+    assert summary["indexes"]["mpnet"] == {"embedded": 0, "compacted": True, "delta": {"appended": 0, "deleted": 0}}
+    assert len(counting.embedded) == 1
+    current = os.path.realpath(index_path)
+    assert not os.path.exists(os.path.join(current, DELTA_DIR)) and not os.path.exists(os.path.join(current, DELETED_FILE))
+    assert_matches_catalog(index_path, kw["csv_path"], embeddings, kw["bm25_path"])
+
+
+def test_a_large_delta_is_compacted_by_default(saved, embeddings):
+    kw, index_path, _ = saved
+    assert ingest(delete_ids=[14], **kw)["indexes"]["mpnet"]["compacted"]
+    assert_matches_catalog(index_path, kw["csv_path"], embeddings, kw["bm25_path"])
+
+
+def test_wines_rendered_differently_after_a_dtype_change_are_embedded_again(saved, wines, embeddings):
+    kw, index_path, counting = saved
+    summary = ingest(upserts=wines.iloc[[0]].assign(id=15, points=90.5), compact=False, **kw)
+    assert summary["indexes"]["mpnet"]["embedded"] == 5
+    assert_matches_catalog(index_path, kw["csv_path"], embeddings, kw["bm25_path"])
+
+
+def test_a_catalog_refresh_updates_loaded_stores_without_loading_them_again(saved, wines):
+    kw, _, counting = saved
+    loads = []
+
+    def loader(name):
+        loads.append(name)
+        return load_vectorstore(name, mmap=True, index_type="flat")
+
+    rag = RAG.__new__(RAG)
+    rag.registry = kw["registry"] = VectorstoreRegistry(loader=loader)
+    loaded = rag.registry.get("mpnet")
+
+    def refresh():
+        catalog = Catalog.from_frame(pd.read_csv(kw["csv_path"]), cache_dir=kw["cache_dir"],
+                                     bm25_path=kw["bm25_path"])
+        rag.set_catalog(catalog)
+        return rag.registry.get("mpnet"), catalog
+
+    ingest(upserts=wines.iloc[[0]].assign(id=15, description="Raspberry."), delete_ids=[14], compact=False, **kw)
+    refreshed, catalog = refresh()
+    assert loads == ["mpnet"]
+    assert refreshed.embedding_function is loaded.embedding_function
+    assert index_segments(refreshed.index)[0] is index_segments(loaded.index)[0]
+    found = catalog.vectorstore(refreshed).similarity_search("Raspberry.", k=10)
+    assert sorted(doc.metadata["id"] for doc in found) == [11, 12, 13, 15]
+
+    ingest(compact=True, **kw)
+    compacted, catalog = refresh()
+    assert loads == ["mpnet"]
+    assert compacted.embedding_function is loaded.embedding_function
+    assert compacted.index.ntotal == 4
+    assert refresh()[0] is compacted
+    assert counting.created == 1
@@ -0,0 +1,117 @@
+import ast
+from types import SimpleNamespace
+
+import pytest
+
+from llm_setup import llm_cache, setup_llm
+from llm_setup.llm_cache import LLMCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm_cache.time, "time", clock.time)
+    return clock
+
+
+def test_entries_expire_after_the_ttl_in_memory_and_on_disk(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = LLMCache(path=path, ttl_seconds=60)
+    cache.set("key", "answer")
+    clock.now += 30
+    assert cache.get("key") == "answer"
+    assert LLMCache(path=path, ttl_seconds=60).get("key") == "answer"
+
+    clock.now += 31
+    assert cache.get("key") is None
+    assert LLMCache(path=path, ttl_seconds=60).get("key") is None
+    assert cache.stats()["disk_entries"] == 0
+
+
+def test_memory_tier_is_a_bounded_lru_backed_by_disk(tmp_path):
+    cache = LLMCache(path=str(tmp_path / "cache.sqlite3"), max_memory_entries=2)
+    for key in "abc":
+        cache.set(key, key.upper())
+    assert cache.stats()["memory_entries"] == 2
+    assert cache.get("a") == "A"
+    assert cache.stats()["totals"]["disk_hits"] == 1
+    assert cache.get("a") == "A"
+    assert cache.stats()["totals"]["memory_hits"] == 1
+
+
+def test_disk_is_trimmed_to_the_least_recently_used_entries(tmp_path, clock):
+    cache = LLMCache(path=str(tmp_path / "cache.sqlite3"), max_memory_entries=1, max_disk_entries=50)
+    for i in range(100):
+        clock.now += 1
+        cache.set(f"key{i}", str(i))
+        if i == 60:
+            clock.now += 1
+            assert cache.get("key0") == "0"
+    assert cache.stats()["disk_entries"] == 50
+    assert cache.get("key0") == "0"
+    assert cache.get("key50") is None
+    assert cache.get("key51") == "51"
+    assert cache.get("key99") == "99"
+
+
+def completion(content, finish_reason="stop"):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content),
+                                                    finish_reason=finish_reason)], usage=None)
+
+
+class ScriptedClient:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, stream=False, **params):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if stream:
+            content, finish_reason = response
+            return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content),
+                                                                  finish_reason=finish_reason)], usage=None)])
+        return response
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = LLMCache()
+    monkeypatch.setattr(setup_llm, "_llm_cache", cache)
+    monkeypatch.setattr(setup_llm, "_llm_cache_configured", True)
+    return cache
+
+
+def test_unparseable_completion_is_not_cached(cache):
+    client = ScriptedClient(completion("['a', 'b'"), completion("['a', 'b']"))
+    with pytest.raises(SyntaxError):
+        setup_llm.prompt_llm(client, "prompt", prompt_key="queries", parse=ast.literal_eval)
+    assert setup_llm.prompt_llm(client, "prompt", prompt_key="queries", parse=ast.literal_eval) == ["a", "b"]
+    assert setup_llm.prompt_llm(client, "prompt", prompt_key="queries", parse=ast.literal_eval) == ["a", "b"]
+    assert client.calls == 2
+
+
+def test_cached_completion_that_no_longer_parses_is_fetched_again(cache):
+    cache.set(cache.make_key(setup_llm.LLM_MODEL, "prompt", {}), "not a literal")
+    client = ScriptedClient(completion("{'intent': 'normal'}"))
+    assert setup_llm.prompt_llm(client, "prompt", parse=ast.literal_eval) == {"intent": "normal"}
+    assert setup_llm.prompt_llm(client, "prompt", parse=ast.literal_eval) == {"intent": "normal"}
+    assert client.calls == 1
+
+
+def test_truncated_completions_are_not_cached(cache):
+    client = ScriptedClient(completion("cut o", "length"), ("cut o", "length"), completion("full"))
+    assert setup_llm.prompt_llm(client, "prompt") == "cut o"
+    assert list(setup_llm.prompt_llm_stream(client, "prompt")) == ["cut o"]
+    assert setup_llm.prompt_llm(client, "prompt") == "full"
+    assert list(setup_llm.prompt_llm_stream(client, "prompt")) == ["full"]
+    assert client.calls == 3
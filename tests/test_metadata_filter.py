@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+from rag_methods.metadata_filter import MetadataColumns
+
+WINES = pd.DataFrame({
+    "id": [1, 2, 3, 4, 5],
+    "price": [12.0, 25.0, 60.0, np.nan, 18.0],
+    "points": [88, 92, 95, 90, 85],
+    "vintage": [2015, 2018, 2010, 2019, 2020],
+    "variety": ["Riesling", "Pinot Noir", "Cabernet Sauvignon", "Pinot Noir", "Rosé"],
+    "designation": [None, "Reserve", None, None, None],
+    "province": ["Mosel", "Oregon", "California", "Burgundy", "Provence"],
+    "region_1": [None, "Willamette Valley", "Napa Valley", "Côte de Nuits", None],
+    "country": ["Germany", "US", "US", "France", "France"],
+    "wine_color": ["White", "Red", "Red", "Red", "Rosé"],
+})
+
+
+def compile_constraints(positive=None, negative=None):
+    return MetadataColumns(WINES).compile({"positive": positive or {}, "negative": negative or {}})
+
+
+def rows(mask):
+    return np.flatnonzero(mask).tolist()
+
+
+def test_each_relaxation_level_drops_the_next_group():
+    constraints = compile_constraints({"max_price": 20, "points": 90, "country": "US", "wine_color": "red"})
+    assert rows(constraints.level_mask(0)) == []
+    # level 1 drops the price limits, level 2 also the points, level 4 also the country
+    assert rows(constraints.level_mask(1)) == [1, 2]
+    assert rows(constraints.level_mask(2)) == [1, 2]
+    assert rows(constraints.level_mask(4)) == [1, 2, 3]
+    # the final fallback keeps only the desired color
+    assert rows(constraints.level_mask(constraints.num_levels)) == [1, 2, 3]
+
+
+def test_missing_numeric_values_are_not_rejected_and_placeholders_are_ignored():
+    constraints = compile_constraints({"min_price": 15, "country": "-", "points": "-"})
+    assert rows(constraints.level_mask(0)) == [1, 2, 3, 4]
+
+
+def test_categorical_constraints_match_any_column_case_insensitively():
+    constraints = compile_constraints({"province": ["willamette valley", "MOSEL"],
+                                       "variety_designation": "reserve"})
+    assert rows(constraints.level_mask(0)) == [1]
+
+
+def test_negative_constraints_are_kept_until_the_color_fallback():
+    constraints = compile_constraints({"wine_color": "red"}, {"country": "us"})
+    for level in range(constraints.num_levels):
+        assert rows(constraints.level_mask(level)) == [3]
+    assert rows(constraints.level_mask(constraints.num_levels)) == [1, 2, 3]
+
+
+def test_allowed_mask_is_the_strictest_level_with_enough_rows():
+    constraints = compile_constraints({"max_price": 20, "points": 90, "country": "US", "wine_color": "red"})
+    assert rows(constraints.allowed_mask(1)) == [1, 2]
+    assert rows(constraints.allowed_mask(3)) == [1, 2, 3]
+
+
+def test_select_orders_by_level_then_input_order_and_drops_unknown_rows():
+    constraints = compile_constraints({"max_price": 20, "country": "France", "wine_color": "red"})
+    # row 3 matches level 0, rows 2 and 1 only once price and country are dropped, row 0 never (white)
+    selected = constraints.select([0, 2, -1, 3, 1], k=3)
+    assert selected.tolist() == [3, 1, 4]
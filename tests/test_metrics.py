@@ -0,0 +1,39 @@
+import time
+from types import SimpleNamespace
+
+from llm_setup import setup_llm
+from monitoring.metrics import stage_seconds, trace_request
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def chunk(content):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason=None)],
+                           usage=None)
+
+
+def test_streamed_completion_is_timed_to_its_last_chunk_with_time_to_first_token(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "perf_counter", clock)
+    monkeypatch.setattr(setup_llm, "_llm_cache", None)
+    monkeypatch.setattr(setup_llm, "_llm_cache_configured", True)
+
+    def stream():
+        clock.now += 0.5
+        yield chunk("Hello ")
+        clock.now += 2.0
+        yield chunk("world")
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **params: stream())))
+    with trace_request() as trace:
+        text = "".join(setup_llm.prompt_llm_stream(client, "prompt", prompt_key="stream_test"))
+
+    assert text == "Hello world"
+    assert trace.summary()["stage_totals_ms"] == {"llm.stream_test": 2500.0, "llm.stream_test.first_token": 500.0}
+    assert "wine_rag_stage_seconds_count{stage=\"llm.stream_test.first_token\"} 1" in stage_seconds.render()
@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+
+import faiss
+import numpy as np
+
+from vectorstore.registry import VectorstoreRegistry, estimate_vectorstore_bytes
+
+
+def fake_vectorstore(num_vectors, memory_mapped=False):
+    index = faiss.IndexFlatL2(8)
+    index.add(np.zeros((num_vectors, 8), dtype=np.float32))
+    return SimpleNamespace(index=index, docstore=SimpleNamespace(memory_mapped=memory_mapped),
+                           embedding_function=object())
+
+
+def test_memory_mapped_vectors_count_towards_the_estimate():
+    assert estimate_vectorstore_bytes(fake_vectorstore(100)) == (3200, 0)
+    assert estimate_vectorstore_bytes(fake_vectorstore(100, memory_mapped=True)) == (3200, 3200)
+
+
+def test_least_recently_used_store_is_evicted_over_the_cap():
+    stores = {"a": fake_vectorstore(100, memory_mapped=True), "b": fake_vectorstore(100, memory_mapped=True),
+              "c": fake_vectorstore(100)}
+    registry = VectorstoreRegistry(memory_cap_bytes=7000, loader=stores.__getitem__)
+    registry.get("a")
+    registry.get("b")
+    registry.get("a")
+    registry.get("c")
+    assert [entry["emb_model"] for entry in registry.loaded()] == ["c", "a"]
+    assert registry.total_bytes() == 6400
+
+
+def test_requested_store_is_kept_even_when_it_alone_exceeds_the_cap():
+    registry = VectorstoreRegistry(memory_cap_bytes=100, loader=lambda name: fake_vectorstore(100))
+    registry.get("a")
+    registry.get("b")
+    assert [entry["emb_model"] for entry in registry.loaded()] == ["b"]
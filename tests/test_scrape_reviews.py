@@ -0,0 +1,84 @@
+import asyncio
+import json
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("aiohttp")
+pytest.importorskip("bs4")
+pytest.importorskip("tqdm")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data_processing",
+                                "reviews_scraping"))
+import scrape_reviews  # noqa: E402
+import stub_server  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+
+def write_jsonl(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def test_ledger_is_keyed_by_title_and_ignores_positional_entries(tmp_path):
+    write_jsonl(tmp_path / scrape_reviews.LEDGER_FILE, [{"title": "Wine A", "status": "matched"},
+                                                       {"index": 3, "status": "not_matched"},
+                                                       {"title": "Wine B", "status": "no_reviews"}])
+    assert scrape_reviews.completed_titles(str(tmp_path)) == {"Wine A", "Wine B"}
+
+
+def test_export_follows_the_input_order_and_pads_like_the_old_shards(tmp_path):
+    write_jsonl(tmp_path / scrape_reviews.RECORDS_FILE, [
+        {"title": "Wine B", "id": "2", "status": "matched", "reviews": [["Juicy.", 4.0]]},
+        {"title": "Wine A", "id": "1", "status": "matched", "reviews": [["Firm.", 3.5], ["Long.", 4.5]]},
+    ])
+    path = str(tmp_path / "reviews.csv")
+    scrape_reviews.export_reviews(str(tmp_path), path, titles=["Wine A", "Wine C", "Wine B", "Wine A"])
+
+    exported = pd.read_csv(path)
+    assert exported["title"].tolist() == ["Wine A", "Wine B"]
+    assert exported.loc[0, "review_2"] == "('Long.', 4.5)"
+    assert exported.loc[1, "review_2"] == exported.loc[1, "review_10"] == "(None, None)"
+
+
+def test_scrape_against_a_rate_limited_flaky_stub_finishes_every_title_and_resumes(tmp_path, monkeypatch):
+    buckets = []
+
+    class RecordingBucket(scrape_reviews.TokenBucket):
+        def __init__(self, rate):
+            super().__init__(rate)
+            self.rates = [rate]
+            buckets.append(self)
+
+        def throttled(self, retry_after):
+            super().throttled(retry_after)
+            self.rates.append(self.rate)
+
+    monkeypatch.setattr(scrape_reviews, "TokenBucket", RecordingBucket)
+    titles = [f"Wine {i}" for i in range(40)] + ["Ambiguous Wine", "Wine 3"]
+
+    async def run():
+        server = TestServer(stub_server.make_app(max_rps=15, error_rate=0.1))
+        await server.start_server()
+        try:
+            base_url = str(server.make_url("")).rstrip("/")
+            first = await scrape_reviews.scrape(titles, str(tmp_path), base_url=base_url, workers=6, rate=60,
+                                                base_delay=0.01)
+            again = await scrape_reviews.scrape(titles, str(tmp_path), base_url=base_url, workers=6, rate=60,
+                                                base_delay=0.01)
+            return first, again
+        finally:
+            await server.close()
+
+    first, again = asyncio.run(run())
+
+    assert "error" not in first and sum(first.values()) == 41
+    assert first["not_matched"] == 1
+    assert scrape_reviews.completed_titles(str(tmp_path)) == set(titles)
+    assert again == {}
+    assert min(buckets[0].rates) < 60
+
+    exported = scrape_reviews.export_reviews(str(tmp_path), str(tmp_path / "reviews.csv"), titles)
+    assert len(exported) == first["matched"]
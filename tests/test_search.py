@@ -0,0 +1,99 @@
+import faiss
+import numpy as np
+import pytest
+
+from vectorstore import search
+from vectorstore.ann_index import build_index
+from vectorstore.search import search_subset
+from vectorstore.segments import SegmentedIndex
+
+
+def brute_force(vectors, query, positions, k, metric):
+    if metric == faiss.METRIC_INNER_PRODUCT:
+        scores = -(vectors[positions] @ query)
+    else:
+        scores = ((vectors[positions] - query) ** 2).sum(axis=1)
+    return positions[np.argsort(scores, kind="stable")[:k]]
+
+
+@pytest.fixture
+def vectors():
+    return np.random.default_rng(0).standard_normal((2000, 16)).astype(np.float32)
+
+
+@pytest.mark.parametrize("metric", [faiss.METRIC_L2, faiss.METRIC_INNER_PRODUCT])
+@pytest.mark.parametrize("exact", [True, False])
+def test_flat_subset_search_returns_the_nearest_allowed_positions(vectors, metric, exact, monkeypatch):
+    if not exact:
+        monkeypatch.setattr(search, "EXACT_SEARCH_MAX_ROWS", 0)
+    index = faiss.IndexFlat(vectors.shape[1], metric)
+    index.add(vectors)
+    positions = np.flatnonzero(np.arange(len(vectors)) % 7 == 3)
+    query = vectors[:1] + 0.1
+
+    distances, found = search_subset(index, query, positions, 10)
+    assert found.tolist() == brute_force(vectors, query[0], positions, 10, metric).tolist()
+    assert set(found) <= set(positions)
+    assert list(distances) == sorted(distances, reverse=metric == faiss.METRIC_INNER_PRODUCT)
+
+
+def test_subset_smaller_than_k_and_empty_subset(vectors):
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+    _, found = search_subset(index, vectors[:1], np.array([5, 9], dtype=np.int64), 10)
+    assert sorted(found.tolist()) == [5, 9]
+    _, found = search_subset(index, vectors[:1], np.empty(0, dtype=np.int64), 10)
+    assert len(found) == 0
+
+
+@pytest.mark.parametrize("index_type", ["ivf", "hnsw"])
+@pytest.mark.parametrize("exact", [True, False])
+def test_ann_subset_search_stays_inside_the_subset(vectors, index_type, exact, monkeypatch):
+    if not exact:
+        monkeypatch.setattr(search, "EXACT_SEARCH_MAX_ROWS", 0)
+    index = build_index(vectors, index_type, nlist=16, nprobe=8)
+    positions = np.flatnonzero(np.arange(len(vectors)) % 7 == 3)
+    query = vectors[:1] + 0.1
+
+    _, found = search_subset(index, query, positions, 10)
+    expected = brute_force(vectors, query[0], positions, 10, faiss.METRIC_L2)
+    assert set(found) <= set(positions)
+    if exact:
+        # small subsets are scored exactly from reconstructed vectors, whatever the index type
+        assert found.tolist() == expected.tolist()
+    else:
+        assert len(set(found) & set(expected)) >= 8
+
+
+def segmented(vectors, metric, dead):
+    base, delta = faiss.IndexFlat(vectors.shape[1], metric), faiss.IndexFlat(vectors.shape[1], metric)
+    base.add(vectors[:1500])
+    delta.add(vectors[1500:])
+    return SegmentedIndex([base, delta], dead)
+
+
+@pytest.mark.parametrize("metric", [faiss.METRIC_L2, faiss.METRIC_INNER_PRODUCT])
+def test_segmented_index_searches_like_one_index_without_its_dead_positions(vectors, metric):
+    dead = np.arange(0, len(vectors), 3)
+    index = segmented(vectors, metric, dead)
+    live = np.setdiff1d(np.arange(len(vectors)), dead)
+    queries = vectors[:5] + 0.1
+
+    distances, found = index.search(queries, 10)
+    for query, row in zip(queries, found):
+        assert row.tolist() == brute_force(vectors, query, live, 10, metric).tolist()
+    assert np.allclose(index.reconstruct_batch(np.array([3, 1700])), vectors[[3, 1700]])
+
+
+@pytest.mark.parametrize("exact", [True, False])
+def test_segmented_subset_search_skips_dead_positions(vectors, exact, monkeypatch):
+    if not exact:
+        monkeypatch.setattr(search, "EXACT_SEARCH_MAX_ROWS", 0)
+    dead = np.arange(0, len(vectors), 2)
+    index = segmented(vectors, faiss.METRIC_L2, dead)
+    positions = np.flatnonzero(np.arange(len(vectors)) % 3 == 0)
+    query = vectors[1450:1451] + 0.1
+
+    _, found = search_subset(index, query, positions, 10)
+    allowed = np.setdiff1d(positions, dead)
+    assert found.tolist() == brute_force(vectors, query[0], allowed, 10, faiss.METRIC_L2).tolist()